@@ -9,51 +9,160 @@
 # bugs to vladimir kulyukin in canvas.
 #######################################
 
-from ntutils import is_prime
+from ntutils import is_probable_prime
 from ntutils import is_primitive_root_of_p
+from ntutils import miller_rabin
+from ntutils import primes_up_to
+import functools
+import hashlib
 import random
+import secrets
 from pubrepo import pubrepo
+from grputils import mod_exp, element_width, encode_elements
+from metrics import trace, INFO
+
+### odd primes used to sieve candidates for safe primes.
+SIEVE_PRIMES = primes_up_to(1 << 18)[1:]
+SIEVE_SPAN = 1 << 14
+
+class group_hash(object):
+    """
+    A crypto hash function that maps tuples of integers to an integer
+    mod q. Each integer is encoded in element_width(p) bytes, so every
+    element of Z_p has exactly one encoding, and the digest bytes are
+    read as a big-endian integer. Integers outside [0, 2^(8*width))
+    raise ValueError. The last memo_size results are memoized, so that
+    the challenge of a coin is hashed once as the coin travels from the
+    spender through the merchant to the bank.
+    """
+
+    def __init__(self, q, p, name, memo_size=0):
+        self.q = q
+        self.p = p
+        self.name = name
+        self.width = element_width(p)
+        self.memo_size = memo_size
+        if memo_size:
+            self.__hash = functools.lru_cache(maxsize=memo_size)(self.__digest)
+        else:
+            self.__hash = self.__digest
+
+    def __digest(self, int_tup):
+        buf = encode_elements(int_tup, self.width)
+        return int.from_bytes(hashlib.new(self.name, buf).digest(), 'big') % self.q
+
+    def __call__(self, int_tup):
+        return self.__hash(tuple(int_tup))
+
+    def __reduce__(self):
+        ### the memo is not pickled; it is rebuilt empty.
+        return (group_hash, (self.q, self.p, self.name, self.memo_size))
 
 class auth(object):
 
+    def __init__(self, nbits=None):
+        """
+        nbits is the bit length of the safe prime p generated by
+        the Authority. If nbits is None, the toy parameters
+        p = 227, q = 113 of Lecture 25 are used.
+        """
+        assert nbits is None or nbits >= 16
+        self.__nbits = nbits
+
+    def __sieve_safe_prime_candidates(self, q0, span):
+        """
+        yield q = q0 + 2k, 0 <= k < span, such that neither q nor
+        2q+1 is divisible by a sieve prime sp with sp^2 <= q0. q0 is odd.
+        """
+        sieve = bytearray(span)
+        for sp in SIEVE_PRIMES:
+            if sp * sp > q0:
+                break
+            inv2 = (sp + 1) // 2
+            ## q0 + 2k == 0 (mod sp) and 2(q0 + 2k) + 1 == 0 (mod sp)
+            for res in (0, (sp - 1) // 2):
+                k = ((res - q0) * inv2) % sp
+                sieve[k::sp] = b'\x01' * len(range(k, span, sp))
+        for k in range(span):
+            if not sieve[k]:
+                yield q0 + 2*k
+
     def __find_pq(self):
         """
         return p and q such that p is a prime, q is a prime and q = (p-1)/2.
+        The candidates for q are sieved so that neither q nor 2q+1 has
+        a small prime factor. The survivors are filtered with a base-2
+        Fermat test on q and p, and q is then confirmed with Miller-Rabin.
+        If q is prime and 2^(p-1) == 1 (mod p), then p is prime by
+        Pocklington's criterion, because q > sqrt(p).
         """
-        return 227, 113
+        if self.__nbits is None:
+            return 227, 113
+        nbits = self.__nbits
+        span = SIEVE_SPAN
+        while True:
+            q0 = secrets.randbits(nbits-1) | (1 << (nbits-2)) | (1 << (nbits-3)) | 1
+            for q in self.__sieve_safe_prime_candidates(q0, span):
+                p = 2*q + 1
+                if p.bit_length() != nbits:
+                    break
+                if pow(2, q-1, q) != 1 or pow(2, p-1, p) != 1:
+                    continue
+                rng = random.SystemRandom()
+                if miller_rabin(q, (rng.randrange(2, q-1) for _ in range(40))):
+                    return p, q
 
-    def __choose_primitive_root_of_p(self, p):
+    def __choose_primitive_root_of_p(self, p, q):
         """
-        13 is a primitive root of 227.
+        13 is a primitive root of 227. For a generated safe prime p = 2q+1,
+        a random r is a primitive root iff r^2 != 1 and r^q != 1 (mod p).
         """
-        return 13
+        if self.__nbits is None:
+            return 13
+        while True:
+            r = secrets.randbelow(p-3) + 2
+            if is_primitive_root_of_p(r, p, (2, q)):
+                return r
+
+    def __choose_k1_k2(self, q):
+        """
+        The exponents k1 and k2 are fixed and small for the toy parameters
+        so that our unit tests pass w/o any buffer overflows. For
+        generated parameters, they are distinct random elements of Z_q.
+        """
+        if self.__nbits is None:
+            return 3, 5
+        k1 = secrets.randbelow(q-2) + 2
+        k2 = k1
+        while k2 == k1:
+            k2 = secrets.randbelow(q-2) + 2
+        return k1, k2
 
     def init_p_q_g_g1_g2_H_H0(self, pbr):
         """
         Creation of p, p, g, g1, H, and H0 by Authority.
         Cf. Slides 13 - 16 of Lecture 25.
+        The Authority can call this method again at every key rotation
+        to publish a fresh group in pbr.
         """
         ### 1. Auth chooses primes p, q.
         p, q = self.__find_pq()
-        assert is_prime(p) and is_prime(q) and q == (p-1)/2        
+        assert is_probable_prime(p) and is_probable_prime(q) and q == (p-1)//2
 
         ### 2. Auth chooses a primitive root r of p
-        r = self.__choose_primitive_root_of_p(p)
-        assert is_primitive_root_of_p(r, p)
+        r = self.__choose_primitive_root_of_p(p, q)
+        assert is_primitive_root_of_p(r, p, (2, q))
         ### and computes g = r^2
-        g = r**2
+        g = mod_exp(r, 2, p)
         ### 3. Auth chooses 2 random exponents k1 and k2.
-        ###    The larger the better of course, but
-        ###    we'll keep fixed and small to make sure
-        ###    that our unit tests pass w/o any buffer overflows.
-        k1, k2 = 3, 5
+        k1, k2 = self.__choose_k1_k2(q)
 
-        g1 = (g**k1) % p
-        g2 = (g**k2) % p
+        g1 = mod_exp(g, k1, p)
+        g2 = mod_exp(g, k2, p)
 
         ### 4. Auth creates 2 hash functions.
-        H = self.__create_H(q)
-        H0 = self.__create_H0(q)
+        H = self.__create_H(q, p)
+        H0 = self.__create_H0(q, p)
 
         ## 5. Autho publishes p, p, g, g1, g2, H, H0
         pbr.set_p(p)
@@ -66,36 +175,25 @@ class auth(object):
 
         self.__display_init_results(pbr)
 
-    def __create_H(self, q):
+    def __create_H(self, q, p):
         """ 
         Create a crypto hash function that maps 5 tuples to an integer mod q.
         """
-        import hashlib
-        def H(int_5_tup):
-            assert len(int_5_tup) == 5
-            for i in range(5):
-                assert isinstance(int_5_tup[i], int)
-            return int(hashlib.sha3_512(bytes(int_5_tup)).hexdigest(), 16) % q
-        return H
-
-    def __create_H0(self, q):
+        return group_hash(q, p, 'sha3_512', memo_size=1 << 12)
+
+    def __create_H0(self, q, p):
         """
         Create a crypto hash function that maps 4 tuples to an integer mod q.
+        H0 hashes a fresh time stamp every time, so it has no memo.
         """
-        import hashlib
-        def H0(int_4_tup):
-            assert len(int_4_tup) == 4
-            for i in range(4):
-                assert isinstance(int_4_tup[i], int)
-            return int(hashlib.sha3_384(bytes(int_4_tup)).hexdigest(), 16) % q
-        return H0
+        return group_hash(q, p, 'sha3_384')
 
     def __display_init_results(self, pbr):
-        print('*** Authority initialization done...')
-        print('p  == {}'.format(pbr.get_p()))
-        print('q  == {}'.format(pbr.get_q()))
-        print('g  == {}'.format(pbr.get_g()))
-        print('g1 == {}'.format(pbr.get_g1()))
-        print('g2 == {}'.format(pbr.get_g2()))
+        trace(INFO, '*** Authority initialization done...')
+        trace(INFO, 'p  == {}', pbr.get_p())
+        trace(INFO, 'q  == {}', pbr.get_q())
+        trace(INFO, 'g  == {}', pbr.get_g())
+        trace(INFO, 'g1 == {}', pbr.get_g1())
+        trace(INFO, 'g2 == {}', pbr.get_g2())
  
 
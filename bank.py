@@ -8,28 +8,227 @@
 ##############################################################
 
 import random
+import threading
 from pubrepo import pubrepo
-from ntutils import mult_inv
+from nonces import nonce_pool
+from ledger import memory_ledger
+from records import coin_id, coin_record, signature_record, deposit_record, account_table
+from wire import iter_deposit_record_chunks
+from metrics import trace, timed, counter_for, DEBUG, INFO, WARNING
+from grputils import mod_exp, mod_mult, mod_inv, multi_exp, fixed_base_table_cache
+from grputils import is_multi_exp_equal, is_subgroup_member
+
+### the outcomes of a deposit.
+CREDITED, REJECTED, DOUBLE_SPENT = 0, 1, 2
+
+### the counts of the deposits by outcome and of the declined withdrawals.
+DEPOSIT_COUNTERS = {status: counter_for('digcash_bank_deposits_total', 'coins deposited by outcome',
+                                        outcome=outcome)
+                    for status, outcome in ((CREDITED, 'credited'), (REJECTED, 'rejected'),
+                                            (DOUBLE_SPENT, 'double_spent'))}
+_C1S_DECLINED = counter_for('digcash_bank_c1s_declined_total', 'withdrawals declined by the bank')
+
+def group_of(pbr):
+    """
+    the published elements of pbr, which determine the checks of a coin.
+    """
+    return (pbr.get_p(), pbr.get_q(), pbr.get_g(), pbr.get_g1(), pbr.get_g2(),
+            pbr.get_h(), pbr.get_h1(), pbr.get_h2())
+
+def is_coin_in_range(coin, p, q):
+    """
+    is_coin_canonical with p and q bound by the caller.
+    """
+    A, B, z, a, b, r = coin
+    return 0 < A < p and 0 < B < p and 0 < z < p and 0 < a < p and 0 < b < p and 0 <= r < q
+
+def is_signature_in_range(coin_signature, q):
+    """
+    is_signature_canonical with q bound by the caller.
+    """
+    r1, r2, d = coin_signature
+    return 0 <= r1 < q and 0 <= r2 < q and 0 <= d < q
+
+def is_coin_canonical(coin, pbr):
+    """
+    Are A, B, z, a, b in [1, p-1] and r in [0, q-1]? The congruences
+    only see the coin mod p and r mod q, so without this check the same
+    coin could be deposited again with an element shifted by p or q,
+    and it would not be found in the ledger.
+    """
+    return is_coin_in_range(coin, pbr.get_p(), pbr.get_q())
+
+def is_signature_canonical(coin_signature, pbr):
+    """
+    Are r1, r2, d in [0, q-1]? The third congruence only sees them mod
+    q, so a signature shifted by q would be accepted as well, and the
+    ledger would record a different signature for the coin.
+    """
+    return is_signature_in_range(coin_signature, pbr.get_q())
+
+def is_coin_deposit_valid(coin, coin_signature, pbr):
+    """
+    Check the 3 congruences on Slide 30 for the coin (A,B,z,a,b,r)
+    with the signature (r1,r2,d):
+    g^r == a*h^H(A,B,z,a,b), A^r == b*z^H(A,B,z,a,b), g1^r1*g2^r2 == B*A^d.
+    """
+    p, q, H, g_tab, h_tab, g1_tab, g2_tab = pbr.get_verification_params()
+    if not is_coin_in_range(coin, p, q) or not is_signature_in_range(coin_signature, q):
+        return False
+    A, B, z, a, b, r = coin
+    r1, r2, d = coin_signature
+    c = H((A,B,z,a,b))
+    ### the congruences are checked as single multi-exponentiations:
+    ### g^r * h^(-c) == a, A^r * z^(-c) == b, g1^r1 * g2^r2 * A^(-d) == B.
+    return is_multi_exp_equal(((g_tab, r), (h_tab, -c)), a, p) and \
+           is_multi_exp_equal(((A, r), (z, -c)), b, p) and \
+           is_multi_exp_equal(((g1_tab, r1), (g2_tab, r2), (A, -d)), B, p)
+
+def _batch_congruences_hold(coins_with_signatures, pbr):
+    """
+    Small-exponent batch test of the congruences of all coins, whose
+    group elements are in the order-q subgroup. Each congruence of each
+    coin is raised to a random delta of up to 64 bits (fewer for small
+    groups), and the product of the left sides is compared with the
+    product of the right sides. The test is repeated for small groups
+    so that an invalid coin passes with probability at most about 2^-64.
+    """
+    p, q, H, g_tab, h_tab, g1_tab, g2_tab = pbr.get_verification_params()
+    rng = random.SystemRandom()
+    delta_bits = min(64, q.bit_length() - 1)
+    challenges = [H((A,B,z,a,b)) for (A, B, z, a, b, r), _ in coins_with_signatures]
+    for _ in range(-(-64 // delta_bits)):
+        e_g = e_h = e_g1 = e_g2 = 0
+        lhs, rhs = [], []
+        for ((A, B, z, a, b, r), (r1, r2, d)), c in zip(coins_with_signatures, challenges):
+            d1, d2, d3 = (rng.randrange(1, 1 << delta_bits) for _ in range(3))
+            ### (g^r * h^(-c))^d1 == a^d1
+            e_g += d1 * r
+            e_h -= d1 * c
+            rhs.append((a, d1))
+            ### (A^r)^d2 == (b * z^c)^d2 and
+            ### (g1^r1 * g2^r2)^d3 == (B * A^d)^d3
+            e_g1 += d3 * r1
+            e_g2 += d3 * r2
+            lhs.append((A, (d2 * r - d3 * d) % q))
+            rhs.append((b, d2))
+            rhs.append((z, (d2 * c) % q))
+            rhs.append((B, d3))
+        lhs.extend(((g_tab, e_g), (h_tab, e_h), (g1_tab, e_g1), (g2_tab, e_g2)))
+        if multi_exp(lhs, p) != multi_exp(rhs, p):
+            return False
+    return True
+
+def batch_verify_coin_deposits(coins_with_signatures, pbr):
+    """
+    Return the indices of the valid (coin, coin_signature) pairs.
+    Coins whose group elements are not all in the order-q subgroup are
+    checked one by one with is_coin_deposit_valid. The other coins are
+    checked together; if the batch test fails, the batch is bisected
+    until every invalid coin is isolated and rejected by the exact
+    single-coin check.
+    """
+    p, q = pbr.get_p(), pbr.get_q()
+    valid, members = [], []
+    for i, (coin, coin_signature) in enumerate(coins_with_signatures):
+        if not is_coin_in_range(coin, p, q) or not is_signature_in_range(coin_signature, q):
+            continue
+        if all(is_subgroup_member(x, p) for x in coin[:5]):
+            members.append(i)
+        elif is_coin_deposit_valid(coin, coin_signature, pbr):
+            valid.append(i)
+    stack = [members]
+    while stack:
+        idxs = stack.pop()
+        if not idxs:
+            continue
+        if len(idxs) == 1:
+            coin, coin_signature = coins_with_signatures[idxs[0]]
+            if is_coin_deposit_valid(coin, coin_signature, pbr):
+                valid.append(idxs[0])
+        elif _batch_congruences_hold([coins_with_signatures[i] for i in idxs], pbr):
+            valid.extend(idxs)
+        else:
+            mid = len(idxs) // 2
+            stack.append(idxs[mid:])
+            stack.append(idxs[:mid])
+    return sorted(valid)
+
+def compute_double_spender_id(spent_coin_sig, coin_signature, q):
+    """
+    The identity u of the spender who signed the same coin with
+    (r1, r2, d) and (r1_prime, r2_prime, d_prime) (cf. Slide 34):
+    u == (r1 - r1_prime) * (r2 - r2_prime)^{-1} (mod q).
+    Returns None if r2 == r2_prime (mod q), i.e., d == d_prime, because
+    then the two signatures carry no information about u.
+    """
+    r1, r2, d = spent_coin_sig
+    r1_prime, r2_prime, d_prime = coin_signature
+    r2_diff = r2 - r2_prime
+    if r2_diff % q == 0:
+        return None
+    return ((r1 - r1_prime) * mod_inv(r2_diff, q)) % q
+
+class lock_stripes(object):
+    """
+    num_stripes locks, each of which guards the keys that hash to it,
+    so that operations on keys of different stripes run in parallel.
+    """
+
+    def __init__(self, num_stripes=64):
+        self.__locks = [threading.Lock() for _ in range(num_stripes)]
+
+    def __call__(self, key):
+        return self.__locks[hash(key) % len(self.__locks)]
 
 class bank(object):
+    """
+    The bank is safe to call from many threads. A spender's or a
+    merchant's balance is read, checked, and updated under the lock of
+    its account's stripe. A coin is verified without a lock and then
+    looked up, recorded, and credited under the lock of its digest's
+    stripe, so a coin is credited at most once, while independent
+    spenders, merchants, and coins do not wait for each other. The
+    ledger is called without a lock of the bank, so it must be safe to
+    call from many threads, as the ledgers of ledger.py are.
+    """
 
-    def __init__(self):
+    def __init__(self, ledger=None, spender_cache_size=1024, num_lock_stripes=64):
+        """
+        ledger is the spent-coin ledger (e.g., a ledger.sqlite_ledger
+        that survives restarts). By default, the ledger is in memory.
+        spender_cache_size is the number of spenders whose fixed-base
+        tables of I*g2 are kept for their withdrawals. num_lock_stripes
+        is the number of locks of the accounts and of the coins.
+        """
         ### Initialization steps by the Bank on Slides 17,18.
         ### The bank chooses its secret identiy x.
         self.__x = 19
         ### The bank creates a table of spender accounts
-        self.__spender_accounts = {}
+        self.__spender_accounts = account_table()
         ### The bank creates a table of merchant accounts
-        self.__merchant_accounts = {}
+        self.__merchant_accounts = account_table()
         ### The bank keeps track of the spent coins
-        ### by mapping coins to their signatures.
-        self.__spent_coins = {}
-        ### The bank keeps track of generated w numbers
-        ### for each coin (cf. Slide 21)
-        self.__ws = set()
-        ### the bank keeps track of generated gws for each
-        ### coin. (cf. Slide 21).
-        self.__gws = {}
+        ### by mapping coin digests to their signatures.
+        self.__spent_coins = ledger if ledger is not None else memory_ledger()
+        ### The bank draws the w number of each coin and its gw from
+        ### a pool of precomputed (w, gw) pairs, which keeps track of
+        ### the gws issued for coins (cf. Slide 21). The pool is
+        ### created with the public repo of the first withdrawal and
+        ### recreated when the group changes.
+        self.__nonces = None
+        ### The bank raises I*g2 to a fresh w for every coin of the
+        ### spender I, so it keeps the fixed-base tables of I*g2 of
+        ### the most recently active spenders, keyed by I.
+        self.__spender_cache_size = spender_cache_size
+        self.__spender_tables = None
+        ### The locks of the accounts' balances and of the coins. The
+        ### tables lock guards the creation of accounts and the setup
+        ### lock the creation of the nonce pool and of the spender tables.
+        self.__account_locks = lock_stripes(num_lock_stripes)
+        self.__coin_locks = lock_stripes(num_lock_stripes)
+        self.__tables_lock = threading.Lock()
+        self.__setup_lock = threading.Lock()
 
     def create_h_h1_h2(self, pbr):
         """
@@ -37,9 +236,9 @@ class bank(object):
         pbr is a public repo object.
         """
         p  = pbr.get_p()
-        h  = (pbr.get_g()**self.__x)  % p
-        h1 = (pbr.get_g1()**self.__x) % p
-        h2 = (pbr.get_g2()**self.__x) % p
+        h  = mod_exp(pbr.get_g(),  self.__x, p)
+        h1 = mod_exp(pbr.get_g1(), self.__x, p)
+        h2 = mod_exp(pbr.get_g2(), self.__x, p)
 
         ### publish h, h1, h2 in the public repo.
         pbr.set_h(h)
@@ -49,13 +248,10 @@ class bank(object):
         self.__display_init_results(pbr)
 
     def __display_init_results(self, pbr):
-        print('*** Bank initialization done...')
-        h = pbr.get_h()
-        h1 = pbr.get_h1()
-        h2 = pbr.get_h2()
-        print('h  == {}'.format(h))
-        print('h1 == {}'.format(h1))
-        print('h2 == {}'.format(h2))
+        trace(INFO, '*** Bank initialization done...')
+        trace(INFO, 'h  == {}', pbr.get_h())
+        trace(INFO, 'h1 == {}', pbr.get_h1())
+        trace(INFO, 'h2 == {}', pbr.get_h2())
         
 
     def create_spender_account(self, I, pbr, num_credit_units = 10):
@@ -65,95 +261,264 @@ class bank(object):
         ### 1. the bank computes z' (cf. Slide 19) by looking up
         ### g2 and p in public repo pbr and using its secret idenity x
         ### and the number I provided by the spender.
-        z_prime  = ((I*pbr.get_g2())**self.__x) % pbr.get_p()
+        p = pbr.get_p()
+        z_prime  = mod_exp(mod_mult(I, pbr.get_g2(), p), self.__x, p)
         ### The bank maps I to the number of credit units.
-        self.__spender_accounts[I] = num_credit_units
-        print('Bank created the spender account {} with {} credit units'.format(I, num_credit_units))
-        print('Bank computed z_prime == {}'.format(z_prime))
+        with self.__tables_lock, self.__account_locks(I):
+            self.__spender_accounts[I] = num_credit_units
+        trace(DEBUG, 'Bank created the spender account {} with {} credit units', I, num_credit_units)
+        trace(DEBUG, 'Bank computed z_prime == {}', z_prime)
         return z_prime
 
     def create_merchant_account(self, account_id):
         """
         merchant accounts are created w/ 0 credits.
         """
-        self.__merchant_accounts[account_id] = 0
-        print('Bank created the merchant account {} with 0 credit units'.format(account_id))
+        with self.__tables_lock, self.__account_locks(account_id):
+            self.__merchant_accounts[account_id] = 0
+        trace(DEBUG, 'Bank created the merchant account {} with 0 credit units', account_id)
 
-    def __gen_w(self):
+    def __nonce_pool(self, pbr):
         """
-        a generator for w created for each coin.
+        the nonce pool of the group of pbr. A pool of another group,
+        e.g., of the group before a key rotation, is closed and replaced.
         """
-        while True:
-            w = random.randint(5, 15)
-            if w not in self.__ws:
-                self.__ws.add(w)
-                print('Bank computed w == {}'.format(w))
-                return w
+        p = pbr.get_p()
+        nonces = self.__nonces
+        if nonces is None or nonces.p != p:
+            with self.__setup_lock:
+                nonces = self.__nonces
+                if nonces is None or nonces.p != p:
+                    if nonces is not None:
+                        nonces.close()
+                    nonces = nonce_pool(pbr.get_fixed_base_table(pbr.get_g()), pbr.get_q())
+                    self.__nonces = nonces
+        return nonces
 
+    def __spender_table(self, I, pbr):
+        """
+        the fixed-base table of I*g2 for the spender I.
+        """
+        p = pbr.get_p()
+        tables = self.__spender_tables
+        if tables is None or tables.p != p:
+            with self.__setup_lock:
+                tables = self.__spender_tables
+                if tables is None or tables.p != p:
+                    tables = fixed_base_table_cache(p, pbr.get_q(), self.__spender_cache_size)
+                    self.__spender_tables = tables
+        return tables.get(I, mod_mult(I, pbr.get_g2(), p))
+
+    def spender_table_stats(self):
+        """
+        the size, capacity, hits, misses, evictions, and hit rate of the
+        cache of the spenders' fixed-base tables.
+        """
+        return {} if self.__spender_tables is None else self.__spender_tables.stats()
+
+    def nonce_stats(self):
+        """
+        the statistics of the bank's nonce pool (cf. nonces.nonce_pool.stats).
+        """
+        return {} if self.__nonces is None else self.__nonces.stats()
+
+    def close(self):
+        """
+        stop the nonce pool's background thread.
+        """
+        if self.__nonces is not None:
+            self.__nonces.close()
+
+    @timed('bank.compute_gw_beta')
     def compute_gw_beta(self, I, pbr):
         """
         The bank creats gw and beta (cf. Slide 21).
         g, g2, and p are looked up in public repo pbr.
         I is created by the spender.
         """
-        w = self.__gen_w()
-        gw   = (pbr.get_g()**w) % pbr.get_p()
-        beta = ((I*pbr.get_g2())**w) % pbr.get_p()
-        ## the bank saves gw in __gws table.
-        self.__gws[gw] = w
-        print('Bank computed gw == {} and beta == {}'.format(gw, beta))
+        w, gw = self.__nonce_pool(pbr).take()
+        trace(DEBUG, 'Bank computed w == {}', w)
+        beta = self.__spender_table(I, pbr).exp(w)
+        trace(DEBUG, 'Bank computed gw == {} and beta == {}', gw, beta)
         return gw, beta
 
+    @timed('bank.compute_c1')
     def compute_c1(self, I, c, gw, pbr):
         ## 6. The Bank computes c1 = cx + w (mod q), sends c1 to the Spender,
         ## and immediately deducts the amount equal to 1 coin from the Spender’s
         ## account. Cf. Slides 24, 25.
-        if self.__spender_accounts[I] > 0:
-            self.__spender_accounts[I] -= 1
-            w  = self.__gws[gw]
-            c1 = (c*self.__x + w) % pbr.get_q()
-            print('Bank computed c1 == {}'.format(c1))
-            return c1
-        else:
-            ## no coin if the spender has 0 credit.
-            print('Bank cannot compute c1, because spender account {} has 0 credits'.format(I))
-            return None
+        ## The balance is checked and debited under the account's lock.
+        with self.__account_locks(I):
+            if self.__spender_accounts[I] <= 0:
+                ## no coin if the spender has 0 credit.
+                trace(WARNING, 'Bank cannot compute c1, because spender account {} has 0 credits', I)
+                _C1S_DECLINED.inc()
+                return None
+            ## the gw is redeemed only once, so no w is used for two c1s.
+            w = self.__nonce_pool(pbr).redeem(gw)
+            if w is None:
+                trace(WARNING, 'Bank cannot compute c1, because gw {} was not issued or has expired', gw)
+                _C1S_DECLINED.inc()
+                return None
+            self.__spender_accounts.add(I, -1)
+        c1 = (c*self.__x + w) % pbr.get_q()
+        trace(DEBUG, 'Bank computed c1 == {}', c1)
+        return c1
+
+    def compute_gw_betas(self, I, n, pbr):
+        """
+        n (gw, beta) pairs for a bulk withdrawal of n coins by the
+        spender I, as n calls of compute_gw_beta would return them.
+        The gws are issued until compute_c1s redeems them.
+        """
+        return [self.compute_gw_beta(I, pbr) for _ in range(n)]
 
+    @timed('bank.compute_c1s')
+    def compute_c1s(self, I, cs, gws, pbr):
+        """
+        The c1 of every challenge c in cs for the gw at the same position
+        in gws (cf. Slides 24, 25). The spender's account is debited with
+        len(cs) units at once, and only if it has that many; otherwise,
+        nothing is debited and the result is None.
+        """
+        n = len(cs)
+        assert n == len(gws)
+        with self.__account_locks(I):
+            if self.__spender_accounts[I] < n:
+                trace(WARNING, 'Bank cannot compute {} c1s, because spender account {} has {} credits',
+                      n, I, self.__spender_accounts[I])
+                _C1S_DECLINED.inc(n)
+                return None
+            ### all gws are redeemed at once before the debit, so an
+            ### unknown gw leaves the account and the gws as they were.
+            ws = self.__nonce_pool(pbr).redeem_all(gws)
+            if ws is None:
+                trace(WARNING, 'Bank cannot compute c1s, because some gw was not issued or has expired')
+                _C1S_DECLINED.inc(n)
+                return None
+            self.__spender_accounts.add(I, -n)
+        q = pbr.get_q()
+        c1s = [(c*self.__x + w) % q for c, w in zip(cs, ws)]
+        trace(DEBUG, 'Bank computed {} c1s for spender account {}', n, I)
+        return c1s
+
+    @timed('bank.deposit_coin_for_merchant')
     def deposit_coin_for_merchant(self, merchant_id, coin, coin_signature, pbr):
         """
         If the coin has been deposited before, the bank initiates double
         spending fraud control. Otherwise, the bank checks the validity
         of the coin with the 3 congruences on Slide 30.
         """
-        if coin in self.__spent_coins:
-            return self.double_spending_faud_control(merchant_id, coin, coin_signature, pbr)
-        else:
-            g = pbr.get_g()
-            g1 = pbr.get_g1()
-            g2 = pbr.get_g2()
-            A, B, z, a, b, r = coin
-            p = pbr.get_p()
-            H = pbr.get_H()
-            h = pbr.get_h()
-            r1, r2, d = coin_signature
-            cond1 = g**r % p == a*(h**H((A,B,z,a,b)))   % p
-            cond2 = A**r % p == ((z**H((A,B,z,a,b)))*b) % p
-            cond3 = (g1**r1)*(g2**r2) % p == ((A**d)*B) % p
-            ### if all conditions hold, the coin is added
-            ### to the set of spent coins and the merchant's
-            ### account is credited with 1 unit.
-            if cond1 and cond2 and cond3:
-                self.__spent_coins[coin] = coin_signature
-                self.__merchant_accounts[merchant_id] += 1
-                print('Bank deposited coin {} with signature {} to merchant account {}'.format(coin,
-                                                                                               coin_signature,
-                                                                                               merchant_id))
-                return merchant_id
+        coin, coin_signature = coin_record.of(coin), signature_record.of(coin_signature)
+        ### the congruences are checked before the coin's lock is taken,
+        ### so other coins of its stripe do not wait for them.
+        is_valid = not self.is_coin_spent(coin) and is_coin_deposit_valid(coin, coin_signature, pbr)
+        return self.__deposit_verified_coin(merchant_id, coin, coin_signature, is_valid, pbr)[1]
+
+    @timed('bank.deposit_coins')
+    def deposit_coins(self, merchant_id, coins_with_signatures, pbr, batch_size=64):
+        """
+        Deposit a list of (coin, coin_signature) pairs for the merchant.
+        Returns a list with the result of deposit_coin_for_merchant for
+        each pair, in order. The fresh coins are verified together in
+        batches of batch_size by batch_verify_coin_deposits.
+        """
+        coins_with_signatures = [(coin_record.of(coin), signature_record.of(coin_signature))
+                                 for coin, coin_signature in coins_with_signatures]
+        valid = self.__verify_fresh_coins(coins_with_signatures, pbr, batch_size)
+        return self.deposit_verified_coins(merchant_id, coins_with_signatures, valid, pbr)
+
+    def __verify_fresh_coins(self, coins_with_signatures, pbr, batch_size):
+        """
+        valid[i] tells if the i-th pair is unspent and passes the
+        congruences. Spent coins are not verified.
+        """
+        fresh = [i for i, (coin, _) in enumerate(coins_with_signatures)
+                 if not self.is_coin_spent(coin)]
+        valid = [False] * len(coins_with_signatures)
+        for k in range(0, len(fresh), batch_size):
+            batch = fresh[k:k+batch_size]
+            for j in batch_verify_coin_deposits([coins_with_signatures[i] for i in batch], pbr):
+                valid[batch[j]] = True
+        return valid
+
+    def is_coin_spent(self, coin):
+        return coin in self.__spent_coins
+
+    def deposit_verified_coins(self, merchant_id, coins_with_signatures, valid, pbr):
+        """
+        Deposit (coin, coin_signature) pairs whose congruences have been
+        checked elsewhere (e.g., in a verifier process); valid[i] tells
+        if the i-th pair passed. A spent coin goes to double spending fraud
+        control, an invalid fresh coin is rejected, and a valid fresh coin
+        is credited, as in deposit_coin_for_merchant.
+        """
+        return [self.__deposit_verified_coin(merchant_id, coin, coin_signature, is_valid, pbr)[1]
+                for (coin, coin_signature), is_valid in zip(coins_with_signatures, valid)]
+
+    def __deposit_verified_coin(self, merchant_id, coin, coin_signature, is_valid, pbr):
+        """
+        (CREDITED | REJECTED | DOUBLE_SPENT, result of deposit_coin_for_merchant).
+        """
+        coin, coin_signature = coin_record.of(coin), signature_record.of(coin_signature)
+        ### a coin verified as fresh may have been deposited since, so
+        ### it is looked up again under its lock.
+        with self.__coin_locks(coin_id(coin)):
+            if self.is_coin_spent(coin):
+                return DOUBLE_SPENT, self.double_spending_faud_control(merchant_id, coin, coin_signature, pbr)
+            elif not is_valid:
+                return REJECTED, self.__reject_coin(merchant_id, coin, coin_signature)
             else:
-                print('Bank failed to deposit coin {} with signature {} to merchant account {}'.format(coin,
-                                                                                                       coin_signature,
-                                                                                                       merchant_id))
-                return -1
+                return CREDITED, self.__credit_coin(merchant_id, coin, coin_signature)
+
+    def ingest_settlement_file(self, src, pbr, chunk_records=4096, batch_size=64):
+        """
+        Deposit the coins of a settlement file: a wire batch of deposit
+        records (cf. wire.write_deposit_records) in the binary file or
+        bytes-like object (e.g., an mmap) src. The records are read in
+        chunks of chunk_records and verified in batches of batch_size,
+        and every chunk is recorded in the ledger and the merchant
+        accounts before the next one is read, so memory stays bounded by
+        the chunk size. Yields (status, record, result) for every record
+        in file order, where status is CREDITED, REJECTED or DOUBLE_SPENT,
+        record is a records.deposit_record, and result is what
+        deposit_coin_for_merchant would return, e.g., the double
+        spender's id. The file is read as far as the caller consumes.
+        """
+        for chunk in iter_deposit_record_chunks(src, chunk_records):
+            recs = [deposit_record(*rec) for rec in chunk]
+            valid = self.__verify_fresh_coins([(rec.coin, rec.coin_signature) for rec in recs],
+                                              pbr, batch_size)
+            for rec, is_valid in zip(recs, valid):
+                status, rslt = self.__deposit_verified_coin(rec.merchant_id, rec.coin,
+                                                            rec.coin_signature, is_valid, pbr)
+                yield status, rec, rslt
+
+    def __credit_coin(self, merchant_id, coin, coin_signature):
+        """
+        The valid coin is added to the set of spent coins and the
+        merchant's account is credited with 1 unit.
+        """
+        self.__spent_coins.put(coin, coin_signature)
+        self.credit_merchant_account(merchant_id, 1)
+        DEPOSIT_COUNTERS[CREDITED].inc()
+        trace(DEBUG, 'Bank deposited coin {} with signature {} to merchant account {}',
+              coin, coin_signature, merchant_id)
+        return merchant_id
+
+    def __reject_coin(self, merchant_id, coin, coin_signature):
+        DEPOSIT_COUNTERS[REJECTED].inc()
+        trace(WARNING, 'Bank failed to deposit coin {} with signature {} to merchant account {}',
+              coin, coin_signature, merchant_id)
+        return -1
+
+    def credit_merchant_account(self, merchant_id, num_credit_units=1):
+        """
+        credit the merchant account with coins deposited elsewhere,
+        e.g., by the deposit workers of a shardbank.sharded_bank.
+        """
+        with self.__account_locks(merchant_id):
+            self.__merchant_accounts.add(merchant_id, num_credit_units)
 
     def balance_for_merchant_account(self, merchant_account_id):
         return self.__merchant_accounts[merchant_account_id]
@@ -165,7 +530,8 @@ class bank(object):
         """
         The bank figures out the true identity u of the double spender.
         """
-        print('Bank initiated double spending fraud control')
+        DEPOSIT_COUNTERS[DOUBLE_SPENT].inc()
+        trace(WARNING, 'Bank initiated double spending fraud control')
         ### 1. Bank looks up the signature for the coin.
         ### your code here
 
@@ -175,20 +541,12 @@ class bank(object):
             return
 
 
-        ### 2. Bank extracts r1_prime, r2_prime, d_prime from that signature.
-        A, B, z, a, b, r = coin
-        r1, r2, d = spent_coin_sig
-        r1_prime, r2_prime, d_prime = coin_signature
-        
-        ### 3. Bank computes the congruence for the spender's id u on Slide 34
-        ###    puts it in double_spender_id and returns it.
-        ### your code here.
-        q = pbr.get_q()
-        r2_diff = r2 - r2_prime
-        mult_inv_r2_diff = mult_inv(r2_diff, q)
-        double_spender_id = ((r1 - r1_prime)*mult_inv_r2_diff) % q
-        
-        print('double spender id = {}'.format(double_spender_id))
+        ### 2. - 3. Bank computes the spender's id u on Slide 34.
+        double_spender_id = compute_double_spender_id(spent_coin_sig, coin_signature, pbr.get_q())
+        if double_spender_id is None:
+            trace(WARNING, 'Bank cannot identify the double spender, because d == d_prime')
+        else:
+            trace(WARNING, 'double spender id = {}', double_spender_id)
         return double_spender_id
 
         
@@ -0,0 +1,187 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#############################################################
+# module: bench.py
+# descrip: benchmarks of the phases of the coin lifecycle,
+# from the Authority's setup to double spending fraud control,
+# with machine-readable results.
+#
+# python bench.py --groups toy 512 1024 --coins 100 --out bench.json
+# python bench.py --groups toy --coins 100 --baseline bench.json
+#
+# bugs to vladimir kulyukin via canvas
+##############################################################
+
+import argparse
+import json
+import math
+import platform
+import sys
+import time
+from pubrepo import pubrepo
+from auth import auth
+from bank import bank
+from spender import spender
+from merchant import merchant
+from vendor import vendor
+from metrics import get_trace_level, set_trace_level, DEBUG, OFF
+
+### the phases in the order of the lifecycle.
+PHASES = ('authority_setup', 'bank_setup', 'account_creation', 'withdrawal',
+          'spend', 'deposit', 'double_spend_detection')
+
+### every spender account is created with 10 credit units.
+COINS_PER_SPENDER = 10
+
+def percentile(sorted_xs, pct):
+    """
+    the nearest-rank pct-th percentile of the sorted list sorted_xs.
+    """
+    if not sorted_xs:
+        return None
+    k = max(0, int(math.ceil(pct / 100.0 * len(sorted_xs))) - 1)
+    return sorted_xs[k]
+
+def summarize(latencies):
+    """
+    the count, total time, throughput, and latency percentiles in
+    milliseconds of the latencies in seconds.
+    """
+    xs = sorted(latencies)
+    total = sum(xs)
+    ms = lambda x: None if x is None else x * 1e3
+    return {'count': len(xs),
+            'total_s': total,
+            'ops_per_s': len(xs) / total if total > 0 else None,
+            'mean_ms': ms(total / len(xs)) if xs else None,
+            'p50_ms': ms(percentile(xs, 50)),
+            'p90_ms': ms(percentile(xs, 90)),
+            'p99_ms': ms(percentile(xs, 99)),
+            'max_ms': ms(xs[-1]) if xs else None}
+
+class _phase_timer(object):
+
+    def __init__(self):
+        self.latencies = {phase: [] for phase in PHASES}
+
+    def time(self, phase, fn, *args):
+        t0 = time.perf_counter()
+        rslt = fn(*args)
+        self.latencies[phase].append(time.perf_counter() - t0)
+        return rslt
+
+def run_benchmark(group='toy', num_coins=100, num_double_spends=10):
+    """
+    Run the lifecycle of num_coins coins in the group 'toy' (p == 227)
+    or in a generated group of group bits, and double spend
+    num_double_spends of them. Every spender withdraws up to 10 coins,
+    spends each at the merchant, and the merchant deposits it. Returns
+    the summary of every phase and the numbers of the deposited and
+    detected coins.
+    """
+    timer = _phase_timer()
+    nbits = None if group == 'toy' else int(group)
+    pbr = pubrepo()
+    timer.time('authority_setup', auth(nbits).init_p_q_g_g1_g2_H_H0, pbr)
+    bnk = bank()
+
+    def bank_setup():
+        bnk.create_h_h1_h2(pbr)
+        pbr.precompute_fixed_base_tables()
+    timer.time('bank_setup', bank_setup)
+    mrt, vdr = merchant(), vendor()
+    mrt.create_bank_account(bnk)
+    vdr.create_bank_account(bnk)
+    deposited = detected = 0
+    num_double_spends = min(num_double_spends, num_coins)
+    try:
+        for k in range(0, num_coins, COINS_PER_SPENDER):
+            spr = spender()
+            timer.time('account_creation', spr.create_bank_account, bnk, pbr)
+            n = min(COINS_PER_SPENDER, num_coins - k)
+            for i in range(n):
+                timer.time('withdrawal', spr.request_coin, bnk, pbr)
+                timer.time('spend', spr.spend_unspent_coin, mrt, pbr)
+                if timer.time('deposit', mrt.deposit_coin, bnk, pbr) == mrt.get_id():
+                    deposited += 1
+            ### the double spends are spread over the spenders.
+            for i in range(num_double_spends * (k + n) // num_coins - num_double_spends * k // num_coins):
+                spr.double_spend_coin(vdr, pbr)
+                rslt = timer.time('double_spend_detection', vdr.deposit_coin, bnk, pbr)
+                if rslt == spr.reveal_secret_id():
+                    detected += 1
+    finally:
+        bnk.close()
+    return {'group': group,
+            'p_bits': pbr.get_p().bit_length(),
+            'num_coins': num_coins,
+            'num_deposited': deposited,
+            'num_double_spends': num_double_spends,
+            'num_detected': detected,
+            'phases': {phase: summarize(timer.latencies[phase]) for phase in PHASES}}
+
+def run_benchmarks(groups, num_coins, num_double_spends, quiet=True):
+    """
+    run_benchmark for every group. With quiet, the parties' trace
+    events are disabled, so that they are not formatted or timed.
+    """
+    runs = []
+    level = get_trace_level()
+    if quiet:
+        set_trace_level(OFF)
+    try:
+        for group in groups:
+            runs.append(run_benchmark(group, num_coins, num_double_spends))
+    finally:
+        set_trace_level(level)
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'runs': runs}
+
+def compare(results, baseline):
+    """
+    (group, phase, baseline p50, p50, relative change) of every phase
+    of every group in both results and baseline.
+    """
+    base_runs = {run['group']: run for run in baseline['runs']}
+    rows = []
+    for run in results['runs']:
+        base = base_runs.get(run['group'])
+        if base is None:
+            continue
+        for phase in PHASES:
+            old, new = base['phases'][phase]['p50_ms'], run['phases'][phase]['p50_ms']
+            if old and new is not None:
+                rows.append((run['group'], phase, old, new, (new - old) / old))
+    return rows
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='benchmark the digital cash coin lifecycle')
+    ap.add_argument('--groups', nargs='+', default=['toy'],
+                    help="'toy' (p == 227) or bit lengths of generated groups, e.g., 512 3072")
+    ap.add_argument('--coins', type=int, default=100)
+    ap.add_argument('--double-spends', type=int, default=10)
+    ap.add_argument('--out', help='write the results as JSON to this file')
+    ap.add_argument('--baseline', help='compare the p50 latencies with these JSON results')
+    ap.add_argument('--verbose', action='store_true', help='trace every protocol step of the parties')
+    args = ap.parse_args(argv)
+    if args.verbose:
+        set_trace_level(DEBUG)
+    results = run_benchmarks(args.groups, args.coins, args.double_spends, quiet=not args.verbose)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for group, phase, old, new, change in compare(results, baseline):
+            print('{:>6} {:<24} p50 {:10.3f} ms -> {:10.3f} ms {:+7.1%}'.format(group, phase, old, new, change),
+                  file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#############################################################
+# module: bloom.py
+# descrip: Bloom filters over coin digests used by the bank
+# in front of its spent-coin ledger.
+# bugs to vladimir kulyukin via canvas
+##############################################################
+
+import math
+
+class bloom_filter(object):
+    """
+    A Bloom filter sized for capacity digests at the false positive
+    rate fp_rate. The k bit positions of a digest are derived from its
+    first 16 bytes by double hashing, so the digests must be uniformly
+    distributed (e.g., SHA-256 digests).
+    """
+
+    def __init__(self, capacity=1 << 20, fp_rate=0.001):
+        assert capacity > 0 and 0 < fp_rate < 1
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(fp_rate) / math.log(2)**2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.count = 0
+        self.__bits = bytearray((self.num_bits + 7) // 8)
+
+    def __positions(self, digest):
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        m = self.num_bits
+        return ((h1 + i*h2) % m for i in range(self.num_hashes))
+
+    def add(self, digest):
+        bits = self.__bits
+        for i in self.__positions(digest):
+            bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+    def __contains__(self, digest):
+        bits = self.__bits
+        for i in self.__positions(digest):
+            if not bits[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+    def is_full(self):
+        return self.count >= self.capacity
+
+    def estimated_fp_rate(self):
+        """
+        (1 - e^(-kn/m))^k for n added digests, m bits, and k hashes.
+        """
+        k, m = self.num_hashes, self.num_bits
+        return (1 - math.exp(-k * self.count / m)) ** k
+
+class scalable_bloom_filter(object):
+    """
+    A scalable Bloom filter: a list of Bloom filters, each growth times
+    larger than the previous one. The i-th filter has the false positive
+    rate fp_rate * (1 - tightening) * tightening^i, so the rates sum to
+    less than fp_rate, which bounds the compound rate however many
+    digests are added.
+    """
+
+    def __init__(self, capacity=1 << 20, fp_rate=0.001, growth=2, tightening=0.5):
+        self.growth = growth
+        self.tightening = tightening
+        self.__filters = [bloom_filter(capacity, fp_rate * (1 - tightening))]
+
+    def add(self, digest):
+        last = self.__filters[-1]
+        if last.is_full():
+            last = bloom_filter(last.capacity * self.growth, last.fp_rate * self.tightening)
+            self.__filters.append(last)
+        last.add(digest)
+
+    def __contains__(self, digest):
+        return any(digest in f for f in self.__filters)
+
+    @property
+    def count(self):
+        return sum(f.count for f in self.__filters)
+
+    @property
+    def num_bits(self):
+        return sum(f.num_bits for f in self.__filters)
+
+    def estimated_fp_rate(self):
+        rate = 1.0
+        for f in self.__filters:
+            rate *= 1 - f.estimated_fp_rate()
+        return 1 - rate
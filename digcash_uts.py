@@ -9,12 +9,49 @@
 
 import unittest
 import random
+import os
+import tempfile
+import asyncio
+import concurrent.futures
+import multiprocessing
+import itertools
+import json
 from pubrepo import pubrepo
 from auth import auth
-from bank import bank
+from bank import bank, CREDITED, REJECTED, DOUBLE_SPENT
 from spender import spender
 from merchant import merchant
 from vendor import vendor
+from ntutils import is_probable_prime, is_prime, ith_prime, prime_factors, euler_phi
+from grputils import fixed_base_table, fixed_base_table_cache, multi_exp
+from ledger import sqlite_ledger, memory_ledger, bloom_ledger
+from bloom import scalable_bloom_filter
+from shardbank import sharded_bank
+from netbank import serve_in_background, remote_bank, bank_client
+from records import coin_record, signature_record, deposit_record, account_table
+from wire import pack_coin, unpack_coin, pack_deposit_records, iter_deposit_records, wire_width
+from wire import write_deposit_records, coin_digest
+from nonces import nonce_pool
+from bench import run_benchmarks, compare, PHASES
+from loadgen import load_generator
+import metrics
+import pickle
+from params import attach_params
+import threading
+from timesrc import time_source, counter_allocator, wall_clock_allocator
+from merchsvc import merchant_service
+from metrics import registry, export_prometheus, export_json, set_trace_level, set_trace_sink
+
+def vendor_of_fresh_d(coin_with_signature, pbr, V=31):
+    """
+    a vendor V whose clock stamps the challenge d_prime of the coin so
+    that d_prime != d of its signature, so that a double spending of the
+    coin at the vendor always reveals the spender's id. In the toy group,
+    d_prime == d for about 1 in q stamps.
+    """
+    (A, B, _, _, _, _), (_, _, d) = coin_with_signature
+    t = next(t for t in itertools.count(1) if pbr.get_H0()((A, B, V, t)) != d)
+    return vendor(V, clock=lambda: t)
 
 class rsa_uts(unittest.TestCase):
 
@@ -76,6 +113,686 @@ class rsa_uts(unittest.TestCase):
         ### the double spent coint was not deposited.
         assert vdr.get_balance(bnk) == 0
     
+    def test_digcash_system_generated_group(self):
+        """
+        Test the coin lifecycle and double spending fraud control
+        in a generated 256-bit group, whose elements need the
+        fixed-width encoding of H and H0.
+        """
+        pbr = pubrepo()
+        auth(nbits=256).init_p_q_g_g1_g2_H_H0(pbr)
+        bnk = bank()
+        bnk.create_h_h1_h2(pbr)
+        spr = spender()
+        spr.create_bank_account(bnk, pbr)
+        mrt = merchant()
+        mrt.create_bank_account(bnk)
+        spr.request_coin(bnk, pbr)
+        spr.spend_unspent_coin(mrt, pbr)
+        coin, coin_signature = mrt.get_accepted_coins()[0]
+        assert mrt.deposit_coin(bnk, pbr) == mrt.get_id()
+        assert spr.get_balance(bnk) == 9 and mrt.get_balance(bnk) == 1
+        vdr = vendor()
+        vdr.create_bank_account(bnk)
+        spr.double_spend_coin(vdr, pbr)
+        assert vdr.deposit_coin(bnk, pbr) == spr.reveal_secret_id()
+        assert vdr.get_balance(bnk) == 0
+        ## the same coin w/ r shifted by q is not a new coin.
+        A, B, z, a, b, r = coin
+        shifted = (A, B, z, a, b, r + pbr.get_q())
+        assert bnk.deposit_coin_for_merchant(mrt.get_id(), shifted, coin_signature, pbr) == -1
+
+    def test_spender_wallet(self):
+        """
+        Test a wallet of coins withdrawn with blindings precomputed in a
+        process pool, and the double spending of a coin that is not the
+        latest one.
+        """
+        pbr = pubrepo()
+        auth().init_p_q_g_g1_g2_H_H0(pbr)
+        bnk = bank()
+        bnk.create_h_h1_h2(pbr)
+        spr = spender()
+        spr.create_bank_account(bnk, pbr)
+        mrt = merchant()
+        mrt.create_bank_account(bnk)
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('fork')) as ex:
+            spr.precompute_coins(3, ex, chunk_size=2)
+            for _ in range(4):
+                assert spr.request_coin(bnk, pbr) is not None
+        assert spr.get_num_unspent_coins() == 4 and spr.get_num_precomputed_coins() == 0
+        assert len(spr.request_coins(bnk, pbr, 2)) == 2 and spr.get_balance(bnk) == 4
+        assert spr.request_coins(bnk, pbr, 5) is None and spr.get_balance(bnk) == 4
+        ## the bank has seen the declined blindings, so none is kept.
+        assert spr.get_num_unspent_coins() == 6 and spr.get_num_precomputed_coins() == 0
+        for _ in range(3):
+            spr.spend_unspent_coin(mrt, pbr)
+            vdr = vendor_of_fresh_d(mrt.get_accepted_coins()[-1], pbr)
+            assert mrt.deposit_coin(bnk, pbr) == mrt.get_id()
+        vdr.create_bank_account(bnk)
+        spr.double_spend_coin(vdr, pbr)
+        assert vdr.deposit_coin(bnk, pbr) == spr.reveal_secret_id()
+        assert spr.get_num_unspent_coins() == 3 and spr.get_balance(bnk) == 4
+
+    def test_nonce_pool(self):
+        """
+        Test that the nonces are unique while in use, redeemed once,
+        and expire, and that a bank issues more than 11 coins.
+        """
+        pbr = pubrepo()
+        auth().init_p_q_g_g1_g2_H_H0(pbr)
+        now = [0.0]
+        pool = nonce_pool(fixed_base_table(pbr.get_g(), pbr.get_p(), pbr.get_q()), pbr.get_q(),
+                          ttl=10.0, background=False, clock=lambda: now[0])
+        pool.fill()
+        pairs = [pool.take() for _ in range(100)]
+        assert len(set(gw for _, gw in pairs)) == 100
+        assert all(pow(pbr.get_g(), w, pbr.get_p()) == gw for w, gw in pairs)
+        w, gw = pairs[0]
+        assert pool.redeem(gw) == w and pool.redeem(gw) is None
+        assert pool.redeem_all([pairs[1][1], pairs[1][1]]) is None
+        ## the toy group has 112 nonces, and one is kept unused.
+        pairs += [pool.take() for _ in range(12)]
+        with self.assertRaises(RuntimeError):
+            pool.take()
+        now[0] = 11.0
+        assert pool.redeem(pairs[1][1]) is None
+        assert pool.stats()['expired'] == 111 and pool.stats()['issued'] == 0
+        bnk = bank()
+        bnk.create_h_h1_h2(pbr)
+        spr = spender()
+        spr.create_bank_account(bnk, pbr)
+        for _ in range(3):
+            assert len(spr.request_coins(bnk, pbr, 5)) == 5
+            bnk.create_spender_account(spr._spender__I, pbr)
+        assert bnk.nonce_stats()['redeemed'] == 15
+        assert bnk.spender_table_stats()['misses'] == 1 and bnk.spender_table_stats()['hits'] == 14
+        ## after a key rotation, the gws are drawn from the new group.
+        pbr = pubrepo()
+        auth(nbits=64).init_p_q_g_g1_g2_H_H0(pbr)
+        bnk.create_h_h1_h2(pbr)
+        gw, _ = bnk.compute_gw_beta(spr._spender__I, pbr)
+        assert pow(gw, pbr.get_q(), pbr.get_p()) == 1 and bnk.nonce_stats()['redeemed'] == 0
+        bnk.close()
+
+    def test_auth_generated_params(self):
+        """
+        Test that the Authority generates a safe prime p = 2q+1
+        and generators g, g1, g2 of the order-q subgroup.
+        """
+        pbr = pubrepo()
+        aut = auth(nbits=128)
+        aut.init_p_q_g_g1_g2_H_H0(pbr)
+        p, q = pbr.get_p(), pbr.get_q()
+        assert p.bit_length() == 128 and p == 2*q + 1
+        assert is_probable_prime(p) and is_probable_prime(q)
+        for g in (pbr.get_g(), pbr.get_g1(), pbr.get_g2()):
+            assert g != 1 and pow(g, q, p) == 1
+
+    def test_ntutils_primes_and_factors(self):
+        """
+        Test Miller-Rabin, the prime cache, and Pollard's rho.
+        """
+        assert not is_prime(3825123056546413051)
+        assert is_prime(2**61 - 1) and is_prime(2**127 - 1)
+        assert ith_prime(1) == 2 and ith_prime(10000) == 104729
+        n = (2**61 - 1) * 1000003 * 1000003 * 12
+        assert prime_factors(n) == [2, 2, 3, 1000003, 1000003, 2**61 - 1]
+        assert euler_phi(226) == 112
+
+    def test_fixed_base_tables(self):
+        """
+        Test fixed-base exponentiation against pow().
+        """
+        pbr = pubrepo()
+        auth().init_p_q_g_g1_g2_H_H0(pbr)
+        p, g = pbr.get_p(), pbr.get_g()
+        for e in range(-300, 300):
+            assert pbr.fixed_base_exp(g, e) == pow(g, e, p)
+        tab = fixed_base_table(3, 2**127 - 1, nbits=127, window=5)
+        for _ in range(100):
+            e = random.getrandbits(127)
+            assert tab.exp(e) == pow(3, e, 2**127 - 1)
+        cache = fixed_base_table_cache(p, pbr.get_q(), capacity=2)
+        for key in (1, 2, 1, 3, 2):
+            assert cache.get(key, g * key).exp(5) == pow(g * key, 5, p)
+        assert cache.stats() == {'size': 2, 'capacity': 2, 'hits': 1, 'misses': 4,
+                                 'evictions': 2, 'hit_rate': 0.2}
+
+    def test_multi_exp(self):
+        """
+        Test simultaneous multi-exponentiation against pow().
+        """
+        p = 2**127 - 1
+        tab = fixed_base_table(3, p, nbits=127)
+        for _ in range(100):
+            b1, b2 = random.randrange(2, p), random.randrange(2, p)
+            e1, e2, e3 = (random.randrange(-2**127, 2**127) for _ in range(3))
+            expected = pow(b1, e1, p) * pow(b2, e2, p) * pow(3, abs(e3), p) % p
+            assert multi_exp(((b1, e1), (b2, e2), (tab, abs(e3))), p) == expected
+
+    def test_bank_batch_deposit(self):
+        """
+        Test the batch deposit of valid, forged, and repeated coins.
+        """
+        pbr = pubrepo()
+        auth().init_p_q_g_g1_g2_H_H0(pbr)
+        bnk = bank()
+        bnk.create_h_h1_h2(pbr)
+        spr = spender()
+        spr.create_bank_account(bnk, pbr)
+        mrt = merchant()
+        mrt.create_bank_account(bnk)
+        coins = []
+        for _ in range(8):
+            spr.request_coin(bnk, pbr)
+            spr.spend_unspent_coin(mrt, pbr)
+            coins.append(mrt.get_accepted_coins()[-1])
+        ## a forged signature and a coin w/ an element outside the subgroup.
+        r1, r2, d = coins[3][1]
+        coins[3] = (coins[3][0], (r1 + 1, r2, d))
+        A, B, z, a, b, r = coins[5][0]
+        coins[5] = ((pbr.get_p() - A, B, z, a, b, r), coins[5][1])
+        ## the same coin deposited twice.
+        coins.append(coins[0])
+        rslts = bnk.deposit_coins(mrt.get_id(), coins, pbr)
+        M = mrt.get_id()
+        assert rslts == [M, M, M, -1, M, -1, M, M, None]
+        assert mrt.get_balance(bnk) == 6
+        ## a signature w/ an element below 0 or not below q.
+        spr.request_coin(bnk, pbr)
+        spr.spend_unspent_coin(mrt, pbr)
+        coin, (r1, r2, d) = mrt.get_accepted_coins()[-1]
+        q = pbr.get_q()
+        assert bnk.deposit_coin_for_merchant(M, coin, (r1 - q, r2, d), pbr) == -1
+        assert bnk.deposit_coins(M, [(coin, (r1, r2, d + q))], pbr) == [-1]
+        assert bnk.deposit_coin_for_merchant(M, coin, (r1, r2, d), pbr) == M
+        assert mrt.get_balance(bnk) == 7
+
+    def test_ingest_settlement_file(self):
+        """
+        Test the chunked ingestion of a settlement file with valid,
+        forged, and repeated coins from two merchants.
+        """
+        pbr = pubrepo()
+        auth().init_p_q_g_g1_g2_H_H0(pbr)
+        bnk = bank()
+        bnk.create_h_h1_h2(pbr)
+        spr = spender()
+        spr.create_bank_account(bnk, pbr)
+        mrt, vdr = merchant(), vendor()
+        mrt.create_bank_account(bnk)
+        vdr.create_bank_account(bnk)
+        recs = []
+        for i in range(5):
+            spr.request_coin(bnk, pbr)
+            shop = (mrt, vdr)[i % 2]
+            spr.spend_unspent_coin(shop, pbr)
+            recs.append((shop.get_id(),) + shop.get_accepted_coins()[-1])
+        r1, r2, d = recs[1][2]
+        recs[1] = (recs[1][0], recs[1][1], (r1, r2 + 1, d))
+        recs.append(recs[0])
+        with tempfile.TemporaryFile() as f:
+            assert write_deposit_records(f, iter(recs), wire_width(pbr)) == 6
+            f.seek(0)
+            out = list(bnk.ingest_settlement_file(f, pbr, chunk_records=2))
+        assert [status for status, _, _ in out] == [CREDITED, REJECTED, CREDITED,
+                                                    CREDITED, CREDITED, DOUBLE_SPENT]
+        assert [rec for _, rec, _ in out] == recs
+        assert out[0][2] == mrt.get_id() and out[1][2] == -1
+        assert mrt.get_balance(bnk) == 3 and vdr.get_balance(bnk) == 1
+
+    def test_sqlite_ledger(self):
+        """
+        Test that the spent coins survive a restart of the ledger.
+        """
+        coin, coin_signature = (2**300, 5, 7, 11, 13, 17), (-3, 2**200, 19)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'spent.db')
+            ldg = sqlite_ledger(path)
+            assert coin not in ldg and ldg.get(coin) is None
+            ldg.put(coin, coin_signature)
+            ldg.close()
+            ldg = sqlite_ledger(path)
+            assert coin in ldg and len(ldg) == 1
+            assert ldg.get(coin) == coin_signature
+            assert list(ldg.digests()) == [coin_digest(coin)]
+            ldg.close()
+
+    def test_wire_format(self):
+        """
+        Test the round trips of coins and deposit records through the
+        binary wire format.
+        """
+        pbr = pubrepo()
+        auth().init_p_q_g_g1_g2_H_H0(pbr)
+        assert wire_width(pbr) == 8
+        width = 32
+        coin = (2**255, 5, 7, 11, 13, 17)
+        buf = bytearray(3) + pack_coin(coin, width)
+        assert len(buf) == 3 + 6*width
+        assert unpack_coin(memoryview(buf), width, 3) == coin
+        recs = [(29, coin, (1, 2, 3)), (31, tuple(range(6)), (2**200, 0, 1))]
+        batch = pack_deposit_records(recs, width)
+        assert list(iter_deposit_records(batch)) == recs
+        with self.assertRaises(ValueError):
+            list(iter_deposit_records(batch[:-1]))
+        with self.assertRaises(ValueError):
+            pack_coin((2**256,) + coin[1:], width)
+
+    def test_records(self):
+        """
+        Test that the records behave like the tuples they replace,
+        and the account table like a dict.
+        """
+        coin = coin_record(2**300, 5, 7, 11, 13, 17)
+        A, B, z, a, b, r = coin
+        assert coin == (A, B, z, a, b, r) and hash(coin) == hash(tuple(coin))
+        assert coin[:2] == (A, B) and coin.digest() == coin_digest(tuple(coin))
+        assert not hasattr(coin, '__dict__') and coin[-1] == r
+        with self.assertRaises(AttributeError):
+            coin.r = r + 1
+        assert coin_record.unpack(coin.pack(40), 40) == coin
+        rec = deposit_record(29, tuple(coin), (1, 2, 3))
+        assert rec.coin == coin and rec.coin_signature == signature_record(1, 2, 3)
+        accts = account_table()
+        accts[29] = 0
+        accts.add(29, 2**40)
+        accts[31] = 10
+        accts[31] -= 1
+        assert dict(accts.items()) == {29: 2**40, 31: 9} and len(accts) == 2
+        with self.assertRaises(KeyError):
+            accts[3]
+
+    def test_bloom_ledger(self):
+        """
+        Test that the Bloom filter has no false negatives, is rebuilt
+        from the ledger, and keeps its false positive rate in check.
+        """
+        ldg = bloom_ledger(memory_ledger(), scalable_bloom_filter(capacity=500, fp_rate=0.01))
+        spent = [tuple(random.getrandbits(64) for _ in range(6)) for _ in range(2000)]
+        ldg.put_many((coin, (1, 2, 3)) for coin in spent)
+        fresh = [tuple(random.getrandbits(64) for _ in range(6)) for _ in range(5000)]
+        assert all(coin in ldg for coin in spent)
+        assert not any(coin in ldg for coin in fresh)
+        metrics = ldg.metrics()
+        assert metrics['observed_fp_rate'] < 0.03
+        assert metrics['definite_misses'] + metrics['false_positives'] == len(fresh)
+        rebuilt = bloom_ledger(ldg)
+        assert all(coin in rebuilt for coin in spent)
+
+    def test_sharded_bank(self):
+        """
+        Test deposits and double spending fraud control with
+        the spent coins sharded across 2 worker processes.
+        """
+        pbr = pubrepo()
+        auth().init_p_q_g_g1_g2_H_H0(pbr)
+        bnk = sharded_bank(num_shards=2)
+        try:
+            bnk.create_h_h1_h2(pbr)
+            spr = spender()
+            spr.create_bank_account(bnk, pbr)
+            mrt = merchant()
+            mrt.create_bank_account(bnk)
+            M = mrt.get_id()
+            spr.request_coin(bnk, pbr)
+            spr.spend_unspent_coin(mrt, pbr)
+            vdr = vendor_of_fresh_d(mrt.get_accepted_coins()[-1], pbr)
+            vdr.create_bank_account(bnk)
+            assert mrt.deposit_coin(bnk, pbr) == M
+            spr.double_spend_coin(vdr, pbr)
+            assert vdr.deposit_coin(bnk, pbr) == spr.reveal_secret_id()
+            assert vdr.get_balance(bnk) == 0
+            coins = []
+            for _ in range(3):
+                spr.request_coin(bnk, pbr)
+                spr.spend_unspent_coin(mrt, pbr)
+                coins.append(mrt.get_accepted_coins()[-1])
+            assert bnk.deposit_coins(M, coins + coins[:1], pbr) == [M, M, M, None]
+            assert mrt.get_balance(bnk) == 4 and spr.get_balance(bnk) == 6
+            ### the spent coins and the pre-verified deposits of the
+            ### verifiers of a bank server go to the shards.
+            assert all(bnk.is_coin_spent(coin) for coin, _ in coins)
+            spr.request_coin(bnk, pbr)
+            spr.spend_unspent_coin(mrt, pbr)
+            fresh = mrt.get_accepted_coins()[-1]
+            assert not bnk.is_coin_spent(fresh[0])
+            assert bnk.deposit_verified_coins(M, [fresh], [False], pbr) == [-1]
+            assert bnk.deposit_verified_coins(M, [fresh], [True], pbr) == [M]
+            assert bnk.is_coin_spent(fresh[0]) and mrt.get_balance(bnk) == 5
+            ### a snapshot of the workers' group is accepted, another group is not.
+            spr.request_coin(bnk, pbr)
+            spr.spend_unspent_coin(mrt, pbr)
+            assert bnk.deposit_coins(M, mrt.get_accepted_coins()[-1:], pbr.snapshot()) == [M]
+            other = pubrepo()
+            auth().init_p_q_g_g1_g2_H_H0(other)
+            other.set_h(pbr.get_h() * pbr.get_g() % pbr.get_p())
+            other.set_h1(pbr.get_h1())
+            other.set_h2(pbr.get_h2())
+            try:
+                bnk.deposit_coins(M, coins, other)
+                assert False, 'the shards deposited coins in another group'
+            except ValueError:
+                pass
+        finally:
+            bnk.close()
+
+    def test_netbank_loopback(self):
+        """
+        Test the withdrawal, deposit, and double spending fraud control
+        over a loopback TCP connection to the bank server, and
+        pipelined requests on a pool of connections.
+        """
+        pbr = pubrepo()
+        auth().init_p_q_g_g1_g2_H_H0(pbr)
+        bnk = bank()
+        bnk.create_h_h1_h2(pbr)
+        (host, port), stop = serve_in_background(bnk, pbr, num_verifiers=1)
+        try:
+            rbnk = remote_bank(host, port)
+            spr = spender()
+            spr.create_bank_account(rbnk, pbr)
+            mrt = merchant()
+            mrt.create_bank_account(rbnk)
+            spr.request_coin(rbnk, pbr)
+            spr.spend_unspent_coin(mrt, pbr)
+            vdr = vendor_of_fresh_d(mrt.get_accepted_coins()[-1], pbr)
+            assert mrt.deposit_coin(rbnk, pbr) == mrt.get_id()
+            assert spr.get_balance(rbnk) == 9 and mrt.get_balance(rbnk) == 1
+            assert len(spr.request_coins(rbnk, pbr, 2)) == 2 and spr.get_balance(rbnk) == 7
+            vdr.create_bank_account(rbnk)
+            spr.double_spend_coin(vdr, pbr)
+            assert vdr.deposit_coin(rbnk, pbr) == spr.reveal_secret_id()
+            assert vdr.get_balance(rbnk) == 0
+            assert rbnk.deposit_coin_batch([(mrt.get_id(), (1, 2, 3, 4, 5, 6), (7, 8, 9))], pbr) == [-1]
+            rbnk.close()
+
+            async def pipelined_balances():
+                client = bank_client(host, port, pool_size=2)
+                await client.connect()
+                rslts = await asyncio.gather(*(client.call('balance_for_merchant_account', mrt.get_id())
+                                               for _ in range(50)))
+                await client.close()
+                return rslts
+            assert asyncio.run(pipelined_balances()) == [1] * 50
+
+            async def malformed_frames():
+                reader, writer = await asyncio.open_connection(host, port)
+                writer.write(b'not json\n{"op": "compute_c1"}\n{"id": 7, "op": "no_such_op", "args": []}\n')
+                resps = [json.loads(await reader.readline()) for _ in range(3)]
+                writer.close()
+                return sorted((resp['id'] or 0, 'error' in resp) for resp in resps)
+            assert asyncio.run(malformed_frames()) == [(0, True), (0, True), (7, True)]
+        finally:
+            stop()
+
+    def test_bench(self):
+        """
+        Test that the benchmark covers every phase of the lifecycle.
+        """
+        results = run_benchmarks(['toy'], 12, 2)
+        run = results['runs'][0]
+        assert run['num_deposited'] == 12 and run['p_bits'] == 8
+        assert [run['phases'][phase]['count'] for phase in PHASES] == [1, 1, 2, 12, 12, 12, 2]
+        assert len(compare(results, results)) == len(PHASES)
+
+    def test_load_generator(self):
+        """
+        Test that the simulated deposits add up in the merchant accounts
+        and that every double spent coin is caught.
+        """
+        pbr = pubrepo()
+        auth().init_p_q_g_g1_g2_H_H0(pbr)
+        bnk = bank()
+        bnk.create_h_h1_h2(pbr)
+        gen = load_generator(pbr, 20, 4, double_spend_rate=0.2, seed=7)
+        rslt = gen.run(bnk, 300)
+        bnk.close()
+        outcomes = rslt['outcomes']
+        assert rslt['num_ops'] == 300 and outcomes.get('rejected', 0) == 0
+        assert outcomes['credited'] + outcomes['double_spent'] == rslt['ops']['deposit']['count']
+        assert outcomes['double_spent'] <= rslt['ops']['double_spend']['count']
+        assert sum(mrt.get_balance(bnk) for mrt in gen.merchants) == outcomes['credited']
+
+    def test_metrics(self):
+        """
+        Test that disabled trace events are not formatted and that the
+        phases of a deposit show up in the exporters.
+        """
+        class unformattable(object):
+            def __format__(self, spec):
+                raise AssertionError('formatted a disabled event')
+        events = []
+        level = metrics.get_trace_level()
+        set_trace_sink(lambda level, msg: events.append((level, msg)))
+        try:
+            assert level == metrics.WARNING
+            metrics.trace(metrics.DEBUG, 'coin {}', unformattable())
+            metrics.trace(metrics.WARNING, 'coin {}', 7)
+            set_trace_level(metrics.DEBUG)
+            metrics.trace(metrics.DEBUG, 'coin {}', 8)
+            assert events == [(metrics.WARNING, 'coin 7'), (metrics.DEBUG, 'coin 8')]
+        finally:
+            set_trace_sink(metrics._print_event)
+            set_trace_level(level)
+        reg = registry()
+        reg.counter('deposits_total', 'deposits', outcome='credited').inc(3)
+        hist = reg.histogram('phase_seconds', 'latency', buckets=(0.001, 0.01), phase='deposit')
+        for x in (0.0005, 0.005, 0.005, 0.5):
+            hist.observe(x)
+        text = export_prometheus(reg)
+        assert 'deposits_total{outcome="credited"} 3' in text
+        assert 'phase_seconds_bucket{phase="deposit",le="0.01"} 3' in text
+        assert 'phase_seconds_count{phase="deposit"} 4' in text
+        assert export_json(reg)['histograms'][0]['p50'] == 0.01
+        pbr = pubrepo()
+        auth().init_p_q_g_g1_g2_H_H0(pbr)
+        bnk = bank()
+        bnk.create_h_h1_h2(pbr)
+        deposits = metrics.counter_for('digcash_bank_deposits_total', outcome='credited')
+        phase = metrics.histogram_for('digcash_phase_seconds', phase='bank.deposit_coin_for_merchant')
+        num_deposits, num_timed = deposits.value, phase.count
+        spr, mrt = spender(), merchant()
+        spr.create_bank_account(bnk, pbr)
+        mrt.create_bank_account(bnk)
+        spr.request_coin(bnk, pbr)
+        spr.spend_unspent_coin(mrt, pbr)
+        assert mrt.deposit_coin(bnk, pbr) == mrt.get_id()
+        bnk.close()
+        assert deposits.value == num_deposits + 1 and phase.count == num_timed + 1
+
+    def test_params_snapshot(self):
+        """
+        Test that a frozen snapshot and its copy attached from shared
+        memory serve the coin lifecycle like the public repo.
+        """
+        pbr = pubrepo()
+        auth().init_p_q_g_g1_g2_H_H0(pbr)
+        bnk = bank()
+        bnk.create_h_h1_h2(pbr)
+        prm = pbr.snapshot()
+        try:
+            prm.p = 7
+            assert False, 'params are not frozen'
+        except AttributeError:
+            pass
+        shared = prm.share()
+        try:
+            attached = attach_params(shared.name)
+            assert (attached.p, attached.q, attached.h2) == (prm.p, prm.q, prm.h2)
+            assert len(pickle.dumps(attached)) < 200
+            for e in range(-5, 300):
+                assert attached.fixed_base_exp(prm.g1, e) == pbr.fixed_base_exp(prm.g1, e)
+            spr, mrt = spender(), merchant()
+            spr.create_bank_account(bnk, prm)
+            mrt.create_bank_account(bnk)
+            spr.request_coin(bnk, prm)
+            spr.spend_unspent_coin(mrt, attached)
+            assert mrt.deposit_coin(bnk, attached) == mrt.get_id()
+            ## the time stamps of a forked process that attaches to the
+            ## block, of the parent, and of the attached snapshot differ.
+            ctx = multiprocessing.get_context('fork')
+            parent_conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(target=lambda: child_conn.send([attach_params(shared.name).get_time()
+                                                               for _ in range(3)]))
+            proc.start()
+            stamps = parent_conn.recv() + [shared.params.get_time() for _ in range(3)] + [attached.get_time()]
+            proc.join()
+            assert len(set(stamps)) == 7
+            del attached
+        finally:
+            shared.close()
+            shared.unlink()
+            bnk.close()
+
+    def test_time_source(self):
+        """
+        Test that the leased time stamps are unique across threads and
+        forked processes and that the wall clock stamps never go back.
+        """
+        src = time_source(counter_allocator(block_size=16, shared=True))
+        stamps = [[] for _ in range(4)]
+
+        def take(k):
+            stamps[k].extend(src() for _ in range(100))
+        threads = [threading.Thread(target=take, args=(k,)) for k in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert all(ts == sorted(ts) for ts in stamps)
+        ### the forking thread and a cursor have partly used blocks,
+        ### which the child must not hand out again.
+        cur = src.cursor()
+        stamps.append([src() for _ in range(3)] + [cur() for _ in range(3)])
+        ctx = multiprocessing.get_context('fork')
+        parent_conn, child_conn = ctx.Pipe()
+        proc = ctx.Process(target=lambda: child_conn.send([src() for _ in range(100)] +
+                                                          [cur() for _ in range(10)]))
+        proc.start()
+        child = parent_conn.recv()
+        proc.join()
+        stamps = sum(stamps, []) + child + [src() for _ in range(100)] + [cur() for _ in range(10)]
+        assert len(set(stamps)) == len(stamps) == 626
+        now = [10**9]
+        src = time_source(wall_clock_allocator(block_size=2, node_id=3, node_bits=2, clock=lambda: now[0]))
+        assert [src() for _ in range(3)] == [4*10**6 + 3, 4*10**6 + 7, 4*10**6 + 11]
+        now[0] = 0
+        assert src() == 4*10**6 + 15
+        pbr = pubrepo()
+        auth().init_p_q_g_g1_g2_H_H0(pbr)
+        bnk = bank()
+        bnk.create_h_h1_h2(pbr)
+        assert [pbr.get_time() for _ in range(3)] == [1, 2, 3]
+        spr, mrt = spender(), merchant(clock=time_source().cursor())
+        spr.create_bank_account(bnk, pbr)
+        mrt.create_bank_account(bnk)
+        spr.request_coin(bnk, pbr)
+        spr.spend_unspent_coin(mrt, pbr)
+        assert mrt.deposit_coin(bnk, pbr) == mrt.get_id()
+        bnk.close()
+
+    def test_concurrent_bank(self):
+        """
+        Test that threads withdraw no more coins than the account has
+        credits and that a coin deposited by many threads at once is
+        credited once, with a ledger that every thread connects to.
+        """
+        pbr = pubrepo()
+        auth().init_p_q_g_g1_g2_H_H0(pbr)
+        tmp = tempfile.TemporaryDirectory()
+        ldg = bloom_ledger(sqlite_ledger(os.path.join(tmp.name, 'spent.db')))
+        bnk = bank(ldg, num_lock_stripes=4)
+        bnk.create_h_h1_h2(pbr)
+        spr = spender()
+        spr.create_bank_account(bnk, pbr)
+        mrts = [merchant(100 + k) for k in range(8)]
+        for mrt in mrts:
+            mrt.create_bank_account(bnk)
+        barrier = threading.Barrier(8)
+        coins = [None] * 16
+
+        def withdraw(k):
+            barrier.wait()
+            coins[2*k:2*k+2] = [spr.request_coin(bnk, pbr) for _ in range(2)]
+        threads = [threading.Thread(target=withdraw, args=(k,)) for k in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert sum(coin is not None for coin in coins) == 10 and spr.get_balance(bnk) == 0
+        accepted = []
+
+        class recording_merchant(object):
+            get_id, compute_d = mrts[0].get_id, mrts[0].compute_d
+
+            def accept_coin(self, *args):
+                accepted.append(args)
+                mrts[0].accept_coin(*args)
+        spr.spend_unspent_coin(recording_merchant(), pbr)
+        for mrt in mrts[1:]:
+            mrt.accept_coin(*accepted[0])
+        rslts = [None] * 8
+
+        def deposit(k):
+            barrier.wait()
+            rslts[k] = mrts[k].deposit_coin(bnk, pbr)
+        threads = [threading.Thread(target=deposit, args=(k,)) for k in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        bnk.close()
+        ldg.close()
+        tmp.cleanup()
+        credited = [k for k in range(8) if rslts[k] == mrts[k].get_id()]
+        assert len(credited) == 1 and sum(mrt.get_balance(bnk) for mrt in mrts) == 1
+
+    def test_merchant_service(self):
+        """
+        Test that terminals sharing a pool of verifiers queue the
+        accepted coins, refuse forged ones, and report their throughput.
+        """
+        pbr = pubrepo()
+        auth().init_p_q_g_g1_g2_H_H0(pbr)
+        bnk = bank()
+        bnk.create_h_h1_h2(pbr)
+        svc = merchant_service(pbr.snapshot(), num_workers=2, chunk_size=2)
+        terminals = [merchant(service=svc, terminal='till-{}'.format(k)) for k in range(2)]
+        terminals[0].create_bank_account(bnk)
+        spenders = [spender(u) for u in (5, 6)]
+        for spr in spenders:
+            spr.create_bank_account(bnk, pbr)
+
+        def sell(k):
+            for _ in range(3):
+                spenders[k].request_coin(bnk, pbr)
+                spenders[k].spend_unspent_coin(terminals[k], pbr)
+        threads = [threading.Thread(target=sell, args=(k,)) for k in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        coins = terminals[0].get_accepted_coins() + terminals[1].get_accepted_coins()
+        assert [terminal.get_num_accepted_coins() for terminal in terminals] == [3, 3]
+        (r1, r2, d) = coins[0][1]
+        assert terminals[0].accept_coins([(coins[0][0], (r1 + 1, r2, d))] + coins[3:5], pbr) == [False, True, True]
+        assert terminals[0].compute_ds([coins[1][0], (1, 1, 1, 1, 1, 0)], pbr)[1] is None
+        stats = svc.stats()
+        other = pubrepo()
+        auth(nbits=64).init_p_q_g_g1_g2_H_H0(other)
+        with self.assertRaises(ValueError):
+            terminals[0].compute_ds([coins[1][0]], other)
+        svc.close()
+        assert stats['till-0']['acceptable'] == 5 and stats['till-0']['unacceptable'] == 1
+        assert stats['till-1']['valid'] == 3 and stats['till-1']['coins_per_s'] > 0
+        M = terminals[0].get_id()
+        assert terminals[0].deposit_coins(bnk, pbr) == [M, M, M, M, M]
+        ## coins[3] was queued at both terminals and is credited once.
+        assert terminals[1].deposit_coin(bnk, pbr) is None and terminals[0].get_balance(bnk) == 5
+        bnk.close()
+
     def runTest(self):
         pass
 
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#############################################################
+# module: grputils.py
+# descrip: group arithmetic in Z^{*}_{p} shared by the Authority,
+# the Bank, the Spender, and the Merchants.
+# All operations reduce mod p at every step so that no
+# intermediate result grows beyond 2*log2(p) bits.
+# bugs to vladimir kulyukin via canvas
+##############################################################
+
+import collections
+import threading
+from ntutils import jacobi
+
+def element_width(p):
+    """
+    the number of bytes in the fixed-width encoding of the elements
+    of Z_p, but at least 8 so that ids and time stamps fit as well.
+    """
+    return max(8, (p.bit_length() + 7) // 8)
+
+def encode_elements(xs, width):
+    """
+    the concatenation of the width-byte big-endian encodings of the
+    integers in xs. Raises ValueError if some x is outside [0, 2^(8*width)).
+    """
+    try:
+        return b''.join(x.to_bytes(width, 'big') for x in xs)
+    except OverflowError:
+        raise ValueError('integer does not fit in {} bytes'.format(width))
+
+def mod_exp(b, e, p):
+    """
+    b^e (mod p) computed by square-and-multiply in the group.
+    A negative e means (b^{-1})^{|e|} (mod p).
+    """
+    return pow(b, e, p)
+
+def mod_mult(a, b, p):
+    """
+    a*b (mod p).
+    """
+    return (a * b) % p
+
+def mod_prod(nums, p):
+    """
+    the product of all numbers in nums (mod p).
+    """
+    rslt = 1
+    for n in nums:
+        rslt = (rslt * n) % p
+    return rslt
+
+def mod_inv(a, p):
+    """
+    multiplicative inverse of a in Z^{*}_{p}. Raises ValueError
+    if a is not invertible mod p.
+    """
+    return pow(a, -1, p)
+
+class fixed_base_table(object):
+    """
+    Windowed fixed-base table for b^e (mod p). Row i holds
+    b^(j*2^(w*i)) (mod p) for 0 <= j < 2^w, so b^e takes one
+    multiplication per nonzero w-bit digit of e and no squarings.
+    If order is given, b^order == 1 (mod p) and e is reduced mod order.
+    """
+
+    __slots__ = ('base', 'p', 'order', 'window', 'nbits', 'rows')
+
+    def __init__(self, base, p, order=None, nbits=None, window=4):
+        """
+        nbits is the largest exponent bit length served by the table.
+        It defaults to the bit length of order, or of p if order is None.
+        """
+        self.base = base % p
+        self.p = p
+        self.order = order
+        self.window = window
+        if nbits is None:
+            nbits = (order if order is not None else p).bit_length()
+        self.nbits = nbits
+        self.rows = []
+        bi = self.base
+        for i in range(-(-nbits // window)):
+            row = [1, bi]
+            for j in range(2, 1 << window):
+                row.append((row[-1] * bi) % p)
+            self.rows.append(row)
+            bi = (row[-1] * bi) % p
+
+    def exp(self, e):
+        """
+        base^e (mod p). Exponents outside the table fall back to mod_exp().
+        """
+        if self.order is not None:
+            e %= self.order
+        if e < 0 or e.bit_length() > self.nbits:
+            return pow(self.base, e, self.p)
+        p = self.p
+        w = self.window
+        mask = (1 << w) - 1
+        rslt = 1
+        for row in self.rows:
+            if not e:
+                break
+            d = e & mask
+            if d:
+                rslt = (rslt * row[d]) % p
+            e >>= w
+        return rslt
+
+    @classmethod
+    def of_rows(cls, base, p, order, nbits, window, rows):
+        """
+        the table with the precomputed rows, e.g., rows that read their
+        entries from shared memory, so nothing is recomputed.
+        """
+        tab = cls.__new__(cls)
+        tab.base, tab.p, tab.order, tab.nbits, tab.window = base % p, p, order, nbits, window
+        tab.rows = rows
+        return tab
+
+class fixed_base_table_cache(object):
+    """
+    An LRU cache of at most capacity fixed-base tables mod p for bases
+    of order q, keyed by the caller's key (e.g., the bank keys the table
+    of I*g2 by the spender's I). The least recently used table is
+    evicted when a new one does not fit. The cache is thread-safe;
+    tables are built outside its lock.
+    """
+
+    def __init__(self, p, q, capacity=1024, window=4):
+        self.p = p
+        self.q = q
+        self.capacity = capacity
+        self.window = window
+        self.__tables = collections.OrderedDict()
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__tables)
+
+    def get(self, key, base):
+        """
+        the table of base for key, built on a miss.
+        """
+        with self.__lock:
+            tab = self.__tables.get(key)
+            if tab is not None and tab.base == base % self.p:
+                self.__hits += 1
+                self.__tables.move_to_end(key)
+                return tab
+            self.__misses += 1
+        tab = fixed_base_table(base, self.p, self.q, window=self.window)
+        with self.__lock:
+            self.__tables[key] = tab
+            self.__tables.move_to_end(key)
+            while len(self.__tables) > self.capacity:
+                self.__tables.popitem(last=False)
+                self.__evictions += 1
+        return tab
+
+    def stats(self):
+        with self.__lock:
+            lookups = self.__hits + self.__misses
+            return {'size': len(self.__tables), 'capacity': self.capacity,
+                    'hits': self.__hits, 'misses': self.__misses, 'evictions': self.__evictions,
+                    'hit_rate': self.__hits / lookups if lookups else 0.0}
+
+def multi_exp(pairs, p, window=4):
+    """
+    prod_i b_i^e_i (mod p) for the (b_i, e_i) in pairs. The variable
+    bases are exponentiated simultaneously with Straus' method: one
+    shared chain of squarings and one multiplication per nonzero
+    w-bit digit of each e_i. A b_i that is a fixed_base_table is
+    exponentiated with its table. A negative e_i means (b_i^{-1})^{|e_i|}.
+    Raises ValueError if such a b_i is not invertible mod p.
+    """
+    rslt = 1
+    var = []
+    for b, e in pairs:
+        if isinstance(b, fixed_base_table):
+            rslt = (rslt * b.exp(e)) % p
+        elif e < 0:
+            var.append((mod_inv(b, p), -e))
+        elif e > 0:
+            var.append((b % p, e))
+    if not var:
+        return rslt % p
+    if len(var) == 1:
+        return (rslt * pow(var[0][0], var[0][1], p)) % p
+    w = window
+    mask = (1 << w) - 1
+    ### the rows are sorted by exponent length, longest first, so
+    ### that short (e.g., batching) exponents drop out of the scan
+    ### of the high windows.
+    var.sort(key=lambda be: be[1].bit_length(), reverse=True)
+    rows = []
+    for b, e in var:
+        row = [1, b]
+        for j in range(2, min(1 << w, e + 1)):
+            row.append((row[-1] * b) % p)
+        rows.append((row, e, e.bit_length()))
+    nbits = rows[0][2]
+    acc = 1
+    for shift in range(((nbits - 1) // w) * w, -1, -w):
+        if acc != 1:
+            for _ in range(w):
+                acc = (acc * acc) % p
+        for row, e, ebits in rows:
+            if ebits <= shift:
+                break
+            d = (e >> shift) & mask
+            if d:
+                acc = (acc * row[d]) % p
+    return (rslt * acc) % p
+
+def is_subgroup_member(x, p):
+    """
+    Is x in the subgroup of order q of Z^{*}_{p} for a safe prime
+    p = 2q+1? That subgroup consists of the quadratic residues, so
+    the test is one Jacobi symbol and no exponentiation.
+    """
+    return 0 < x < p and jacobi(x, p) == 1
+
+def is_multi_exp_equal(pairs, rhs, p):
+    """
+    Does prod_i b_i^e_i == rhs (mod p)? The answer is False if some b_i
+    with a negative e_i is not invertible mod p.
+    """
+    try:
+        return multi_exp(pairs, p) == rhs % p
+    except ValueError:
+        return False
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#############################################################
+# module: ledger.py
+# descrip: spent-coin ledgers of the bank. A ledger maps
+# the digest of each deposited coin to the coin's signature
+# (r1, r2, d), which the bank needs for double spending
+# fraud control (cf. Slide 34).
+# bugs to vladimir kulyukin via canvas
+##############################################################
+
+import sqlite3
+import threading
+from bloom import scalable_bloom_filter
+from grputils import element_width
+from wire import int_to_bytes, int_from_bytes, pack_signature
+from records import coin_id, signature_record
+
+def _pack_signature(coin_signature):
+    """
+    the coin signature in the wire format, with the width of its largest
+    element, so that unpack_signature() recovers it from len(b) // 3.
+    """
+    width = element_width(max(coin_signature) + 1)
+    return pack_signature(coin_signature, width)
+
+def _unpack_signature(b):
+    return signature_record.unpack(b, len(b) // 3)
+
+class memory_ledger(object):
+    """
+    An in-memory ledger that maps coin digests to coin signatures.
+    The signatures are kept in the wire format, which takes about half
+    the memory of a tuple of three ints. Every call is a single dict
+    operation, so the ledger is safe to call from many threads.
+    """
+
+    def __init__(self):
+        self.__sigs = {}
+
+    def __contains__(self, coin):
+        return coin_id(coin) in self.__sigs
+
+    def __len__(self):
+        return len(self.__sigs)
+
+    def get(self, coin):
+        """
+        the signature of the spent coin or None if the coin is unspent.
+        """
+        b = self.__sigs.get(coin_id(coin))
+        return None if b is None else _unpack_signature(b)
+
+    def put(self, coin, coin_signature):
+        self.__sigs[coin_id(coin)] = _pack_signature(coin_signature)
+
+    def put_many(self, coins_with_signatures):
+        for coin, coin_signature in coins_with_signatures:
+            self.put(coin, coin_signature)
+
+    def digests(self):
+        """
+        iterate over the digests of all spent coins.
+        """
+        return iter(self.__sigs)
+
+    def close(self):
+        pass
+
+class sqlite_ledger(object):
+    """
+    An on-disk ledger in a SQLite database at path. The coin digest is
+    the primary key of a WITHOUT ROWID table, so a lookup is a single
+    B-tree search, and opening an existing ledger reads nothing up front.
+    Every put is committed before it returns. Every thread has its own
+    connection to the database, whose write-ahead log lets the threads
+    read while another one writes.
+    """
+
+    def __init__(self, path):
+        self.__path = path
+        self.__local = threading.local()
+        ### all connections, so that close() closes them.
+        self.__dbs = []
+        self.__dbs_lock = threading.Lock()
+        db = self.__db()
+        db.execute('CREATE TABLE IF NOT EXISTS spent_coins ('
+                   'digest BLOB PRIMARY KEY, r1 BLOB, r2 BLOB, d BLOB) WITHOUT ROWID')
+        db.commit()
+
+    def __db(self):
+        """
+        the connection of the calling thread.
+        """
+        db = getattr(self.__local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.__path, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.__local.db = db
+            with self.__dbs_lock:
+                self.__dbs.append(db)
+        return db
+
+    def __contains__(self, coin):
+        cur = self.__db().execute('SELECT 1 FROM spent_coins WHERE digest = ?', (coin_id(coin),))
+        return cur.fetchone() is not None
+
+    def __len__(self):
+        return self.__db().execute('SELECT COUNT(*) FROM spent_coins').fetchone()[0]
+
+    def get(self, coin):
+        """
+        the signature of the spent coin or None if the coin is unspent.
+        """
+        cur = self.__db().execute('SELECT r1, r2, d FROM spent_coins WHERE digest = ?', (coin_id(coin),))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return signature_record(*(int_from_bytes(x) for x in row))
+
+    def put(self, coin, coin_signature):
+        self.put_many(((coin, coin_signature),))
+
+    def put_many(self, coins_with_signatures):
+        """
+        insert all (coin, coin_signature) pairs in one transaction.
+        """
+        rows = ((coin_id(coin),) + tuple(int_to_bytes(x) for x in coin_signature)
+                for coin, coin_signature in coins_with_signatures)
+        db = self.__db()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO spent_coins VALUES (?, ?, ?, ?)', rows)
+
+    def digests(self):
+        """
+        iterate over the digests of all spent coins.
+        """
+        for (digest,) in self.__db().execute('SELECT digest FROM spent_coins'):
+            yield digest
+
+    def close(self):
+        with self.__dbs_lock:
+            for db in self.__dbs:
+                db.close()
+            self.__dbs = []
+        self.__local = threading.local()
+
+class bloom_ledger(object):
+    """
+    A Bloom filter in front of another ledger. A coin whose digest is
+    not in the filter is certainly unspent, so only the possible hits
+    are looked up in the underlying ledger. The filter is rebuilt from
+    the ledger's digests when the bloom_ledger is created. bloom is a
+    bloom.bloom_filter or a bloom.scalable_bloom_filter. The filter's
+    updates and counters are guarded by a lock of their own, and the
+    underlying ledger is called outside of it, so the bloom_ledger is as
+    safe to call from many threads as its ledger.
+    """
+
+    def __init__(self, ledger, bloom=None):
+        self.__ledger = ledger
+        self.__bloom = bloom if bloom is not None else scalable_bloom_filter()
+        for digest in ledger.digests():
+            self.__bloom.add(digest)
+        self.__queries = 0
+        self.__definite_misses = 0
+        self.__false_positives = 0
+        self.__lock = threading.Lock()
+
+    def __contains__(self, coin):
+        with self.__lock:
+            self.__queries += 1
+            if coin_id(coin) not in self.__bloom:
+                self.__definite_misses += 1
+                return False
+        if coin in self.__ledger:
+            return True
+        with self.__lock:
+            self.__false_positives += 1
+        return False
+
+    def __len__(self):
+        return len(self.__ledger)
+
+    def get(self, coin):
+        if coin_id(coin) not in self.__bloom:
+            return None
+        return self.__ledger.get(coin)
+
+    def put(self, coin, coin_signature):
+        self.__ledger.put(coin, coin_signature)
+        with self.__lock:
+            self.__bloom.add(coin_id(coin))
+
+    def put_many(self, coins_with_signatures):
+        coins_with_signatures = list(coins_with_signatures)
+        self.__ledger.put_many(coins_with_signatures)
+        with self.__lock:
+            for coin, _ in coins_with_signatures:
+                self.__bloom.add(coin_id(coin))
+
+    def digests(self):
+        return self.__ledger.digests()
+
+    def close(self):
+        self.__ledger.close()
+
+    def metrics(self):
+        """
+        The filter's counters: the number of membership queries, the
+        definite misses answered by the filter alone, the lookups passed
+        on to the ledger, the false positives among them, the observed
+        false positive rate over the queries for unspent coins, and the
+        filter's estimated false positive rate.
+        """
+        with self.__lock:
+            negatives = self.__definite_misses + self.__false_positives
+            return {'queries': self.__queries,
+                    'definite_misses': self.__definite_misses,
+                    'ledger_lookups': self.__queries - self.__definite_misses,
+                    'false_positives': self.__false_positives,
+                    'observed_fp_rate': self.__false_positives / negatives if negatives else 0.0,
+                    'estimated_fp_rate': self.__bloom.estimated_fp_rate(),
+                    'filter_bits': self.__bloom.num_bits,
+                    'filter_count': self.__bloom.count}
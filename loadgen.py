@@ -0,0 +1,292 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#############################################################
+# module: loadgen.py
+# descrip: a synthetic workload of many spenders and merchants
+# that withdraw, spend, deposit, and double spend coins against
+# a bank in this process or behind a local bank server, for
+# capacity planning of the bank.
+#
+# python loadgen.py --group 256 --spenders 1000 --merchants 50 --ops 20000 --rate 500
+# python loadgen.py --group 256 --server --workers 4 --bank-threads 4 --ops 20000
+#
+# bugs to vladimir kulyukin via canvas
+##############################################################
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from pubrepo import pubrepo
+from auth import auth
+from bank import bank
+from spender import spender
+from merchant import merchant
+from bench import summarize
+from metrics import set_trace_level, serve_metrics, DEBUG, OFF
+
+### the operations of the workload.
+OPS = ('account', 'withdraw', 'spend', 'double_spend', 'deposit')
+
+### every spender account is created with 10 credit units.
+CREDITS_PER_ACCOUNT = 10
+
+def distinct_ids(n, lo, hi, rng):
+    """
+    n distinct random integers in [lo, hi).
+    """
+    assert hi - lo >= n, 'there are fewer than {} ids in [{}, {})'.format(n, lo, hi)
+    ids = set()
+    while len(ids) < n:
+        ids.add(rng.randrange(lo, hi))
+    return list(ids)
+
+class load_generator(object):
+    """
+    A workload of num_spenders spenders with distinct secret identities
+    and num_merchants merchants with the ids first_merchant_id, ... .
+    Every step, a random spender either withdraws a coin or spends one
+    at a random free merchant, and a merchant with an accepted coin
+    deposits it. After a spend, the spender double spends the same coin
+    at another free merchant with the probability double_spend_rate.
+    A spender whose credits run out has its account created again.
+    """
+
+    def __init__(self, pbr, num_spenders, num_merchants, double_spend_rate=0.01, seed=None,
+                 first_merchant_id=1000, spender_ids=None):
+        """
+        spender_ids are the spenders' secret identities, by default
+        num_spenders distinct random ones.
+        """
+        self.pbr = pbr
+        self.double_spend_rate = double_spend_rate
+        self.rng = random.Random(seed)
+        ### the identities are distinct, so no two spenders share an account.
+        if spender_ids is None:
+            spender_ids = distinct_ids(num_spenders, 1, pbr.get_q(), self.rng)
+        num_spenders = len(spender_ids)
+        self.spenders = [spender(u) for u in spender_ids]
+        self.merchants = [merchant(first_merchant_id + j) for j in range(num_merchants)]
+        self.__credits = [0] * num_spenders
+        self.__unspent = [0] * num_spenders
+        self.__free = list(range(num_merchants))
+        ### the merchants with an accepted coin.
+        self.__pending = set()
+        self.__accounts_created = set()
+        self.__merchant_accounts_created = False
+
+    def __step(self, bnk):
+        """
+        pick and run one operation. Returns its name and its result.
+        """
+        rng, pbr = self.rng, self.pbr
+        if self.__pending and (not self.__free or rng.random() < 0.5):
+            j = rng.choice(list(self.__pending))
+            self.__pending.discard(j)
+            mrt = self.merchants[j]
+            self.__free.append(j)
+            rslt = mrt.deposit_coin(bnk, pbr)
+            if rslt == mrt.get_id():
+                return 'deposit', 'credited'
+            elif rslt == -1:
+                return 'deposit', 'rejected'
+            ### the second deposit of a double spent coin, whichever
+            ### merchant makes it.
+            return 'deposit', 'double_spent'
+        i = rng.randrange(len(self.spenders))
+        spr = self.spenders[i]
+        if i not in self.__accounts_created or (self.__credits[i] == 0 and self.__unspent[i] == 0):
+            spr.create_bank_account(bnk, pbr)
+            self.__accounts_created.add(i)
+            self.__credits[i] = CREDITS_PER_ACCOUNT
+            return 'account', None
+        if self.__unspent[i] == 0:
+            if spr.request_coin(bnk, pbr) is None:
+                self.__credits[i] = 0
+                return 'withdraw', 'declined'
+            self.__credits[i] -= 1
+            self.__unspent[i] += 1
+            return 'withdraw', None
+        j = self.__free.pop(rng.randrange(len(self.__free)))
+        spr.spend_unspent_coin(self.merchants[j], pbr)
+        self.__unspent[i] -= 1
+        self.__pending.add(j)
+        if self.__free and rng.random() < self.double_spend_rate:
+            k = self.__free.pop(rng.randrange(len(self.__free)))
+            spr.double_spend_coin(self.merchants[k], pbr)
+            self.__pending.add(k)
+            return 'double_spend', None
+        return 'spend', None
+
+    def run(self, bnk, num_ops, rate=None):
+        """
+        Run num_ops operations against the bank bnk (a bank or a
+        netbank.remote_bank). With rate, the operations arrive open-loop
+        as a Poisson process of rate per second, and the time an
+        operation waits for the previous ones to finish is its queueing
+        delay; without rate, every operation starts when the previous one
+        ends. Returns the report of report().
+        """
+        if not self.__merchant_accounts_created:
+            for mrt in self.merchants:
+                mrt.create_bank_account(bnk)
+            self.__merchant_accounts_created = True
+        latencies = {op: [] for op in OPS}
+        delays = []
+        outcomes = {}
+        t0 = time.perf_counter()
+        arrival = t0
+        for _ in range(num_ops):
+            if rate:
+                arrival += self.rng.expovariate(rate)
+                now = time.perf_counter()
+                if now < arrival:
+                    time.sleep(arrival - now)
+            start = time.perf_counter()
+            delays.append(start - arrival if rate else 0.0)
+            op, outcome = self.__step(bnk)
+            latencies[op].append(time.perf_counter() - start)
+            if outcome is not None:
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        return report(latencies, delays, outcomes, time.perf_counter() - t0)
+
+def report(latencies, delays, outcomes, elapsed):
+    """
+    the sustained throughput, the queueing delay, the latency of every
+    operation, and the counts of the outcomes of a run: the credited,
+    rejected, and double spent deposits and the declined withdrawals.
+    """
+    num_ops = sum(len(xs) for xs in latencies.values())
+    return {'num_ops': num_ops,
+            'elapsed_s': elapsed,
+            'ops_per_s': num_ops / elapsed if elapsed > 0 else None,
+            'queueing_delay': summarize(delays),
+            'ops': {op: summarize(xs) for op, xs in latencies.items()},
+            'outcomes': outcomes}
+
+def merge_reports(reports, elapsed):
+    """
+    the report of concurrent runs that took elapsed seconds together.
+    """
+    merged = {'num_ops': sum(r['num_ops'] for r in reports), 'elapsed_s': elapsed, 'outcomes': {}}
+    merged['ops_per_s'] = merged['num_ops'] / elapsed if elapsed > 0 else None
+    for r in reports:
+        for outcome, n in r['outcomes'].items():
+            merged['outcomes'][outcome] = merged['outcomes'].get(outcome, 0) + n
+    merged['workers'] = reports
+    return merged
+
+def simulate(pbr, bnk, num_spenders, num_merchants, num_ops, rate=None, double_spend_rate=0.01,
+             seed=None, num_workers=1):
+    """
+    Run a load_generator against the bank bnk in this process. With
+    num_workers > 1, the thread-safe bank is driven by num_workers
+    threads at once, as in run_workers.
+    """
+    if num_workers > 1:
+        return run_workers(pbr, lambda: (bnk, None), num_spenders, num_merchants, num_ops, rate,
+                           double_spend_rate, seed, num_workers)
+    gen = load_generator(pbr, num_spenders, num_merchants, double_spend_rate, seed)
+    return gen.run(bnk, num_ops, rate)
+
+def run_workers(pbr, connect, num_spenders, num_merchants, num_ops, rate=None,
+                double_spend_rate=0.01, seed=None, num_workers=1):
+    """
+    Drive a bank from num_workers threads, each with its own share of
+    the spenders, merchants, operations, and rate. connect() returns
+    a worker's bank and a function that closes it, or None.
+    """
+    reports = [None] * num_workers
+    ### the workers' spenders are drawn together, so that they are distinct.
+    rng = random.Random(seed)
+    per_worker = max(1, num_spenders // num_workers)
+    spender_ids = distinct_ids(per_worker * num_workers, 1, pbr.get_q(), rng)
+
+    def work(k):
+        bnk, close = connect()
+        try:
+            gen = load_generator(pbr, per_worker, max(2, num_merchants // num_workers),
+                                 double_spend_rate, None if seed is None else seed + k,
+                                 first_merchant_id=1000 + k * num_merchants,
+                                 spender_ids=spender_ids[k*per_worker:(k+1)*per_worker])
+            reports[k] = gen.run(bnk, num_ops // num_workers, rate / num_workers if rate else None)
+        finally:
+            if close is not None:
+                close()
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=work, args=(k,)) for k in range(num_workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return merge_reports(reports, time.perf_counter() - t0)
+
+def simulate_via_server(pbr, bnk, num_spenders, num_merchants, num_ops, rate=None,
+                        double_spend_rate=0.01, seed=None, num_workers=1, num_verifiers=None,
+                        num_bank_threads=1):
+    """
+    Serve bnk with a netbank.bank_server on num_bank_threads bank
+    threads and drive it from num_workers threads, each with its own
+    connection, as in run_workers.
+    """
+    from netbank import serve_in_background, remote_bank
+    (host, port), stop = serve_in_background(bnk, pbr, num_verifiers=num_verifiers,
+                                             num_bank_threads=num_bank_threads)
+
+    def connect():
+        rbnk = remote_bank(host, port)
+        return rbnk, rbnk.close
+
+    try:
+        return run_workers(pbr, connect, num_spenders, num_merchants, num_ops, rate,
+                           double_spend_rate, seed, num_workers)
+    finally:
+        stop()
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='simulate many spenders and merchants against the bank')
+    ap.add_argument('--group', default='toy', help="'toy' (p == 227) or the bit length of a generated group")
+    ap.add_argument('--spenders', type=int, default=100)
+    ap.add_argument('--merchants', type=int, default=10)
+    ap.add_argument('--ops', type=int, default=1000)
+    ap.add_argument('--rate', type=float, help='open-loop arrival rate in ops/s (default: closed loop)')
+    ap.add_argument('--double-spend-rate', type=float, default=0.01)
+    ap.add_argument('--seed', type=int)
+    ap.add_argument('--server', action='store_true', help='drive the bank through a local bank server')
+    ap.add_argument('--workers', type=int, default=1, help='client threads')
+    ap.add_argument('--bank-threads', type=int, default=1, help='bank threads of the server with --server')
+    ap.add_argument('--verbose', action='store_true', help='trace every protocol step of the parties')
+    ap.add_argument('--metrics-port', type=int,
+                    help='serve /metrics and /metrics.json on this local port during the run')
+    args = ap.parse_args(argv)
+    set_trace_level(DEBUG if args.verbose else OFF)
+    stop_metrics = None
+    if args.metrics_port is not None:
+        (host, port), stop_metrics = serve_metrics(port=args.metrics_port)
+        print('metrics at http://{}:{}/metrics'.format(host, port), file=sys.stderr)
+    pbr = pubrepo()
+    auth(None if args.group == 'toy' else int(args.group)).init_p_q_g_g1_g2_H_H0(pbr)
+    bnk = bank()
+    bnk.create_h_h1_h2(pbr)
+    pbr.precompute_fixed_base_tables()
+    try:
+        if args.server:
+            rslt = simulate_via_server(pbr, bnk, args.spenders, args.merchants, args.ops, args.rate,
+                                       args.double_spend_rate, args.seed, args.workers,
+                                       num_bank_threads=args.bank_threads)
+        else:
+            rslt = simulate(pbr, bnk, args.spenders, args.merchants, args.ops, args.rate,
+                            args.double_spend_rate, args.seed, args.workers)
+    finally:
+        bnk.close()
+        if stop_metrics is not None:
+            stop_metrics()
+    json.dump(rslt, sys.stdout, indent=2)
+    print()
+
+if __name__ == '__main__':
+    main()
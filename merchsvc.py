@@ -0,0 +1,285 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#############################################################
+# module: merchsvc.py
+# descrip: the verification service of the merchants'
+# point-of-sale terminals, which checks the validity (cf.
+# Slide 27) and the acceptability (cf. Slide 28) of coins in
+# this process or in a pool of worker processes, and the
+# terminal that merchant.py and vendor.py build on.
+# bugs to vladimir kulyukin via canvas
+##############################################################
+
+import collections
+import concurrent.futures
+import multiprocessing
+import threading
+import time
+from bank import is_coin_in_range, is_signature_in_range, group_of
+from grputils import is_multi_exp_equal
+from records import coin_record, signature_record
+from metrics import trace, timed, DEBUG, WARNING
+
+def is_coin_valid(coin, pbr):
+    """
+    Check g^r == a*h^c and A^r == b*z^c with c == H(A,B,z,a,b) for
+    the coin (A,B,z,a,b,r). Cf. Slide 27.
+    """
+    p, q, H, g_tab, h_tab, _, _ = pbr.get_verification_params()
+    if not is_coin_in_range(coin, p, q):
+        return False
+    A, B, z, a, b, r = coin
+    c = H((A,B,z,a,b))
+    ### g^r == a*h^c and A^r == b*z^c are checked as
+    ### g^r * h^(-c) == a and A^r * z^(-c) == b.
+    return is_multi_exp_equal(((g_tab, r), (h_tab, -c)), a, p) and \
+           is_multi_exp_equal(((A, r), (z, -c)), b, p)
+
+def is_coin_acceptable(coin, coin_signature, pbr):
+    """
+    Check g1^r1 * g2^r2 == A^d * B for the coin with the signature
+    (r1,r2,d). Cf. Slide 28.
+    """
+    p, q, _, _, _, g1_tab, g2_tab = pbr.get_verification_params()
+    if not is_signature_in_range(coin_signature, q):
+        return False
+    A, B = coin[0], coin[1]
+    r1, r2, d = coin_signature
+    ## g1^r1 * g2^r2 == A^d * B is checked as g1^r1 * g2^r2 * A^(-d) == B.
+    return is_multi_exp_equal(((g1_tab, r1), (g2_tab, r2), (A, -d)), B, p)
+
+### the public repo of a worker process, set by its initializer.
+_worker_pbr = None
+
+def _init_worker(pbr):
+    global _worker_pbr
+    _worker_pbr = pbr
+
+def _are_coins_valid(coins, pbr=None):
+    pbr = pbr if pbr is not None else _worker_pbr
+    return [is_coin_valid(coin, pbr) for coin in coins]
+
+def _are_coins_acceptable(coins_with_signatures, pbr=None):
+    pbr = pbr if pbr is not None else _worker_pbr
+    return [is_coin_acceptable(coin, coin_signature, pbr)
+            for coin, coin_signature in coins_with_signatures]
+
+class merchant_service(object):
+    """
+    Checks coins for the point-of-sale terminals of the merchants. With
+    num_workers == 0, a terminal's coins are checked in its own thread;
+    otherwise, they are checked by num_workers worker processes, which
+    are forked with the public repo pbr (e.g., a params snapshot) on
+    creation, and many coins of one request are split into chunks of
+    chunk_size that are checked in parallel. The workers check coins
+    only in the group of pbr and raise ValueError for another group, so
+    a service with workers is replaced after a key rotation. Terminals in many threads can share one
+    service. The service counts the coins every terminal has had
+    checked and the time it has spent waiting for the checks.
+    """
+
+    def __init__(self, pbr=None, num_workers=0, chunk_size=16):
+        self.__chunk_size = chunk_size
+        if num_workers:
+            if pbr is None:
+                raise ValueError('the workers need the public repo')
+            self.__group = group_of(pbr)
+            self.__pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=_init_worker, initargs=(pbr,))
+        else:
+            self.__group = None
+            self.__pool = None
+        ### terminal -> [valid, invalid, acceptable, unacceptable,
+        ###              busy seconds, time of first check, time of last check]
+        self.__stats = {}
+        self.__lock = threading.Lock()
+
+    def __check(self, terminal, check, k, items, pbr):
+        """
+        check the items and count the results in the terminal's stats
+        from index k on.
+        """
+        t0 = time.perf_counter()
+        if self.__pool is None:
+            rslts = check(items, pbr)
+        else:
+            if group_of(pbr) != self.__group:
+                raise ValueError('the workers check coins in another group')
+            n = self.__chunk_size
+            chunks = [items[i:i+n] for i in range(0, len(items), n)]
+            rslts = [ok for oks in self.__pool.map(check, chunks) for ok in oks]
+        t1 = time.perf_counter()
+        with self.__lock:
+            st = self.__stats.get(terminal)
+            if st is None:
+                st = self.__stats[terminal] = [0, 0, 0, 0, 0.0, t0, t1]
+            num_ok = sum(rslts)
+            st[k] += num_ok
+            st[k+1] += len(rslts) - num_ok
+            st[4] += t1 - t0
+            st[6] = t1
+        return rslts
+
+    def validate_coins(self, terminal, coins, pbr):
+        """
+        whether each coin in the list coins is valid (cf. Slide 27).
+        """
+        return self.__check(terminal, _are_coins_valid, 0, coins, pbr)
+
+    def accept_coins(self, terminal, coins_with_signatures, pbr):
+        """
+        whether each (coin, coin_signature) in the list is acceptable
+        (cf. Slide 28).
+        """
+        return self.__check(terminal, _are_coins_acceptable, 2, coins_with_signatures, pbr)
+
+    def stats(self):
+        """
+        For every terminal: the numbers of valid, invalid, acceptable,
+        and unacceptable coins, the seconds spent waiting for checks
+        (busy_s) and from its first check to its last (elapsed_s), and
+        its throughput in accepted coins per second of elapsed time.
+        """
+        with self.__lock:
+            return {terminal: {'valid': st[0], 'invalid': st[1],
+                               'acceptable': st[2], 'unacceptable': st[3],
+                               'busy_s': st[4], 'elapsed_s': st[6] - st[5],
+                               'coins_per_s': st[2] / (st[6] - st[5]) if st[6] > st[5] else None}
+                    for terminal, st in self.__stats.items()}
+
+    def close(self):
+        """
+        stop the worker processes.
+        """
+        if self.__pool is not None:
+            self.__pool.shutdown()
+            self.__pool = None
+
+class point_of_sale(object):
+    """
+    A point-of-sale terminal of the merchant merchant_id. Its coins are
+    checked by the merchant_service service, by default one of its own
+    that checks them in its thread, and the accepted coins wait in a
+    queue until they are deposited, oldest first. terminal names the
+    terminal in the service's stats; by default, it is the merchant id,
+    so terminals of one merchant that share a service should be given
+    names of their own. clock() returns the time stamps of its challenges,
+    e.g., a timesrc.time_cursor of the terminal's own leased blocks; by
+    default, they come from the public repo.
+    """
+
+    def __init__(self, merchant_id, clock=None, service=None, terminal=None):
+        self.__id = merchant_id
+        self.__clock = clock
+        self.__service = service if service is not None else merchant_service()
+        self.__terminal = terminal if terminal is not None else merchant_id
+        ### the accepted (coin, coin signature) pairs.
+        self.__accepted_coins = collections.deque()
+
+    def get_id(self):
+        return self.__id
+
+    def get_terminal(self):
+        return self.__terminal
+
+    def create_bank_account(self, bnk):
+        """
+        The merchant requests the bank to create
+        a merchant account.
+        """
+        trace(DEBUG, 'Merchant {} requested Bank to create a merchant account.', self.__id)
+        bnk.create_merchant_account(self.__id)
+
+    def __challenge(self, coin, pbr):
+        t = self.__clock() if self.__clock is not None else pbr.get_time()
+        return pbr.get_H0()((coin[0], coin[1], self.__id, t))
+
+    @timed('merchant.compute_d')
+    def compute_d(self, coin, pbr):
+        """
+        the merchant checks the validity of the coin and
+        if the coin is valid computes d (Cf. Slide 27).
+        """
+        return self.compute_ds([coin], pbr)[0]
+
+    def compute_ds(self, coins, pbr):
+        """
+        the d of every coin in the list coins, or None for an invalid
+        coin, with the coins checked together.
+        """
+        ds = []
+        for coin, is_valid in zip(coins, self.__service.validate_coins(self.__terminal, coins, pbr)):
+            if is_valid:
+                d = self.__challenge(coin, pbr)
+                trace(DEBUG, 'Merchant {} computed d == {}.', self.__id, d)
+                ds.append(d)
+            else:
+                trace(WARNING, 'Merchant {} failed to computed d, because coin {} is not valid.', self.__id, coin)
+                ds.append(None)
+        return ds
+
+    @timed('merchant.accept_coin')
+    def accept_coin(self, coin, r1, r2, d, pbr):
+        """
+        the merchant accepts the coin (cf. Slide 28).
+        """
+        ## The Merchant checks if the assertion below holds
+        #  and only then accepts the coin.
+        coin_acceptable = self.accept_coins([(coin, (r1, r2, d))], pbr)[0]
+        assert coin_acceptable
+
+    def accept_coins(self, coins_with_signatures, pbr):
+        """
+        Check the (coin, coin_signature) pairs together and queue the
+        acceptable ones for deposit. Returns whether each was accepted.
+        """
+        oks = self.__service.accept_coins(self.__terminal, coins_with_signatures, pbr)
+        for (coin, coin_signature), ok in zip(coins_with_signatures, oks):
+            if ok:
+                coin_signature = signature_record.of(coin_signature)
+                self.__accepted_coins.append((coin_record.of(coin), coin_signature))
+                trace(DEBUG, 'Merchant {} found coin {} with signature {} acceptable.',
+                      self.__id, coin, coin_signature)
+        return oks
+
+    def get_num_accepted_coins(self):
+        return len(self.__accepted_coins)
+
+    def get_accepted_coins(self):
+        """
+        the queued (coin, coin_signature) pairs, oldest first.
+        """
+        return list(self.__accepted_coins)
+
+    @timed('merchant.deposit_coin')
+    def deposit_coin(self, bnk, pbr):
+        """
+        The merchant asks the bank to deposit the oldest accepted coin.
+        Cf. Slide 30.
+        """
+        assert self.__accepted_coins, 'the merchant has no accepted coins'
+        coin, coin_sign = self.__accepted_coins.popleft()
+        trace(DEBUG, 'Merchant {} requested Bank to deposit coin {} with signature {}', self.__id, coin, coin_sign)
+        return bnk.deposit_coin_for_merchant(self.__id, coin, coin_sign, pbr)
+
+    def deposit_coins(self, bnk, pbr):
+        """
+        The merchant asks the bank to deposit all accepted coins in one
+        batch. Returns the bank's result for each coin, oldest first.
+        """
+        ### the coins are taken one by one, so a coin accepted by another
+        ### thread meanwhile stays queued for the next deposit.
+        coins_with_signatures = []
+        while self.__accepted_coins:
+            try:
+                coins_with_signatures.append(self.__accepted_coins.popleft())
+            except IndexError:
+                break
+        trace(DEBUG, 'Merchant {} requested Bank to deposit {} coins', self.__id, len(coins_with_signatures))
+        return bnk.deposit_coins(self.__id, coins_with_signatures, pbr)
+
+    def get_balance(self, bnk):
+        return bnk.balance_for_merchant_account(self.__id)
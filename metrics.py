@@ -0,0 +1,284 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#############################################################
+# module: metrics.py
+# descrip: leveled trace events, counters, and latency
+# histograms of the protocol phases of all parties, with
+# Prometheus text and JSON exporters.
+#
+# Only WARNING events are traced by default; set_trace_level(DEBUG)
+# traces every protocol step and set_trace_level(OFF) silences
+# the trace events, which are formatted only if their level is
+# enabled. set_metrics_enabled(False) stops the timing of the phases.
+#
+# bugs to vladimir kulyukin via canvas
+##############################################################
+
+import bisect
+import functools
+import http.server
+import json
+import threading
+import time
+
+### the trace levels. DEBUG events trace every protocol step,
+### INFO events the setup of the parties, and WARNING events
+### the failed steps.
+DEBUG, INFO, WARNING, OFF = 10, 20, 30, 100
+
+_trace_level = WARNING
+
+def _print_event(level, msg):
+    print(msg)
+
+_trace_sink = _print_event
+
+def set_trace_level(level):
+    """
+    only the events of level or higher are formatted and sent to the sink.
+    """
+    global _trace_level
+    _trace_level = level
+
+def get_trace_level():
+    return _trace_level
+
+def set_trace_sink(sink):
+    """
+    sink(level, msg) receives the enabled events; the default prints msg.
+    """
+    global _trace_sink
+    _trace_sink = sink
+
+def is_tracing(level):
+    return level >= _trace_level
+
+def trace(level, fmt, *args):
+    """
+    send fmt.format(*args) to the sink if level is enabled. The message
+    is not formatted otherwise, so a disabled event costs one call and
+    one comparison.
+    """
+    if level >= _trace_level:
+        _trace_sink(level, fmt.format(*args) if args else fmt)
+
+### latency buckets from 10 microseconds to 10 seconds.
+DEFAULT_BUCKETS = tuple(1e-5 * 2**i for i in range(21))
+
+class counter(object):
+    """
+    a monotonically increasing count.
+    """
+
+    __slots__ = ('name', 'labels', 'value', '__lock')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self.__lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.__lock:
+            self.value += n
+
+class histogram(object):
+    """
+    a histogram of observed values (e.g., latencies in seconds) over
+    the upper bounds in buckets; the last bucket is +Inf.
+    """
+
+    __slots__ = ('name', 'labels', 'bounds', 'counts', 'sum', 'count', '__lock')
+
+    def __init__(self, name, labels, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.labels = labels
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.__lock = threading.Lock()
+
+    def observe(self, x):
+        i = bisect.bisect_left(self.bounds, x)
+        with self.__lock:
+            self.counts[i] += 1
+            self.sum += x
+            self.count += 1
+
+    def quantile(self, phi):
+        """
+        the upper bound of the bucket of the phi-quantile, or None if
+        nothing has been observed.
+        """
+        if not self.count:
+            return None
+        rank = phi * self.count
+        seen = 0
+        for bound, n in zip(self.bounds + (float('inf'),), self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+class registry(object):
+    """
+    the counters and histograms by name and labels.
+    """
+
+    def __init__(self):
+        self.__metrics = {}
+        self.__help = {}
+        self.__lock = threading.Lock()
+
+    def __get(self, cls, name, help, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            m = self.__metrics.get(key)
+            if m is None:
+                m = cls(name, key[1], *args)
+                self.__metrics[key] = m
+                self.__help.setdefault(name, (help, 'counter' if cls is counter else 'histogram'))
+            return m
+
+    def counter(self, name, help='', **labels):
+        return self.__get(counter, name, help, labels)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS, **labels):
+        return self.__get(histogram, name, help, labels, buckets)
+
+    def metrics(self):
+        with self.__lock:
+            return list(self.__metrics.values())
+
+    def help(self, name):
+        return self.__help[name]
+
+    def reset(self):
+        """
+        zero all metrics, e.g., between benchmark runs.
+        """
+        for m in self.metrics():
+            if isinstance(m, counter):
+                m.value = 0
+            else:
+                m.counts = [0] * len(m.counts)
+                m.sum, m.count = 0.0, 0
+
+REGISTRY = registry()
+
+def counter_for(name, help='', **labels):
+    return REGISTRY.counter(name, help, **labels)
+
+def histogram_for(name, help='', buckets=DEFAULT_BUCKETS, **labels):
+    return REGISTRY.histogram(name, help, buckets, **labels)
+
+_metrics_enabled = True
+
+def set_metrics_enabled(enabled):
+    global _metrics_enabled
+    _metrics_enabled = enabled
+
+def timed(phase):
+    """
+    a decorator that observes the latency of every call of the
+    decorated function in the histogram digcash_phase_seconds of phase.
+    """
+    def decorate(fn):
+        hist = histogram_for('digcash_phase_seconds', 'latency of the protocol phases', phase=phase)
+
+        @functools.wraps(fn)
+        def timed_fn(*args, **kwargs):
+            if not _metrics_enabled:
+                return fn(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                hist.observe(time.perf_counter() - t0)
+        return timed_fn
+    return decorate
+
+def _label_str(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+
+def export_prometheus(reg=REGISTRY):
+    """
+    the metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    by_name = {}
+    for m in reg.metrics():
+        by_name.setdefault(m.name, []).append(m)
+    for name in sorted(by_name):
+        help, kind = reg.help(name)
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for m in sorted(by_name[name], key=lambda m: m.labels):
+            if kind == 'counter':
+                lines.append('{}{} {}'.format(name, _label_str(m.labels), m.value))
+                continue
+            cum = 0
+            for bound, n in zip(m.bounds + (float('inf'),), m.counts):
+                cum += n
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(name, _label_str(m.labels, (('le', le),)), cum))
+            lines.append('{}_sum{} {!r}'.format(name, _label_str(m.labels), m.sum))
+            lines.append('{}_count{} {}'.format(name, _label_str(m.labels), m.count))
+    return '\n'.join(lines) + '\n'
+
+def export_json(reg=REGISTRY):
+    """
+    the metrics as a dict: counters by name and labels, and the count,
+    sum, mean, and bucketed p50/p90/p99 of every histogram.
+    """
+    out = {'counters': [], 'histograms': []}
+    for m in reg.metrics():
+        if isinstance(m, counter):
+            out['counters'].append({'name': m.name, 'labels': dict(m.labels), 'value': m.value})
+        else:
+            out['histograms'].append({'name': m.name, 'labels': dict(m.labels),
+                                      'count': m.count, 'sum': m.sum,
+                                      'mean': m.sum / m.count if m.count else None,
+                                      'p50': m.quantile(0.5), 'p90': m.quantile(0.9),
+                                      'p99': m.quantile(0.99)})
+    return out
+
+class _metrics_handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, ctype = export_prometheus().encode(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, ctype = json.dumps(export_json()).encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve_metrics(host='127.0.0.1', port=0):
+    """
+    Serve /metrics (Prometheus text) and /metrics.json on a background
+    thread. Returns the server's address and a function that stops it.
+    """
+    server = http.server.ThreadingHTTPServer((host, port), _metrics_handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    return server.server_address, stop
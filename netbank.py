@@ -0,0 +1,398 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#############################################################
+# module: netbank.py
+# descrip: asyncio server and clients that expose the bank's
+# withdrawal (gw/beta, c1) and deposit protocol steps over
+# local TCP or Unix sockets.
+# bugs to vladimir kulyukin via canvas
+##############################################################
+
+import asyncio
+import base64
+import concurrent.futures
+import json
+import multiprocessing
+import threading
+from bank import batch_verify_coin_deposits
+from wire import iter_deposit_records, pack_deposit_records, wire_width
+
+### Every frame is one line of JSON. A request is
+### {"id": n, "op": op, "args": [...]} and its response is
+### {"id": n, "result": ...} or {"id": n, "error": "..."},
+### where n is null if the frame is not a request with an id.
+### A connection may carry many requests at once; the
+### responses come back in the order they are ready.
+### Bulk deposits may instead be sent as one base64-encoded
+### wire.pack_deposit_records() batch, which is about half the
+### size of the same coins in JSON.
+MAX_FRAME_SIZE = 1 << 26
+
+### the public repo of a verifier process.
+_verifier_pbr = None
+
+def _init_verifier(pbr):
+    global _verifier_pbr
+    _verifier_pbr = pbr
+
+def _verify_coin_deposits(coins_with_signatures):
+    return batch_verify_coin_deposits(coins_with_signatures, _verifier_pbr)
+
+def _as_pairs(coins_with_signatures):
+    return [(tuple(coin), tuple(coin_signature)) for coin, coin_signature in coins_with_signatures]
+
+class bank_server(object):
+    """
+    Serves the bank bnk with the public repo pbr. The calls into the bank
+    run on num_bank_threads bank threads, so the event loop stays free
+    to read new requests. The bank is thread-safe, so with more than one
+    thread, requests for different accounts and coins run concurrently.
+    The congruences of deposited coins are checked by num_verifiers
+    forked verifier processes (all cores by default) before the bank
+    thread records them; with num_verifiers == 0, deposits go straight
+    to bnk.deposit_coins, e.g., for a shardbank.sharded_bank, which
+    verifies in its own workers.
+    """
+
+    def __init__(self, bnk, pbr, num_verifiers=None, num_bank_threads=1, max_requests_in_flight=64):
+        """
+        A connection has at most max_requests_in_flight requests
+        in flight; the next request is read when one of them is answered.
+        """
+        self.__bnk = bnk
+        self.__pbr = pbr
+        self.__max_requests_in_flight = max_requests_in_flight
+        self.__bank_executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_bank_threads)
+        if num_verifiers == 0:
+            self.__verifiers = None
+        else:
+            self.__verifiers = concurrent.futures.ProcessPoolExecutor(
+                max_workers=num_verifiers or multiprocessing.cpu_count(),
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=_init_verifier, initargs=(pbr,))
+        self.__server = None
+        self.__ops = {'create_spender_account': self.__create_spender_account,
+                      'create_merchant_account': self.__create_merchant_account,
+                      'compute_gw_beta': self.__compute_gw_beta,
+                      'compute_c1': self.__compute_c1,
+                      'compute_gw_betas': self.__compute_gw_betas,
+                      'compute_c1s': self.__compute_c1s,
+                      'deposit_coin_for_merchant': self.__deposit_coin_for_merchant,
+                      'deposit_coins': self.__deposit_coins,
+                      'deposit_coin_batch': self.__deposit_coin_batch,
+                      'balance_for_merchant_account': self.__balance_for_merchant_account,
+                      'balance_for_spender_account': self.__balance_for_spender_account}
+
+    async def start(self, host='127.0.0.1', port=0, path=None):
+        """
+        Listen on the Unix socket at path or, if path is None, on TCP
+        host:port. Returns the address the server is bound to.
+        """
+        if path is not None:
+            self.__server = await asyncio.start_unix_server(self.__serve_connection, path=path,
+                                                            limit=MAX_FRAME_SIZE)
+        else:
+            self.__server = await asyncio.start_server(self.__serve_connection, host, port,
+                                                       limit=MAX_FRAME_SIZE)
+        return self.__server.sockets[0].getsockname()
+
+    async def close(self):
+        self.__server.close()
+        await self.__server.wait_closed()
+        self.__bank_executor.shutdown()
+        if self.__verifiers is not None:
+            self.__verifiers.shutdown()
+
+    async def __serve_connection(self, reader, writer):
+        tasks = set()
+        in_flight = asyncio.Semaphore(self.__max_requests_in_flight)
+        try:
+            while True:
+                ### the connection is not read while it has the maximum
+                ### number of requests in flight.
+                await in_flight.acquire()
+                line = await reader.readline()
+                if not line:
+                    break
+                ### each request runs in its own task, so a slow deposit
+                ### does not hold up the requests pipelined behind it.
+                task = asyncio.ensure_future(self.__serve_request(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: in_flight.release())
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+
+    async def __serve_request(self, line, writer):
+        """
+        Answer the request in the frame line. Every frame gets a
+        response; a malformed one gets an error with the request's id if
+        it has one and null otherwise.
+        """
+        req_id = None
+        try:
+            req = json.loads(line)
+            req_id = req.get('id')
+            resp = {'id': req_id, 'result': await self.__ops[req['op']](*req['args'])}
+        except Exception as e:
+            resp = {'id': req_id, 'error': '{}: {}'.format(type(e).__name__, e)}
+        try:
+            writer.write(json.dumps(resp).encode() + b'\n')
+            await writer.drain()
+        except ConnectionError:
+            ### the client has gone away.
+            pass
+
+    def __in_bank(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self.__bank_executor, fn, *args)
+
+    async def __create_spender_account(self, I):
+        return await self.__in_bank(self.__bnk.create_spender_account, I, self.__pbr)
+
+    async def __create_merchant_account(self, merchant_id):
+        return await self.__in_bank(self.__bnk.create_merchant_account, merchant_id)
+
+    async def __compute_gw_beta(self, I):
+        return list(await self.__in_bank(self.__bnk.compute_gw_beta, I, self.__pbr))
+
+    async def __compute_c1(self, I, c, gw):
+        return await self.__in_bank(self.__bnk.compute_c1, I, c, gw, self.__pbr)
+
+    async def __compute_gw_betas(self, I, n):
+        gw_betas = await self.__in_bank(self.__bnk.compute_gw_betas, I, n, self.__pbr)
+        return [list(gw_beta) for gw_beta in gw_betas]
+
+    async def __compute_c1s(self, I, cs, gws):
+        return await self.__in_bank(self.__bnk.compute_c1s, I, cs, gws, self.__pbr)
+
+    async def __deposit_coin_for_merchant(self, merchant_id, coin, coin_signature):
+        return (await self.__deposit_coins(merchant_id, [(coin, coin_signature)]))[0]
+
+    async def __deposit_coins(self, merchant_id, coins_with_signatures):
+        bnk, pbr = self.__bnk, self.__pbr
+        coins_with_signatures = _as_pairs(coins_with_signatures)
+        if self.__verifiers is None:
+            return await self.__in_bank(bnk.deposit_coins, merchant_id, coins_with_signatures, pbr)
+        ### 1. the spent coins are looked up on a bank thread.
+        spent = await self.__in_bank(lambda: [bnk.is_coin_spent(coin) for coin, _ in coins_with_signatures])
+        fresh = [i for i in range(len(coins_with_signatures)) if not spent[i]]
+        ### 2. the fresh coins are verified in a verifier process.
+        valid = [False] * len(coins_with_signatures)
+        if fresh:
+            loop = asyncio.get_running_loop()
+            for j in await loop.run_in_executor(self.__verifiers, _verify_coin_deposits,
+                                                [coins_with_signatures[i] for i in fresh]):
+                valid[fresh[j]] = True
+        ### 3. a bank thread records them. It looks the coins up again,
+        ###    because a concurrent deposit may have spent them meanwhile.
+        return await self.__in_bank(bnk.deposit_verified_coins, merchant_id, coins_with_signatures, valid, pbr)
+
+    async def __deposit_coin_batch(self, batch):
+        """
+        deposit the records of a base64-encoded wire batch. The records
+        are deposited per merchant, and the results come back in the
+        order of the records.
+        """
+        by_merchant = {}
+        for i, (merchant_id, coin, coin_signature) in enumerate(iter_deposit_records(base64.b64decode(batch))):
+            by_merchant.setdefault(merchant_id, []).append((i, (coin, coin_signature)))
+        rslts = [None] * sum(len(recs) for recs in by_merchant.values())
+        for merchant_id, recs in by_merchant.items():
+            for (i, _), rslt in zip(recs, await self.__deposit_coins(merchant_id, [rec for _, rec in recs])):
+                rslts[i] = rslt
+        return rslts
+
+    async def __balance_for_merchant_account(self, merchant_id):
+        return await self.__in_bank(self.__bnk.balance_for_merchant_account, merchant_id)
+
+    async def __balance_for_spender_account(self, I):
+        return await self.__in_bank(self.__bnk.balance_for_spender_account, I)
+
+class _connection(object):
+    """
+    A pooled client connection and its requests awaiting responses.
+    """
+
+    __slots__ = ('reader', 'writer', 'pending', 'task')
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}
+        self.task = None
+
+class bank_client(object):
+    """
+    An asyncio client of a bank_server with a pool of pool_size
+    connections. Each request goes to the connection with the fewest
+    requests in flight, and any number of requests may be pipelined on
+    a connection; their responses are matched to them by id.
+    """
+
+    def __init__(self, host='127.0.0.1', port=None, path=None, pool_size=4):
+        self.__host = host
+        self.__port = port
+        self.__path = path
+        self.__pool_size = pool_size
+        self.__conns = []
+        self.__next_id = 0
+
+    async def connect(self):
+        for _ in range(self.__pool_size):
+            if self.__path is not None:
+                reader, writer = await asyncio.open_unix_connection(self.__path, limit=MAX_FRAME_SIZE)
+            else:
+                reader, writer = await asyncio.open_connection(self.__host, self.__port, limit=MAX_FRAME_SIZE)
+            conn = _connection(reader, writer)
+            conn.task = asyncio.ensure_future(self.__read_responses(conn))
+            self.__conns.append(conn)
+
+    async def close(self):
+        for conn in self.__conns:
+            conn.writer.close()
+        for conn in self.__conns:
+            await conn.task
+        self.__conns = []
+
+    async def __read_responses(self, conn):
+        try:
+            while True:
+                line = await conn.reader.readline()
+                if not line:
+                    break
+                resp = json.loads(line)
+                fut = conn.pending.pop(resp.get('id'), None)
+                if fut is None:
+                    ### the response to a frame this client did not send.
+                    continue
+                if 'error' in resp:
+                    fut.set_exception(RuntimeError(resp['error']))
+                else:
+                    fut.set_result(resp['result'])
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for fut in conn.pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError('bank server closed the connection'))
+            conn.pending.clear()
+
+    async def call(self, op, *args):
+        """
+        send the request op(*args) and wait for its result.
+        """
+        conn = min(self.__conns, key=lambda c: len(c.pending))
+        self.__next_id += 1
+        req_id = self.__next_id
+        fut = asyncio.get_running_loop().create_future()
+        conn.pending[req_id] = fut
+        conn.writer.write(json.dumps({'id': req_id, 'op': op, 'args': args}).encode() + b'\n')
+        await conn.writer.drain()
+        return await fut
+
+    async def compute_gw_beta(self, I):
+        return tuple(await self.call('compute_gw_beta', I))
+
+    async def compute_c1(self, I, c, gw):
+        return await self.call('compute_c1', I, c, gw)
+
+    async def compute_gw_betas(self, I, n):
+        return [tuple(gw_beta) for gw_beta in await self.call('compute_gw_betas', I, n)]
+
+    async def compute_c1s(self, I, cs, gws):
+        return await self.call('compute_c1s', I, list(cs), list(gws))
+
+    async def deposit_coin_for_merchant(self, merchant_id, coin, coin_signature):
+        return await self.call('deposit_coin_for_merchant', merchant_id, tuple(coin), tuple(coin_signature))
+
+    async def deposit_coins(self, merchant_id, coins_with_signatures):
+        return await self.call('deposit_coins', merchant_id, _as_pairs(coins_with_signatures))
+
+    async def deposit_coin_batch(self, deposit_records, width):
+        """
+        deposit the (merchant_id, coin, coin_signature) triples in
+        deposit_records as one binary batch of elements of width bytes.
+        """
+        batch = pack_deposit_records(deposit_records, width)
+        return await self.call('deposit_coin_batch', base64.b64encode(batch).decode('ascii'))
+
+class remote_bank(object):
+    """
+    A synchronous stand-in for a bank that forwards every call to a
+    bank_server through a bank_client running on a background event loop.
+    It can be passed as bnk to spender, merchant, and vendor. The pbr
+    arguments are not sent; the server uses its own public repo.
+    """
+
+    def __init__(self, host='127.0.0.1', port=None, path=None, pool_size=1):
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = threading.Thread(target=self.__loop.run_forever, daemon=True)
+        self.__thread.start()
+        self.__client = bank_client(host, port, path, pool_size)
+        self.__run(self.__client.connect())
+
+    def __run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.__loop).result()
+
+    def close(self):
+        self.__run(self.__client.close())
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
+        self.__loop.close()
+
+    def create_spender_account(self, I, pbr, num_credit_units=10):
+        return self.__run(self.__client.call('create_spender_account', I))
+
+    def create_merchant_account(self, account_id):
+        return self.__run(self.__client.call('create_merchant_account', account_id))
+
+    def compute_gw_beta(self, I, pbr):
+        return self.__run(self.__client.compute_gw_beta(I))
+
+    def compute_c1(self, I, c, gw, pbr):
+        return self.__run(self.__client.compute_c1(I, c, gw))
+
+    def compute_gw_betas(self, I, n, pbr):
+        return self.__run(self.__client.compute_gw_betas(I, n))
+
+    def compute_c1s(self, I, cs, gws, pbr):
+        return self.__run(self.__client.compute_c1s(I, cs, gws))
+
+    def deposit_coin_for_merchant(self, merchant_id, coin, coin_signature, pbr):
+        return self.__run(self.__client.deposit_coin_for_merchant(merchant_id, coin, coin_signature))
+
+    def deposit_coins(self, merchant_id, coins_with_signatures, pbr):
+        return self.__run(self.__client.deposit_coins(merchant_id, coins_with_signatures))
+
+    def deposit_coin_batch(self, deposit_records, pbr):
+        return self.__run(self.__client.deposit_coin_batch(deposit_records, wire_width(pbr)))
+
+    def balance_for_merchant_account(self, merchant_account_id):
+        return self.__run(self.__client.call('balance_for_merchant_account', merchant_account_id))
+
+    def balance_for_spender_account(self, I):
+        return self.__run(self.__client.call('balance_for_spender_account', I))
+
+def serve_in_background(bnk, pbr, host='127.0.0.1', port=0, path=None, num_verifiers=None,
+                        num_bank_threads=1, max_requests_in_flight=64):
+    """
+    Run a bank_server for bnk on its own event loop thread, e.g., for
+    loopback tests. Returns the server's address and a function that
+    stops the server.
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    server = bank_server(bnk, pbr, num_verifiers, num_bank_threads, max_requests_in_flight)
+    address = asyncio.run_coroutine_threadsafe(server.start(host, port, path), loop).result()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    return address, stop
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#############################################################
+# module: nonces.py
+# descrip: the bank's pool of w nonces and their powers g^w
+# for the withdrawal protocol (cf. Slide 21).
+# bugs to vladimir kulyukin via canvas
+##############################################################
+
+import collections
+import secrets
+import threading
+import time
+
+class nonce_pool(object):
+    """
+    A pool of (w, g^w) pairs with w drawn uniformly from [1, q-1] by
+    the OS CSPRNG. g^w is computed with the fixed-base table g_table of
+    g ahead of demand by a background thread, which refills the pool to
+    capacity when it falls below half of it, so take() usually costs no
+    exponentiation.
+
+    A taken pair is issued until its gw is redeemed for a c1 or ttl
+    seconds pass, after which it expires, so the pool's memory stays
+    bounded by the pairs issued in the last ttl seconds. A gw can be
+    redeemed only once, because two c1s for the same w would reveal the
+    bank's secret x. No w is issued twice while it is issued or ready.
+    """
+
+    def __init__(self, g_table, q, capacity=256, ttl=300.0, background=True, clock=time.monotonic):
+        ### the modulus of the group of the nonces.
+        self.p = g_table.p
+        self.__g_table = g_table
+        self.__q = q
+        ### a toy group has only q-1 nonces.
+        self.__capacity = max(1, min(capacity, (q - 1) // 4))
+        self.__low = max(1, self.__capacity // 2)
+        self.__ttl = ttl
+        self.__clock = clock
+        self.__background = background
+        self.__ready = collections.deque()
+        self.__ready_gws = set()
+        ### gw -> (w, deadline) in the order of issue, so that
+        ### the expired pairs are at the front.
+        self.__issued = collections.OrderedDict()
+        self.__cond = threading.Condition()
+        self.__thread = None
+        self.__closed = False
+        self.__hits = 0
+        self.__misses = 0
+        self.__redeemed = 0
+        self.__expired = 0
+
+    def __fresh_pair(self):
+        w = secrets.randbelow(self.__q - 1) + 1
+        return w, self.__g_table.exp(w)
+
+    def __is_unused(self, gw):
+        return gw not in self.__ready_gws and gw not in self.__issued
+
+    def __is_exhausted(self):
+        return len(self.__ready) + len(self.__issued) >= self.__q - 2
+
+    def __expire(self):
+        now = self.__clock()
+        issued = self.__issued
+        while issued:
+            gw, (w, deadline) = next(iter(issued.items()))
+            if deadline > now:
+                break
+            del issued[gw]
+            self.__expired += 1
+
+    def fill(self):
+        """
+        fill the pool to capacity in the calling thread.
+        """
+        while True:
+            with self.__cond:
+                if len(self.__ready) >= self.__capacity or self.__is_exhausted():
+                    return
+            w, gw = self.__fresh_pair()
+            with self.__cond:
+                if self.__is_unused(gw):
+                    self.__ready.append((w, gw))
+                    self.__ready_gws.add(gw)
+
+    def __refill(self):
+        while True:
+            with self.__cond:
+                while not self.__closed and len(self.__ready) >= self.__low:
+                    self.__cond.wait()
+                if self.__closed:
+                    return
+            self.fill()
+            with self.__cond:
+                if self.__is_exhausted() and not self.__closed:
+                    self.__cond.wait()
+
+    def take(self):
+        """
+        issue a fresh (w, gw) pair.
+        """
+        with self.__cond:
+            self.__expire()
+            if self.__background and len(self.__ready) <= self.__low:
+                if self.__thread is None:
+                    self.__thread = threading.Thread(target=self.__refill, daemon=True)
+                    self.__thread.start()
+                self.__cond.notify()
+            if self.__ready:
+                w, gw = self.__ready.popleft()
+                self.__ready_gws.discard(gw)
+                self.__hits += 1
+                return self.__issue(w, gw)
+            self.__misses += 1
+        while True:
+            w, gw = self.__fresh_pair()
+            with self.__cond:
+                if self.__is_exhausted():
+                    raise RuntimeError('all {} nonces of Z_q are in use'.format(self.__q - 1))
+                if self.__is_unused(gw):
+                    return self.__issue(w, gw)
+
+    def __issue(self, w, gw):
+        self.__issued[gw] = (w, self.__clock() + self.__ttl)
+        return w, gw
+
+    def redeem(self, gw):
+        """
+        the w of the issued gw, which is no longer issued, or None if gw
+        is not issued, e.g., because it has been redeemed or has expired.
+        """
+        ws = self.redeem_all((gw,))
+        return None if ws is None else ws[0]
+
+    def redeem_all(self, gws):
+        """
+        the ws of all gws in gws, or None, and nothing is redeemed, if
+        some gw is not issued or occurs twice.
+        """
+        with self.__cond:
+            self.__expire()
+            if len(set(gws)) != len(gws) or not all(gw in self.__issued for gw in gws):
+                return None
+            ws = [self.__issued.pop(gw)[0] for gw in gws]
+            self.__redeemed += len(ws)
+            self.__cond.notify()
+            return ws
+
+    def stats(self):
+        """
+        the numbers of ready and issued pairs, of pairs taken from the
+        pool (hits) and computed on demand (misses), and of pairs
+        redeemed and expired.
+        """
+        with self.__cond:
+            return {'ready': len(self.__ready), 'issued': len(self.__issued),
+                    'hits': self.__hits, 'misses': self.__misses,
+                    'redeemed': self.__redeemed, 'expired': self.__expired}
+
+    def close(self):
+        """
+        stop the background thread.
+        """
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify_all()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
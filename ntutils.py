@@ -3,7 +3,9 @@
 # number theory utils 
 ########################################
 
+import bisect
 import math
+import random
 
 def xgcd(a,b):
     ''' 
@@ -34,14 +36,40 @@ def mult_inv(a, n):
     else:
         return x
 
-def is_primitive_root_of_p(r, p):
+def jacobi(a, n):
+    """
+    the Jacobi symbol (a/n) for odd n > 0. For a prime n, it is the
+    Legendre symbol: 1 if a is a nonzero quadratic residue mod n,
+    -1 if a is a nonresidue, and 0 if n divides a.
+    """
+    assert n > 0 and n % 2 == 1
+    a %= n
+    rslt = 1
+    while a:
+        while a % 2 == 0:
+            a //= 2
+            if n % 8 in (3, 5):
+                rslt = -rslt
+        a, n = n, a
+        if a % 4 == 3 and n % 4 == 3:
+            rslt = -rslt
+        a %= n
+    return rslt if n == 1 else 0
+
+def is_primitive_root_of_p(r, p, p_minus_1_factors=None):
     """
     Is r and primitive root of prime p?
+    r is a primitive root iff r^((p-1)/f) != 1 (mod p) for
+    every prime factor f of p-1. p_minus_1_factors are the
+    prime factors of p-1, if known (e.g., (2, q) for p = 2q+1).
     """
-    assert is_prime(p)
-    equiv_classes = set(r**i % p for i in range(1, p))
-    for i in range(1, p):
-        if not i in equiv_classes:
+    assert is_probable_prime(p)
+    if r % p == 0:
+        return False
+    if p_minus_1_factors is None:
+        p_minus_1_factors = prime_factors(p-1)
+    for f in set(p_minus_1_factors):
+        if pow(r, (p-1)//f, p) == 1:
             return False
     return True
 
@@ -51,44 +79,169 @@ def find_primitive_roots_of_p(p):
     """
     return set(r for r in range(1, p) if is_primitive_root_of_p(r, p))
 
-def is_prime(n):
+def primes_up_to(n):
+    """
+    all primes <= n computed with the sieve of Eratosthenes.
+    """
+    if n < 2:
+        return []
+    sieve = bytearray([1]) * (n+1)
+    sieve[0] = sieve[1] = 0
+    for d in range(2, math.isqrt(n)+1):
+        if sieve[d]:
+            sieve[d*d::d] = bytes(len(range(d*d, n+1, d)))
+    return [i for i in range(n+1) if sieve[i]]
+
+SMALL_PRIMES = primes_up_to(1000)
+
+### Miller-Rabin with these bases is deterministic for all n < 2^64.
+MR_BASES_64 = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)
+
+def miller_rabin(n, bases):
+    """
+    Miller-Rabin test of odd n > 2 for each base in bases.
+    Returns False if some base witnesses that n is composite.
+    """
+    d, s = n-1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    for a in bases:
+        a %= n
+        if a in (0, 1, n-1):
+            continue
+        x = pow(a, d, n)
+        if x == 1 or x == n-1:
+            continue
+        for _ in range(s-1):
+            x = (x * x) % n
+            if x == n-1:
+                break
+        else:
+            return False
+    return True
+
+def is_probable_prime(n, rounds=40):
+    """
+    Is n a prime with the error probability at most 4^(-rounds)?
+    Trial division by small primes is followed by Miller-Rabin
+    with random bases.
+    """
     if n < 2:
         return False
-    if n == 2:
+    for sp in SMALL_PRIMES:
+        if n % sp == 0:
+            return n == sp
+    if n < SMALL_PRIMES[-1]**2:
         return True
-    if n % 2 == 0:
+    rng = random.SystemRandom()
+    return miller_rabin(n, (rng.randrange(2, n-1) for _ in range(rounds)))
+
+def is_prime(n):
+    """
+    Is n a prime? The answer is exact for n < 2^64 (deterministic
+    Miller-Rabin) and holds with the error probability at most 4^(-40)
+    for larger n.
+    """
+    if n < 2:
         return False
-    if n > 2:
-        for d in range(3, int(math.floor(math.sqrt(n)))+1, 2):
-            if n % d == 0:
-                return False
-        return True
+    if n < 2**64:
+        for sp in MR_BASES_64:
+            if n % sp == 0:
+                return n == sp
+        return miller_rabin(n, MR_BASES_64)
+    return is_probable_prime(n)
+
+### the cache of all primes <= _sieve_limit. It is extended
+### with a segmented sieve by _extend_prime_cache().
+_prime_cache = [2, 3, 5, 7]
+_sieve_limit = 10
+
+def _sieve_segment(lo, hi):
+    """
+    the primes in [lo, hi] sieved with the cached primes, which
+    must include all primes <= sqrt(hi).
+    """
+    segment = bytearray([1]) * (hi - lo + 1)
+    for bp in _prime_cache:
+        if bp * bp > hi:
+            break
+        start = max(bp * bp, ((lo + bp - 1) // bp) * bp)
+        segment[start-lo::bp] = bytes(len(range(start, hi+1, bp)))
+    return [lo + i for i in range(len(segment)) if segment[i]]
+
+def _extend_prime_cache(n):
+    """
+    extend the prime cache so that it contains all primes <= n.
+    Each segment ends at most at the square of the sieved limit
+    so that the cache already holds its base primes.
+    """
+    global _sieve_limit
+    while _sieve_limit < n:
+        hi = min(max(n, 2*_sieve_limit), _sieve_limit**2)
+        _prime_cache.extend(_sieve_segment(_sieve_limit + 1, hi))
+        _sieve_limit = hi
 
 def ith_prime(i):
+    """
+    the i-th prime, i >= 1, looked up in the prime cache.
+    """
     assert i > 0
-    pcount = 0
-    pi = 0
-    n = 1
-    while pcount < i:
-        if is_prime(n):
-            pcount += 1
-            pi = n
-        n += 1
-    return pi
-
-def prime_factors_aux(n, i):
-    if is_prime(n):
-        return [n]
-    else:
-        pi = ith_prime(i)
-        if n % pi == 0:
-            return [pi] + prime_factors_aux(n//pi, i)
-        else:
-            return prime_factors_aux(n, i+1)
+    while len(_prime_cache) < i:
+        _extend_prime_cache(2 * _sieve_limit)
+    return _prime_cache[i-1]
+
+def pollard_rho(n):
+    """
+    a nontrivial factor of an odd composite n found with
+    Brent's variant of Pollard's rho.
+    """
+    rng = random.SystemRandom()
+    while True:
+        y, c, m = rng.randrange(1, n), rng.randrange(1, n), 128
+        d, r, prod = 1, 1, 1
+        while d == 1:
+            x = y
+            for _ in range(r):
+                y = (y*y + c) % n
+            k = 0
+            while k < r and d == 1:
+                ys = y
+                for _ in range(min(m, r-k)):
+                    y = (y*y + c) % n
+                    prod = (prod * abs(x - y)) % n
+                d = math.gcd(prod, n)
+                k += m
+            r *= 2
+        if d == n:
+            ### the batched gcd overshot; backtrack one step at a time.
+            d = 1
+            while d == 1:
+                ys = (ys*ys + c) % n
+                d = math.gcd(abs(x - ys), n)
+        if d != n:
+            return d
 
 def prime_factors(n):
+    """
+    the prime factors of n > 1 in ascending order with multiplicities.
+    Small factors are found by trial division, the rest by Pollard's rho.
+    """
     assert n > 1
-    return prime_factors_aux(n, 1)
+    factors = []
+    for sp in SMALL_PRIMES:
+        while n % sp == 0:
+            factors.append(sp)
+            n //= sp
+    stack = [n] if n > 1 else []
+    while stack:
+        m = stack.pop()
+        if is_prime(m):
+            factors.append(m)
+        else:
+            d = pollard_rho(m)
+            stack.extend((d, m // d))
+    return sorted(factors)
         
 def gen_perms(nums, n):
     if n == 0:
@@ -104,29 +257,37 @@ def gen_perms(nums, n):
     
 ### the range is inclusive [a, b]
 def find_primes_in_range(a, b):
+    """
+    Ranges below 2^24 are served from the prime cache. Larger ranges
+    are sieved in one segment if they are narrow enough, and tested
+    one number at a time otherwise.
+    """
+    a = max(a, 2)
+    if b < a:
+        return []
+    if b < (1 << 24):
+        _extend_prime_cache(b)
+        return _prime_cache[bisect.bisect_left(_prime_cache, a):bisect.bisect_right(_prime_cache, b)]
+    if b - a < (1 << 24) and math.isqrt(b) < (1 << 24):
+        _extend_prime_cache(math.isqrt(b))
+        return _sieve_segment(a, b)
     return [i for i in range(a, b+1) if is_prime(i)]
 
 def find_n_digit_primes_in_range(a, b, n):
-    return [i for i in find_primes_in_range2(a, b) if len(str(i)) == n]
+    return [i for i in find_primes_in_range(a, b) if len(str(i)) == n]
 
 def euler_phi(n):
+    """
+    Euler's phi computed from the distinct prime factors of n.
+    """
     assert n >= 2
-    rslt = 1
-    for p in range(n+1):
-        if is_prime2(p) and n % p == 0:
-            rslt *= (p - 1)/p
-    eu_phi = n * rslt
-    f = math.floor(eu_phi)
-    c = math.ceil(eu_phi)
-    fdiff = abs(eu_phi - f)
-    cdiff = abs(eu_phi - c)
-    if fdiff < cdiff:
-        return f
-    else:
-        return c
+    eu_phi = n
+    for p in set(prime_factors(n)):
+        eu_phi = eu_phi // p * (p - 1)
+    return eu_phi
 
 def euler_totient(n):
-    return eulers_phi(n)
+    return euler_phi(n)
 
     
 if __name__ == '__main__':
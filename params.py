@@ -0,0 +1,279 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#############################################################
+# module: params.py
+# descrip: a frozen snapshot of the public parameters
+# published by the Authority and the Bank, with the fixed-base
+# tables of the published bases, which can be placed in shared
+# memory so that worker processes attach to it instead of
+# rebuilding the tables.
+# bugs to vladimir kulyukin via canvas
+##############################################################
+
+import os
+import struct
+import sys
+from multiprocessing import shared_memory, resource_tracker
+from auth import group_hash
+from grputils import mod_exp, element_width, encode_elements, fixed_base_table
+from timesrc import time_source, counter_allocator
+
+### The shared memory block of a snapshot is
+###   header (12 bytes): magic (4) version (1) window (1) width (2) num_rows (4)
+###   p q g g1 g2 h h1 h2              (8 elements of width bytes)
+###   the hash functions H and H0      (name length (1) name memo_size (4) each)
+###   the tables of g g1 g2 h h1 h2    (num_rows * 2^window elements each)
+MAGIC = b'DCPS'
+VERSION = 1
+HEADER = struct.Struct('>4sBBHI')
+_HASH = struct.Struct('>I')
+
+### the counter allocators of the time stamps of the blocks shared by
+### this process, by block name. A forked process inherits them, so
+### the snapshots it attaches take their stamps from the parent's
+### allocator.
+_allocators = {}
+
+### before Python 3.13, SharedMemory has no track argument, and on POSIX
+### attaching to a block registers it with the resource tracker, which
+### unlinks it when the attaching process exits. The tracker knows a block on
+### POSIX by its name with a leading slash, as shared_memory opens it.
+_ATTACH_REGISTERS = sys.version_info < (3, 13) and os.name == 'posix'
+
+class params(object):
+    """
+    The public parameters p, q, g, g1, g2, H, H0 of the Authority and
+    h, h1, h2 of the Bank, and the fixed-base tables of the published
+    bases. A params has the getters of a pubrepo, so it can be passed
+    as pbr to all parties, but it cannot be changed after it is made.
+    The time stamps of get_time come from clock, which is the only
+    state that is not frozen. The fields that the coin checks read are
+    bound once, when the snapshot is made.
+    """
+
+    __slots__ = ('p', 'q', 'g', 'g1', 'g2', 'h', 'h1', 'h2', 'H', 'H0',
+                 '_params__tables', '_params__verification', '_params__clock', '_params__block')
+
+    def __init__(self, p, q, g, g1, g2, h, h1, h2, H, H0, tables=None, clock=None, block=None):
+        """
+        tables maps the published bases to their fixed-base tables;
+        the missing ones are built here. block is the name of the
+        shared memory block the snapshot was attached from, if any.
+        """
+        tables = dict(tables or {})
+        for base in (g, g1, g2, h, h1, h2):
+            if base not in tables:
+                tables[base] = fixed_base_table(base, p, q)
+        verification = (p, q, H, tables[g], tables[h], tables[g1], tables[g2])
+        for name, x in (('p', p), ('q', q), ('g', g), ('g1', g1), ('g2', g2),
+                        ('h', h), ('h1', h1), ('h2', h2), ('H', H), ('H0', H0),
+                        ('_params__tables', tables),
+                        ('_params__verification', verification),
+                        ('_params__clock', clock if clock is not None else time_source()),
+                        ('_params__block', block)):
+            object.__setattr__(self, name, x)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('params are frozen')
+
+    def __delattr__(self, name):
+        raise AttributeError('params are frozen')
+
+    @classmethod
+    def of(cls, pbr):
+        """
+        the snapshot of the public repo pbr, whose h, h1, h2 must be
+        published. It shares pbr's fixed-base tables and time source.
+        """
+        assert pbr.get_h2() is not None, 'the Bank has not published h, h1, h2'
+        pbr.precompute_fixed_base_tables()
+        bases = (pbr.get_g(), pbr.get_g1(), pbr.get_g2(), pbr.get_h(), pbr.get_h1(), pbr.get_h2())
+        return cls(pbr.get_p(), pbr.get_q(), *bases, pbr.get_H(), pbr.get_H0(),
+                   {base: pbr.get_fixed_base_table(base) for base in bases}, pbr.get_time_source())
+
+    def __reduce__(self):
+        ### an attached snapshot is pickled as the name of its block,
+        ### other snapshots with their tables. The clock stays behind.
+        if self.__block is not None:
+            return (attach_params, (self.__block,))
+        return (params, (self.p, self.q, self.g, self.g1, self.g2, self.h, self.h1, self.h2,
+                         self.H, self.H0, self.__tables))
+
+    def get_p(self):
+        return self.p
+
+    def get_q(self):
+        return self.q
+
+    def get_g(self):
+        return self.g
+
+    def get_g1(self):
+        return self.g1
+
+    def get_g2(self):
+        return self.g2
+
+    def get_h(self):
+        return self.h
+
+    def get_h1(self):
+        return self.h1
+
+    def get_h2(self):
+        return self.h2
+
+    def get_H(self):
+        return self.H
+
+    def get_H0(self):
+        return self.H0
+
+    def get_time(self):
+        return self.__clock()
+
+    def get_verification_params(self):
+        """
+        (p, q, H, and the fixed-base tables of g, h, g1, g2), which
+        the coin checks read, as bound when the snapshot was made.
+        """
+        return self.__verification
+
+    def get_fixed_base_table(self, base):
+        """
+        The fixed-base table of the published base g, g1, g2, h, h1, or
+        h2, or None for bases that are not published.
+        """
+        return self.__tables.get(base)
+
+    def precompute_fixed_base_tables(self):
+        """
+        The tables are built with the snapshot.
+        """
+        pass
+
+    def fixed_base_exp(self, base, e):
+        """
+        base^e (mod p) with the fixed-base table of base if it is published.
+        """
+        tab = self.__tables.get(base)
+        if tab is None:
+            return mod_exp(base, e, self.p)
+        return tab.exp(e)
+
+    def share(self, name=None):
+        """
+        Copy the snapshot into a new shared memory block. Returns its
+        shared_params, whose name is passed to attach_params in other
+        processes, and whose params take their time stamps from the
+        same shared allocator as the attached snapshots. The caller
+        unlinks the block when they are done.
+        """
+        return shared_params(self, name)
+
+class shared_params(object):
+    """
+    The shared memory block of a params snapshot, owned by the process
+    that created it. Its allocator is a shared counter_allocator of the
+    time stamps of the processes that attach to the block, and its
+    params is the snapshot with the time stamps of the allocator, which
+    this process uses so that its stamps do not collide with theirs.
+    """
+
+    def __init__(self, prm, name=None):
+        width = element_width(prm.p)
+        bases = (prm.g, prm.g1, prm.g2, prm.h, prm.h1, prm.h2)
+        tables = [prm.get_fixed_base_table(base) for base in bases]
+        window, num_rows = tables[0].window, len(tables[0].rows)
+        assert all(tab.window == window and len(tab.rows) == num_rows for tab in tables)
+        parts = [HEADER.pack(MAGIC, VERSION, window, width, num_rows),
+                 encode_elements((prm.p, prm.q, prm.g, prm.g1, prm.g2, prm.h, prm.h1, prm.h2), width)]
+        for H in (prm.H, prm.H0):
+            name_bytes = H.name.encode('ascii')
+            parts.append(bytes((len(name_bytes),)) + name_bytes + _HASH.pack(H.memo_size))
+        for tab in tables:
+            parts.extend(encode_elements(row, width) for row in tab.rows)
+        data = b''.join(parts)
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=len(data))
+        self.shm.buf[:len(data)] = data
+        self.name = self.shm.name
+        self.size = len(data)
+        self.allocator = counter_allocator(shared=True)
+        _allocators[self.name] = self.allocator
+        self.params = params(prm.p, prm.q, *bases, prm.H, prm.H0, dict(zip(bases, tables)),
+                             time_source(self.allocator))
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        """
+        free the block once every process has closed it.
+        """
+        _allocators.pop(self.name, None)
+        if _ATTACH_REGISTERS:
+            ### a process that attached to the block may have unregistered
+            ### it from the resource tracker they share, which unlink
+            ### expects to find it in.
+            resource_tracker.register('/' + self.shm.name, 'shared_memory')
+        self.shm.unlink()
+
+def attach_params(name, clock=None):
+    """
+    The params snapshot in the shared memory block name, made by
+    params.share in a parent process, e.g., in the initializer of a
+    process pool. Its tables are decoded from the block once, which
+    takes far less time than building them, and the block is closed
+    again. The block stays owned by the process that shared it: it is
+    not registered with this process's resource tracker, so this
+    process does not unlink it or warn about it on exit. The snapshot's
+    time stamps come from clock, by default from the allocator of the
+    block's shared_params, which a process forked from the one that
+    shared the block inherits, so that the stamps are unique across the
+    processes. Other processes, e.g., spawned ones, pass a clock of that
+    allocator, e.g., timesrc.time_source(shared.allocator) handed to
+    them when they start.
+    """
+    if clock is None:
+        allocator = _allocators.get(name)
+        if allocator is None:
+            raise ValueError('{} was not shared by this process or its parent; pass a clock'.format(name))
+        clock = time_source(allocator)
+    if sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        shm = shared_memory.SharedMemory(name=name)
+        if _ATTACH_REGISTERS:
+            resource_tracker.unregister('/' + shm.name, 'shared_memory')
+    try:
+        return _decode_params(shm.buf, name, clock)
+    finally:
+        shm.close()
+
+def _decode_params(buf, name, clock):
+    magic, version, window, width, num_rows = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('{} is not a params block of version {}'.format(name, VERSION))
+    offset = HEADER.size
+    p, q, g, g1, g2, h, h1, h2 = (int.from_bytes(buf[i:i+width], 'big')
+                                  for i in range(offset, offset + 8*width, width))
+    offset += 8*width
+    hashes = []
+    for _ in range(2):
+        n = buf[offset]
+        hash_name = bytes(buf[offset+1:offset+1+n]).decode('ascii')
+        memo_size, = _HASH.unpack_from(buf, offset+1+n)
+        hashes.append(group_hash(q, p, hash_name, memo_size))
+        offset += 1 + n + _HASH.size
+    row_size = (1 << window) * width
+    nbits = q.bit_length()
+    tables = {}
+    for base in (g, g1, g2, h, h1, h2):
+        rows = []
+        for _ in range(num_rows):
+            rows.append([int.from_bytes(buf[i:i+width], 'big')
+                         for i in range(offset, offset + row_size, width)])
+            offset += row_size
+        tables[base] = fixed_base_table.of_rows(base, p, q, nbits, window, rows)
+    return params(p, q, g, g1, g2, h, h1, h2, hashes[0], hashes[1], tables, clock, name)
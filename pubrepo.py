@@ -8,6 +8,9 @@
 # bugs to vladimir kulyukin via canvas
 ##############################################################
 
+from grputils import mod_exp, fixed_base_table
+from timesrc import time_source
+
 class pubrepo(object):
     
     def __init__(self):
@@ -20,8 +23,9 @@ class pubrepo(object):
         self.g2 = None
         self.H = None
         self.H0 = None
-        ## we start the time count at 1
-        self.__time = 1
+        ## we start the time count at 1. The stamps are leased
+        ## in blocks, so threads do not contend for them.
+        self.__time_source = time_source()
         
         ### h, h1, h2 are the parameters
         ### published by the Bank
@@ -29,31 +33,40 @@ class pubrepo(object):
         self.h1 = None
         self.h2 = None
 
+        ### fixed-base tables for the published bases
+        ### built on first use and keyed by the base.
+        self.__fb_tables = {}
+
     def set_p(self, p):
         self.p = p
+        self.__fb_tables.clear()
 
     def get_p(self):
         return self.p
 
     def set_q(self, q):
         self.q = q
+        self.__fb_tables.clear()
 
     def get_q(self):
         return self.q
 
     def set_g(self, g):
+        self.__fb_tables.pop(self.g, None)
         self.g = g
 
     def get_g(self):
         return self.g
 
     def set_g1(self, g1):
+        self.__fb_tables.pop(self.g1, None)
         self.g1 = g1
 
     def get_g1(self):
         return self.g1
 
     def set_g2(self, g2):
+        self.__fb_tables.pop(self.g2, None)
         self.g2 = g2
 
     def get_g2(self):
@@ -72,42 +85,81 @@ class pubrepo(object):
         return self.H0
 
     def set_h(self, h):
+        self.__fb_tables.pop(self.h, None)
         self.h = h
 
     def get_h(self):
         return self.h
 
     def set_h1(self, h1):
+        self.__fb_tables.pop(self.h1, None)
         self.h1 = h1
 
     def get_h1(self):
         return self.h1
 
     def set_h2(self, h2):
+        self.__fb_tables.pop(self.h2, None)
         self.h2 = h2
 
     def get_h2(self):
         return self.h2
 
     def get_time(self):
-        t = self.__time
-        self.__time += 1
-        return t
-    
-
-
-
-
-    
-
-    
-
-    
-
-
-
-        
-        
-
-
-
+        return self.__time_source()
+
+    def set_time_source(self, src):
+        """
+        src() returns a fresh time stamp, e.g., a timesrc.time_source
+        with a wall_clock_allocator in production.
+        """
+        self.__time_source = src
+
+    def get_time_source(self):
+        return self.__time_source
+
+    def get_fixed_base_table(self, base):
+        """
+        The fixed-base table for the published base g, g1, g2, h, h1, or h2.
+        Tables are built on first use and cached until the base or the
+        group is republished. Returns None for bases that are not published.
+        """
+        tab = self.__fb_tables.get(base)
+        if tab is None and base is not None and \
+           base in (self.g, self.g1, self.g2, self.h, self.h1, self.h2):
+            tab = fixed_base_table(base, self.p, self.q)
+            self.__fb_tables[base] = tab
+        return tab
+
+    def get_verification_params(self):
+        """
+        (p, q, H, and the fixed-base tables of g, h, g1, g2), which the
+        coin checks read. The repo can change, so they are looked up on
+        every call; a snapshot binds them once.
+        """
+        tab = self.get_fixed_base_table
+        return (self.p, self.q, self.H, tab(self.g), tab(self.h), tab(self.g1), tab(self.g2))
+
+    def precompute_fixed_base_tables(self):
+        """
+        Build the tables for all published bases ahead of use.
+        """
+        for base in (self.g, self.g1, self.g2, self.h, self.h1, self.h2):
+            self.get_fixed_base_table(base)
+
+    def fixed_base_exp(self, base, e):
+        """
+        base^e (mod p) with the fixed-base table of base if it is published.
+        """
+        tab = self.get_fixed_base_table(base)
+        if tab is None:
+            return mod_exp(base, e, self.p)
+        return tab.exp(e)
+
+    def snapshot(self):
+        """
+        the frozen params.params of the published parameters and their
+        fixed-base tables, which keeps using this repo's time source.
+        """
+        from params import params
+        return params.of(self)
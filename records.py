@@ -0,0 +1,224 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#############################################################
+# module: records.py
+# descrip: immutable records of coins, coin signatures, secret
+# 5-tuples, withdrawal blindings, and deposits, and the
+# array-backed account tables of the bank.
+# bugs to vladimir kulyukin via canvas
+##############################################################
+
+from array import array
+from wire import coin_digest, pack_coin, unpack_coin, pack_signature, unpack_signature
+
+def coin_id(coin):
+    """
+    the digest of the coin, which is kept by a coin_record.
+    """
+    return coin.digest() if type(coin) is coin_record else coin_digest(coin)
+
+class _record(object):
+    """
+    An immutable record with a fixed set of fields in __slots__ and no
+    __dict__. It behaves like the tuple of its fields: it can be
+    unpacked, indexed, compared and hashed with that tuple. Its fields
+    cannot be changed after it is made, so its hash, and the digest of
+    a coin_record, stay valid, e.g., as a key of the ledger.
+    """
+
+    __slots__ = ()
+    _fields = ()
+
+    def _init(self, *values):
+        """
+        set the fields to values; called by __init__ only.
+        """
+        for name, x in zip(self._fields, values):
+            object.__setattr__(self, name, x)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is immutable'.format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError('{} is immutable'.format(type(self).__name__))
+
+    @classmethod
+    def of(cls, xs):
+        """
+        xs itself if it is a record of this class, else the record of
+        the fields in the sequence xs.
+        """
+        return xs if type(xs) is cls else cls(*xs)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __getitem__(self, i):
+        if type(i) is int:
+            return getattr(self, self._fields[i])
+        return tuple(self)[i]
+
+    def __eq__(self, other):
+        try:
+            return len(other) == len(self._fields) and tuple(self) == tuple(other)
+        except TypeError:
+            return NotImplemented
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __reduce__(self):
+        return (type(self), tuple(self))
+
+    def __repr__(self):
+        return repr(tuple(self))
+
+class coin_record(_record):
+    """
+    the coin (A,B,z,a,b,r). Its digest is computed once and kept.
+    """
+
+    __slots__ = ('A', 'B', 'z', 'a', 'b', 'r', '_digest')
+    _fields = ('A', 'B', 'z', 'a', 'b', 'r')
+
+    def __init__(self, A, B, z, a, b, r):
+        self._init(A, B, z, a, b, r)
+        object.__setattr__(self, '_digest', None)
+
+    def __iter__(self):
+        return iter((self.A, self.B, self.z, self.a, self.b, self.r))
+
+    def head(self):
+        """
+        (A,B,z,a,b), the input of H.
+        """
+        return (self.A, self.B, self.z, self.a, self.b)
+
+    def digest(self):
+        """
+        wire.coin_digest() of the coin.
+        """
+        if self._digest is None:
+            object.__setattr__(self, '_digest', coin_digest(self))
+        return self._digest
+
+    def pack(self, width):
+        return pack_coin(self, width)
+
+    @classmethod
+    def unpack(cls, buf, width, offset=0):
+        return cls(*unpack_coin(buf, width, offset))
+
+class signature_record(_record):
+    """
+    the coin signature (r1,r2,d).
+    """
+
+    __slots__ = ('r1', 'r2', 'd')
+    _fields = __slots__
+
+    def __init__(self, r1, r2, d):
+        self._init(r1, r2, d)
+
+    def __iter__(self):
+        return iter((self.r1, self.r2, self.d))
+
+    def pack(self, width):
+        return pack_signature(self, width)
+
+    @classmethod
+    def unpack(cls, buf, width, offset=0):
+        return cls(*unpack_signature(buf, width, offset))
+
+class secret_record(_record):
+    """
+    the spender's secret random 5-tuple (s,x1,x2,alpha1,alpha2) of a coin.
+    """
+
+    __slots__ = ('s', 'x1', 'x2', 'alpha1', 'alpha2')
+    _fields = __slots__
+
+    def __init__(self, s, x1, x2, alpha1, alpha2):
+        self._init(s, x1, x2, alpha1, alpha2)
+
+    def __iter__(self):
+        return iter((self.s, self.x1, self.x2, self.alpha1, self.alpha2))
+
+class blinding_record(_record):
+    """
+    The spender's withdrawal work for one coin that does not depend on
+    the bank's gw and beta (cf. Slides 22, 23): the secret 5-tuple, A,
+    B, z, g^alpha2, A^alpha2, and alpha1^{-1} (mod q).
+    """
+
+    __slots__ = ('secret', 'A', 'B', 'z', 'g_alpha2', 'A_alpha2', 'alpha1_inv')
+    _fields = __slots__
+
+    def __init__(self, secret, A, B, z, g_alpha2, A_alpha2, alpha1_inv):
+        self._init(secret_record.of(secret), A, B, z, g_alpha2, A_alpha2, alpha1_inv)
+
+    def __iter__(self):
+        return iter((self.secret, self.A, self.B, self.z, self.g_alpha2, self.A_alpha2, self.alpha1_inv))
+
+class deposit_record(_record):
+    """
+    the deposit (merchant_id, coin, coin_signature) of a coin by a
+    merchant, as in a wire batch of deposit records.
+    """
+
+    __slots__ = ('merchant_id', 'coin', 'coin_signature')
+    _fields = __slots__
+
+    def __init__(self, merchant_id, coin, coin_signature):
+        self._init(merchant_id, coin_record.of(coin), signature_record.of(coin_signature))
+
+    def __iter__(self):
+        return iter((self.merchant_id, self.coin, self.coin_signature))
+
+class account_table(object):
+    """
+    A table of account balances. A dict maps each account id to its
+    slot, and the balances are 64-bit signed ints in one array, so a
+    balance takes 8 bytes and is updated in place without allocating
+    an int object.
+    """
+
+    __slots__ = ('__slots', '__balances')
+
+    def __init__(self):
+        self.__slots = {}
+        self.__balances = array('q')
+
+    def __contains__(self, account_id):
+        return account_id in self.__slots
+
+    def __len__(self):
+        return len(self.__slots)
+
+    def __iter__(self):
+        return iter(self.__slots)
+
+    def __getitem__(self, account_id):
+        return self.__balances[self.__slots[account_id]]
+
+    def __setitem__(self, account_id, balance):
+        i = self.__slots.get(account_id)
+        if i is None:
+            self.__slots[account_id] = len(self.__balances)
+            self.__balances.append(balance)
+        else:
+            self.__balances[i] = balance
+
+    def add(self, account_id, amount):
+        """
+        add amount to the balance of the existing account and
+        return the new balance.
+        """
+        i = self.__slots[account_id]
+        self.__balances[i] += amount
+        return self.__balances[i]
+
+    def items(self):
+        balances = self.__balances
+        return ((account_id, balances[i]) for account_id, i in self.__slots.items())
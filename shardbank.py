@@ -0,0 +1,250 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#############################################################
+# module: shardbank.py
+# descrip: a bank whose coin deposits are verified by worker
+# processes, each of which owns one shard of the spent coins.
+# bugs to vladimir kulyukin via canvas
+##############################################################
+
+import multiprocessing
+import threading
+from bank import bank, batch_verify_coin_deposits, compute_double_spender_id, group_of
+from bank import CREDITED, REJECTED, DOUBLE_SPENT, DEPOSIT_COUNTERS
+from ledger import memory_ledger
+from records import coin_id, deposit_record
+from wire import iter_deposit_record_chunks
+from metrics import trace, timed, DEBUG
+
+def shard_of_coin(coin, num_shards):
+    """
+    the shard of the coin: its digest's first 8 bytes mod num_shards.
+    """
+    return int.from_bytes(coin_id(coin)[:8], 'big') % num_shards
+
+def memory_ledger_factory(shard):
+    return memory_ledger()
+
+def _deposit_worker(conn, shard, ledger_factory, pbr):
+    """
+    The loop of the worker process for one shard. It receives
+    (op, coins_with_signatures, valid) requests. For op 'spent', it
+    sends back whether each coin is in the shard's ledger. For op
+    'deposit', it verifies the fresh coins in one batch, or takes
+    valid[i] as the outcome of the i-th pair's verification if valid
+    is not None, records the valid ones in the shard's ledger, and sends
+    back one (CREDITED | REJECTED | DOUBLE_SPENT, double_spender_id)
+    per pair.
+    """
+    ledger = ledger_factory(shard)
+    q = pbr.get_q()
+    while True:
+        req = conn.recv()
+        if req is None:
+            break
+        op, coins_with_signatures, valid = req
+        if op == 'spent':
+            conn.send([coin in ledger for coin, _ in coins_with_signatures])
+            continue
+        rslts = [None] * len(coins_with_signatures)
+        fresh = []
+        for i, (coin, coin_signature) in enumerate(coins_with_signatures):
+            spent_coin_sig = ledger.get(coin)
+            if spent_coin_sig is not None:
+                rslts[i] = (DOUBLE_SPENT, compute_double_spender_id(spent_coin_sig, coin_signature, q))
+            else:
+                fresh.append(i)
+        if valid is None:
+            valid = set(fresh[j] for j in batch_verify_coin_deposits([coins_with_signatures[i] for i in fresh],
+                                                                     pbr))
+        else:
+            valid = set(i for i in fresh if valid[i])
+        for i in fresh:
+            coin, coin_signature = coins_with_signatures[i]
+            spent_coin_sig = ledger.get(coin)
+            if i not in valid:
+                rslts[i] = (REJECTED, None)
+            elif spent_coin_sig is not None:
+                ### the same coin occurs twice in the list.
+                rslts[i] = (DOUBLE_SPENT, compute_double_spender_id(spent_coin_sig, coin_signature, q))
+            else:
+                ledger.put(coin, coin_signature)
+                rslts[i] = (CREDITED, None)
+        conn.send(rslts)
+    ledger.close()
+    conn.close()
+
+class sharded_bank(bank):
+    """
+    A bank that partitions the spent coins by coin digest across
+    num_shards worker processes. The withdrawal protocol and all accounts
+    stay in this process; the workers verify deposits and own the spent
+    coins of their shards, and this process credits the merchant accounts
+    from their results. Deposits keep the contract of
+    bank.deposit_coin_for_merchant.
+
+    ledger_factory(shard) creates the ledger of a shard in its worker,
+    e.g., lambda shard: sqlite_ledger('spent-{}.db'.format(shard)).
+    The workers are forked on the first deposit, so that they inherit
+    the public repo with its hash functions and fixed-base tables, and
+    they deposit coins only in its group. Every shard has a lock of its
+    own, so deposits to different shards run in parallel.
+    The spent coins are only in the shards, so is_coin_spent and
+    deposit_verified_coins, e.g., of a netbank.bank_server with
+    verifier processes, ask the shards as well.
+    """
+
+    def __init__(self, num_shards=None, ledger_factory=memory_ledger_factory):
+        bank.__init__(self)
+        self.__num_shards = num_shards or multiprocessing.cpu_count()
+        self.__ledger_factory = ledger_factory
+        self.__workers = []
+        self.__conns = []
+        ### the pipe to a shard carries one list of pairs at a time.
+        self.__shard_locks = [threading.Lock() for _ in range(self.__num_shards)]
+        ### the public repo and the group the workers were forked with.
+        self.__pbr = None
+        self.__group = None
+        self.__start_lock = threading.Lock()
+
+    def __start_workers(self, pbr):
+        if pbr is self.__pbr:
+            return
+        group = group_of(pbr)
+        with self.__start_lock:
+            if self.__group is None:
+                ctx = multiprocessing.get_context('fork')
+                workers, conns = [], []
+                for shard in range(self.__num_shards):
+                    parent_conn, child_conn = ctx.Pipe()
+                    worker = ctx.Process(target=_deposit_worker,
+                                         args=(child_conn, shard, self.__ledger_factory, pbr),
+                                         daemon=True)
+                    worker.start()
+                    child_conn.close()
+                    workers.append(worker)
+                    conns.append(parent_conn)
+                ### is_coin_spent sees either no shards or all of them.
+                self.__workers, self.__conns = workers, conns
+                self.__group = group
+            elif group != self.__group:
+                raise ValueError('the shards deposit coins in another group')
+            self.__pbr = pbr
+
+    def close(self):
+        """
+        stop the deposit workers and the nonce pool.
+        """
+        bank.close(self)
+        for conn in self.__conns:
+            conn.send(None)
+        for worker in self.__workers:
+            worker.join()
+        for conn in self.__conns:
+            conn.close()
+        self.__workers, self.__conns = [], []
+        self.__pbr, self.__group = None, None
+
+    def deposit_coin_for_merchant(self, merchant_id, coin, coin_signature, pbr):
+        return self.deposit_coins(merchant_id, ((coin, coin_signature),), pbr)[0]
+
+    def is_coin_spent(self, coin):
+        """
+        whether the coin is in the ledger of its shard. No coin is spent
+        before the workers are started by the first deposit.
+        """
+        if not self.__conns:
+            return False
+        shard = shard_of_coin(coin, self.__num_shards)
+        with self.__shard_locks[shard]:
+            conn = self.__conns[shard]
+            conn.send(('spent', [(coin, None)], None))
+            return conn.recv()[0]
+
+    @timed('shardbank.deposit_coins')
+    def deposit_coins(self, merchant_id, coins_with_signatures, pbr):
+        """
+        Deposit a list of (coin, coin_signature) pairs for the merchant.
+        The pairs are sent to their shards at once, so the shards verify
+        them in parallel. Returns one result per pair, as
+        deposit_coin_for_merchant would.
+        """
+        return self.deposit_verified_coins(merchant_id, coins_with_signatures, None, pbr)
+
+    def deposit_verified_coins(self, merchant_id, coins_with_signatures, valid, pbr):
+        """
+        bank.deposit_verified_coins with the pairs recorded by their
+        shards, which take valid[i] as the outcome of the verification
+        of the i-th pair. With valid None, the shards verify the pairs.
+        """
+        self.__start_workers(pbr)
+        coins_with_signatures = list(coins_with_signatures)
+        rslts = []
+        credited = 0
+        for status, double_spender_id in self.__deposit_to_shards(coins_with_signatures, valid):
+            if status == CREDITED:
+                rslts.append(merchant_id)
+                credited += 1
+            elif status == REJECTED:
+                rslts.append(-1)
+            else:
+                rslts.append(double_spender_id)
+        ### the shards' credits are aggregated in this process.
+        if credited:
+            self.credit_merchant_account(merchant_id, credited)
+        trace(DEBUG, 'Bank deposited {} of {} coins to merchant account {}',
+              credited, len(coins_with_signatures), merchant_id)
+        return rslts
+
+    def ingest_settlement_file(self, src, pbr, chunk_records=4096, batch_size=None):
+        """
+        bank.ingest_settlement_file with every chunk deposited by the
+        shards in parallel. batch_size is not used; each shard verifies
+        its part of a chunk in one batch.
+        """
+        self.__start_workers(pbr)
+        for chunk in iter_deposit_record_chunks(src, chunk_records):
+            recs = [deposit_record(*rec) for rec in chunk]
+            outcomes = self.__deposit_to_shards([(rec.coin, rec.coin_signature) for rec in recs])
+            credits = {}
+            for rec, (status, _) in zip(recs, outcomes):
+                if status == CREDITED:
+                    credits[rec.merchant_id] = credits.get(rec.merchant_id, 0) + 1
+            for merchant_id, credited in credits.items():
+                self.credit_merchant_account(merchant_id, credited)
+            for rec, (status, double_spender_id) in zip(recs, outcomes):
+                if status == CREDITED:
+                    yield status, rec, rec.merchant_id
+                elif status == REJECTED:
+                    yield status, rec, -1
+                else:
+                    yield status, rec, double_spender_id
+
+    def __deposit_to_shards(self, coins_with_signatures, valid=None):
+        """
+        the (status, double_spender_id) of every pair from its shard.
+        Only the shards of the pairs are locked, in increasing order,
+        so that deposits to other shards go on meanwhile.
+        """
+        n = self.__num_shards
+        by_shard = [[] for _ in range(n)]
+        for i, (coin, coin_signature) in enumerate(coins_with_signatures):
+            by_shard[shard_of_coin(coin, n)].append(i)
+        shards = [shard for shard, idxs in enumerate(by_shard) if idxs]
+        outcomes = [None] * len(coins_with_signatures)
+        for shard in shards:
+            self.__shard_locks[shard].acquire()
+        try:
+            for shard in shards:
+                idxs = by_shard[shard]
+                self.__conns[shard].send(('deposit', [coins_with_signatures[i] for i in idxs],
+                                          None if valid is None else [valid[i] for i in idxs]))
+            for shard in shards:
+                for i, outcome in zip(by_shard[shard], self.__conns[shard].recv()):
+                    outcomes[i] = outcome
+                    DEPOSIT_COUNTERS[outcome[0]].inc()
+        finally:
+            for shard in shards:
+                self.__shard_locks[shard].release()
+        return outcomes
@@ -8,111 +8,216 @@
 ##############################################################
 
 import random
+import collections
 from pubrepo import pubrepo
-from ntutils import mult_inv
+from grputils import mod_exp, mod_mult, mod_inv, fixed_base_table
+from records import coin_record, signature_record, secret_record, blinding_record
+from metrics import trace, timed, DEBUG, WARNING
+
+def precompute_blindings(tables, q, n):
+    """
+    n blinding_records for the withdrawal of n coins. tables are the
+    fixed-base tables of (I*g2, z', g, g1, g2). The secret 5-tuples are
+    drawn from the OS random source, so that forked worker processes
+    do not repeat each other's secrets. This is a module-level function
+    so that it can run in a process pool, e.g.,
+    spender.precompute_coins(n, concurrent.futures.ProcessPoolExecutor()).
+    """
+    I_g2_table, z_prime_table, g_table, g1_table, g2_table = tables
+    rng = random.SystemRandom()
+    p = I_g2_table.p
+    blindings = []
+    for _ in range(n):
+        ### s != 0 (mod q) makes A != 1, and alpha1 != 0 is invertible.
+        s, x1, x2, alpha1, alpha2 = (rng.randrange(1, q) for _ in range(5))
+        A = I_g2_table.exp(s)
+        B = mod_mult(g1_table.exp(x1), g2_table.exp(x2), p)
+        z = z_prime_table.exp(s)
+        blindings.append(blinding_record(secret_record(s, x1, x2, alpha1, alpha2), A, B, z,
+                                         g_table.exp(alpha2), mod_exp(A, alpha2, p), mod_inv(alpha1, q)))
+    return blindings
 
 class spender(object):
 
-    def __init__(self):
-        ### The spender chooses a secret identity u (cf. Slide 19).
-        self.__u  = random.randint(3, 15)
-        ### The spender keeps track of the spent coins.
-        self.__spent_coins = set()
-        ### This is the current unspent coin
-        self.__unspent_coin = None
-        ### This is the secret random 5 tuple created by
-        ### the spender for each requested coin (cf. Slide 22).
-        self.__secret_5_tup = None
+    def __init__(self, u=None):
+        ### The spender chooses a secret identity u (cf. Slide 19),
+        ### unless u is given, e.g., to keep the identities of many
+        ### spenders in a simulation apart.
+        self.__u  = u if u is not None else random.randint(3, 15)
+        ### The spender keeps track of the spent coins
+        ### as (coin, coin signature, secret 5-tuple) records.
+        self.__spent_coins = []
+        ### The wallet of unspent coins, each with the secret random
+        ### 5-tuple created by the spender for it (cf. Slide 22),
+        ### oldest first.
+        self.__unspent_coins = collections.deque()
+        ### The precomputed blindings of future coins and the
+        ### futures of blindings still being computed in a pool.
+        self.__blindings = collections.deque()
+        self.__pending_blindings = []
         
     def create_bank_account(self, bnk, pbr):
         ### the sponder computes I by looking up g1 and p in public repo pbr
         ### and sends I to the bank bnk. (cf. Slide 19).
-        self.__I = (pbr.get_g1()**self.__u) % pbr.get_p()
+        self.__I = pbr.fixed_base_exp(pbr.get_g1(), self.__u)
         ### the bank sends z' to the spender (cf. Slide 19) after
         ### it creates the spender's account.
-        print('Spender {} requested Bank to create a spender account.'.format(self.__I))
+        trace(DEBUG, 'Spender {} requested Bank to create a spender account.', self.__I)
         self.__z_prime = bnk.create_spender_account(self.__I, pbr)
-        print('Spender {} received z_prime {} from Bank.'.format(self.__I, self.__z_prime))
-
-    def __gen_secret_5_tup(self, pbr):
-        """
-        a generator for a random 5 tuple created by the spender.
-        Cf. Slide 22. 
-        """
-        s = random.randint(3, 101)
-        A = ((self.__I*pbr.get_g2())**s) % pbr.get_p()        
-        while A == 1:
-            s = random.randint(3, 101)
-            print('I == {}'.format(self.__I))
-            print('g2 == {}'.format(pbr.get_g2()))
-            print('p == {}'.format(pbr.get_p()))
-            print('s == {}'.format(s))
-            A = ((self.__I*pbr.get_g2())**s) % pbr.get_p()
-        x1, x2, alpha1, alpha2 = tuple(random.randint(3, 15) for i in range(4))
-        print('Spender created secret random 5-tuple {}'.format(((s, x1, x2, alpha1, alpha2))))
-        return (s, x1, x2, alpha1, alpha2)
+        trace(DEBUG, 'Spender {} received z_prime {} from Bank.', self.__I, self.__z_prime)
+        ### the spender raises I*g2 and z' to a fresh s for every coin,
+        ### so it keeps fixed-base tables for both. I*g2 is in the
+        ### order-q subgroup, because I = g1^u.
+        p = pbr.get_p()
+        self.__I_g2_table = fixed_base_table(mod_mult(self.__I, pbr.get_g2(), p), p, pbr.get_q())
+        self.__z_prime_table = fixed_base_table(self.__z_prime, p)
+        tab = pbr.get_fixed_base_table
+        self.__tables = (self.__I_g2_table, self.__z_prime_table,
+                         tab(pbr.get_g()), tab(pbr.get_g1()), tab(pbr.get_g2()))
+        self.__q = pbr.get_q()
+
+    def precompute_coins(self, n, executor=None, chunk_size=64):
+        """
+        Precompute the blindings of n future coins offline, so that
+        request_coin only waits for the bank and does two
+        exponentiations by the bank's gw and beta. With a
+        concurrent.futures executor, the work is submitted in chunks of
+        chunk_size and this returns at once; otherwise it is done here.
+        """
+        if executor is None:
+            self.__blindings.extend(precompute_blindings(self.__tables, self.__q, n))
+            return
+        for k in range(0, n, chunk_size):
+            self.__pending_blindings.append(executor.submit(precompute_blindings, self.__tables,
+                                                            self.__q, min(chunk_size, n - k)))
 
+    def get_num_precomputed_coins(self):
+        self.__collect_blindings()
+        return len(self.__blindings)
+
+    def __collect_blindings(self):
+        if self.__pending_blindings:
+            done = [f for f in self.__pending_blindings if f.done()]
+            for f in done:
+                self.__pending_blindings.remove(f)
+                self.__blindings.extend(f.result())
+
+    def __next_blinding(self):
+        """
+        a precomputed blinding, or one computed on the spot if there is
+        none.
+        """
+        self.__collect_blindings()
+        if not self.__blindings and self.__pending_blindings:
+            f = self.__pending_blindings.pop(0)
+            self.__blindings.extend(f.result())
+        if self.__blindings:
+            return self.__blindings.popleft()
+        return precompute_blindings(self.__tables, self.__q, 1)[0]
+
+    @timed('spender.request_coin')
     def request_coin(self, bnk, pbr):
         """
-        The spender requests that a coin be created by the bank.
+        The spender requests that a coin be created by the bank and adds
+        it to the wallet. Returns the coin, or None if the bank declines.
         Cf. Slides 22, 23.
         """
         ## the bank computes gw and beta and sends it to Spender
-        print('Spender {} requested gw and beta from Bank.'.format(self.__I))
+        trace(DEBUG, 'Spender {} requested gw and beta from Bank.', self.__I)
         gw, beta = bnk.compute_gw_beta(self.__I, pbr)
-        ## The Spender generates a secret random 5-tuple. A new 5-tuple for every newly issued
-        ## coin.
-        s, x1, x2, alpha1, alpha2 = self.__gen_secret_5_tup(pbr)
-        self.__secret_5_tup = s, x1, x2, alpha1, alpha2
-        A = (self.__I*pbr.get_g2())**s % pbr.get_p()
-        assert A != 1
-        B = ((pbr.get_g1()**x1)*(pbr.get_g2()**x2)) % pbr.get_p()
-        z = (self.__z_prime)**s % pbr.get_p()
-        a = ((gw**alpha1)*(pbr.get_g()**alpha2)) % pbr.get_p()
-        b = ((beta**(s*alpha1))*(A**alpha2)) % pbr.get_p()
-
-        ### The Spender computes c ≡ alpha1^{−1} H(A, B, z, a, b) (mod q) and sends c
-        ### to the bank. Cf. Slides 24, 25
-        mult_inv_alpha1 = mult_inv(alpha1, pbr.get_q())
-        c = (mult_inv_alpha1 * pbr.get_H()((A,B,z,a,b))) % pbr.get_q()
-        print('Spender {} computed c == {}.'.format(self.__I, c))
-        
+        bl = self.__next_blinding()
+        A, B, z, a, b, c = self.__blind(bl, gw, beta, pbr)
         ### The Spender requests that the bank compute c1
         ### to create a coin. Cf. Slides 24, 25
-        print('Spender {} requested c1 Bank.'.format(self.__I))
+        trace(DEBUG, 'Spender {} requested c1 Bank.', self.__I)
         c1 = bnk.compute_c1(self.__I, c, gw, pbr)
+        if c1 is None:
+            ### the bank has seen c, so a coin of the same blinding would
+            ### be linkable to this request; the blinding is dropped.
+            return None
+        return self.__add_coin(bl, (A, B, z, a, b), c1, pbr)
+
+    @timed('spender.request_coins')
+    def request_coins(self, bnk, pbr, n):
+        """
+        The spender requests n coins from the bank in two round trips:
+        one for n (gw, beta) pairs and one for n c1s, for which the bank
+        debits the account once. Returns the list of new coins, or None
+        if the bank declines, e.g., because the account has fewer than
+        n credits.
+        """
+        trace(DEBUG, 'Spender {} requested {} gws and betas from Bank.', self.__I, n)
+        gw_betas = bnk.compute_gw_betas(self.__I, n, pbr)
+        bls = [self.__next_blinding() for _ in range(n)]
+        blinded = [self.__blind(bl, gw, beta, pbr) for bl, (gw, beta) in zip(bls, gw_betas)]
+        trace(DEBUG, 'Spender {} requested {} c1s from Bank.', self.__I, n)
+        c1s = bnk.compute_c1s(self.__I, [bc[5] for bc in blinded], [gw for gw, _ in gw_betas], pbr)
+        if c1s is None:
+            ### the bank has seen the cs; the blindings are dropped.
+            return None
+        return [self.__add_coin(bl, bc[:5], c1, pbr) for bl, bc, c1 in zip(bls, blinded, c1s)]
+
+    def __blind(self, bl, gw, beta, pbr):
+        """
+        (A, B, z, a, b, c) of the coin with the blinding bl for the bank's
+        gw and beta (cf. Slides 22 - 25).
+        """
+        ## The Spender takes a secret random 5-tuple. A new 5-tuple for every newly issued
+        ## coin, precomputed with A, B, z, g^alpha2, A^alpha2, and alpha1^{-1}.
+        s, x1, x2, alpha1, alpha2 = bl.secret
+        trace(DEBUG, 'Spender created secret random 5-tuple {}', bl.secret)
+        p = pbr.get_p()
+        q = pbr.get_q()
+        A, B, z = bl.A, bl.B, bl.z
+        a = mod_mult(mod_exp(gw, alpha1, p), bl.g_alpha2, p)
+        ### beta is in the order-q subgroup, so s*alpha1 is reduced mod q.
+        b = mod_mult(mod_exp(beta, (s*alpha1) % q, p), bl.A_alpha2, p)
+
+        ### The Spender computes c ≡ alpha1^{−1} H(A, B, z, a, b) (mod q) and sends c
+        ### to the bank. Cf. Slides 24, 25
+        c = (bl.alpha1_inv * pbr.get_H()((A,B,z,a,b))) % q
+        trace(DEBUG, 'Spender {} computed c == {}.', self.__I, c)
+        return A, B, z, a, b, c
+
+    def __add_coin(self, bl, A_B_z_a_b, c1, pbr):
+        _, _, _, alpha1, alpha2 = bl.secret
         ### The Spender computes r = (alpha1*c1 + alpha2) (mod q).
         r = (alpha1*c1 + alpha2) % pbr.get_q()
-        print('Spender {} computed r == {}.'.format(self.__I, r))        
-        ### the Spender now has one newly issued unspent coin
-        self.__unspent_coin = (A,B,z,a,b,r)
-        print('Spender {} received the unspent coin {}.'.format(self.__I, self.__unspent_coin))
+        trace(DEBUG, 'Spender {} computed r == {}.', self.__I, r)
+        ### the Spender now has one more newly issued unspent coin
+        coin = coin_record(*A_B_z_a_b, r)
+        self.__unspent_coins.append((coin, bl.secret))
+        trace(DEBUG, 'Spender {} received the unspent coin {}.', self.__I, coin)
+        return coin
+
+    def get_num_unspent_coins(self):
+        return len(self.__unspent_coins)
 
+    @timed('spender.spend_unspent_coin')
     def spend_unspent_coin(self, mrt, pbr):
         """
-        The newly issued unspent coin is spent by the spender at the merchant.
+        The oldest unspent coin in the wallet is spent by the spender at the merchant.
         """
+        assert self.__unspent_coins, 'the wallet has no unspent coins'
+        coin, secret = self.__unspent_coins.popleft()
         ### spender receives d from the merchant (cf. SLide 27).
-        print('Spender {} requested Merchant {} to compute d'.format(self.__I, mrt.get_id()))
-        d = mrt.compute_d(self.__unspent_coin, pbr)
+        trace(DEBUG, 'Spender {} requested Merchant {} to compute d', self.__I, mrt.get_id())
+        d = mrt.compute_d(coin, pbr)
         assert d is not None
         ### spender computes r1 and r2 (cf. Slide 27).
-        s, x1, x2, _, _ = self.__secret_5_tup
+        s, x1, x2, _, _ = secret
         q = pbr.get_q()
         r1 = (d*self.__u*s + x1) % q
         r2 = (d*s + x2) % q
         ### spender requests the merchant to accept the coin
         ### r1, r2, and d are the coin signature.
-        print('Spender {} requested Merchant {} to accept coin {} with signature {}'.format(self.__I,
-                                                                                            mrt.get_id(),
-                                                                                            self.__unspent_coin,
-                                                                                            (r1, r2, d)))
-        mrt.accept_coin(self.__unspent_coin, r1, r2, d, pbr)
+        coin_signature = signature_record(r1, r2, d)
+        trace(DEBUG, 'Spender {} requested Merchant {} to accept coin {} with signature {}',
+              self.__I, mrt.get_id(), coin, coin_signature)
+        mrt.accept_coin(coin, r1, r2, d, pbr)
         ### the sepnder adds the coin, the coin's signature, and the
-        ### secret random 5 tuple for bookeeping to the set of spent coins.
-        self.__spent_coins.add((self.__unspent_coin, (r1, r2, d), self.__secret_5_tup))
-        ### the unspent coin is set to None.
-        self.__unspent_coin = None
+        ### secret random 5 tuple for bookeeping to the spent coins.
+        self.__spent_coins.append((coin, coin_signature, secret))
 
     def get_balance(self, bnk):
         return bnk.balance_for_spender_account(self.__I)
@@ -122,19 +227,19 @@ class spender(object):
         Spender attempts to double spend a coin with the vendor vndr.
         Cf. Slides 32, 33, 34.
         """
-        ### 1. get a spent coin from self.__spent_coins
-        spent_coin = self.__spent_coins.pop()[0]
-        print('Spender {} attempts to double spend coin = {}'.format(self.__I, spent_coin))
+        ### 1. get a spent coin and its own secret 5-tuple from self.__spent_coins
+        spent_coin, _, secret = self.__spent_coins.pop()
+        trace(WARNING, 'Spender {} attempts to double spend coin = {}', self.__I, spent_coin)
         
         ### 2. the spender requests the vendor to compute d_prime.
         ###    with compute_d() above.
         d_prime = vdr.compute_d(spent_coin, pbr)
-        print('d_prime = {}'.format(d_prime))
+        trace(DEBUG, 'd_prime = {}', d_prime)
         assert d_prime is not None
         
         ### 3. the spender computes r1_prime, r2_prime
         ### your code here
-        s, x1, x2, _, _ = self.__secret_5_tup
+        s, x1, x2, _, _ = secret
         q = pbr.get_q()
         r1_prime = (d_prime*self.__u*s + x1) % q
         r2_prime = (d_prime*s + x2) % q
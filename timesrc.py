@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#############################################################
+# module: timesrc.py
+# descrip: the time stamps t that the merchants hash into the
+# challenges d == H0(A,B,M,t) (cf. Slide 27). The stamps are
+# leased in blocks from an allocator, so that threads and
+# parties take stamps without contention and no stamp is
+# handed out twice, even across processes.
+# bugs to vladimir kulyukin via canvas
+##############################################################
+
+import multiprocessing
+import os
+import threading
+import time
+
+### the number of forks since this process started. A process forked
+### with a partly used block would hand out its rest in the parent and
+### the child alike, so a cursor drops its block in a forked child.
+_forks = 0
+
+def _after_fork_in_child():
+    global _forks
+    _forks += 1
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+class counter_allocator(object):
+    """
+    Leases the blocks [lo, lo + block_size) of the stamps start,
+    start + 1, ... . With shared, the next block is kept in a
+    multiprocessing.Value, so that processes forked from this one, or
+    started with the allocator as an argument, lease disjoint blocks.
+    """
+
+    def __init__(self, block_size=1024, start=1, shared=False):
+        assert block_size > 0
+        self.block_size = block_size
+        if shared:
+            self.__next = multiprocessing.Value('q', start)
+            self.__lock = self.__next.get_lock()
+        else:
+            self.__next = None
+            self.__start = start
+            self.__lock = threading.Lock()
+
+    def lease(self):
+        """
+        the range of the stamps of a fresh block.
+        """
+        with self.__lock:
+            if self.__next is None:
+                lo = self.__start
+                self.__start += self.block_size
+            else:
+                lo = self.__next.value
+                self.__next.value = lo + self.block_size
+        return range(lo, lo + self.block_size)
+
+class wall_clock_allocator(object):
+    """
+    Leases blocks of block_size stamps that follow the wall clock in
+    microseconds. Every block starts at the current microsecond or after
+    the previous block, whichever is later, so the stamps increase even
+    if the clock is set back. A stamp is (microseconds << node_bits) |
+    node_id, so the stamps of nodes (e.g., hosts or processes) with
+    distinct node_ids never collide.
+    """
+
+    def __init__(self, block_size=64, node_id=0, node_bits=10, clock=time.time_ns):
+        assert block_size > 0 and 0 <= node_id < (1 << node_bits)
+        self.block_size = block_size
+        self.node_id = node_id
+        self.node_bits = node_bits
+        self.__clock = clock
+        self.__next = 0
+        self.__lock = threading.Lock()
+
+    def lease(self):
+        with self.__lock:
+            lo = max(self.__next, self.__clock() // 1000)
+            self.__next = lo + self.block_size
+        nb, node = self.node_bits, self.node_id
+        return range((lo << nb) | node, ((lo + self.block_size) << nb) | node, 1 << nb)
+
+class time_cursor(object):
+    """
+    The stamps of the blocks leased by one party, e.g., one merchant,
+    in increasing order. A cursor is not shared between threads; in a
+    forked child, it leases a block of its own.
+    """
+
+    __slots__ = ('allocator', 'stamps', 'forks')
+
+    def __init__(self, allocator):
+        self.allocator = allocator
+        self.stamps = iter(())
+        self.forks = _forks
+
+    def __call__(self):
+        if self.forks != _forks:
+            self.stamps = iter(())
+            self.forks = _forks
+        for t in self.stamps:
+            return t
+        self.stamps = iter(self.allocator.lease())
+        return next(self.stamps)
+
+class time_source(object):
+    """
+    A source of unique time stamps. Every thread takes its stamps from
+    its own leased block, so threads contend only when they lease a new
+    one. The stamps of a thread increase; stamps of different threads
+    are unordered. The allocator is a counter_allocator by default;
+    a wall_clock_allocator makes the stamps follow the wall clock.
+    """
+
+    def __init__(self, allocator=None):
+        self.allocator = allocator if allocator is not None else counter_allocator()
+        self.__local = threading.local()
+
+    def __call__(self):
+        cursor = getattr(self.__local, 'cursor', None)
+        if cursor is None:
+            cursor = self.__local.cursor = time_cursor(self.allocator)
+        return cursor()
+
+    def cursor(self):
+        """
+        a time_cursor of the blocks of this source for one party.
+        """
+        return time_cursor(self.allocator)
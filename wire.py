@@ -0,0 +1,189 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#############################################################
+# module: wire.py
+# descrip: versioned fixed-width binary encoding of coins,
+# coin signatures, and deposit records, and the coin digest
+# that identifies a coin in the bank's ledgers.
+# bugs to vladimir kulyukin via canvas
+##############################################################
+
+import hashlib
+import struct
+from grputils import element_width, encode_elements
+
+### Every element is a big-endian unsigned integer of width bytes,
+### where width == element_width(p) for the group modulus p:
+###   coin           == A B z a b r              (6 elements)
+###   signature      == r1 r2 d                  (3 elements)
+###   deposit record == merchant_id coin signature (10 elements)
+### A batch of records starts with a 12-byte header:
+###   magic (4 bytes) version (1) kind (1) width (2) count (4).
+MAGIC = b'DCWF'
+VERSION = 1
+COIN, SIGNATURE, DEPOSIT_RECORD = 1, 2, 3
+HEADER = struct.Struct('>4sBBHI')
+
+_NUM_ELEMENTS = {COIN: 6, SIGNATURE: 3, DEPOSIT_RECORD: 10}
+
+def wire_width(pbr):
+    """
+    the width in bytes of an element in the wire format of the group in
+    the public repo pbr.
+    """
+    return element_width(pbr.get_p())
+
+def record_size(kind, width):
+    return _NUM_ELEMENTS[kind] * width
+
+def coin_digest(coin):
+    """
+    A 32-byte SHA-256 digest of the coin (A,B,z,a,b,r). Each element
+    is encoded as a 2-byte length followed by its big-endian bytes,
+    so the digest does not depend on the size of the group and a coin
+    keeps its digest when it is decoded from any wire width.
+    """
+    buf = bytearray()
+    for x in coin:
+        xb = int_to_bytes(x)
+        buf += len(xb).to_bytes(2, 'big')
+        buf += xb
+    return hashlib.sha256(buf).digest()
+
+def int_to_bytes(n):
+    """
+    the minimal signed big-endian encoding of the integer n.
+    """
+    return n.to_bytes(n.bit_length() // 8 + 1, 'big', signed=True)
+
+def int_from_bytes(b):
+    return int.from_bytes(b, 'big', signed=True)
+
+def _unpack_elements(buf, n, width, offset):
+    ### slices of a memoryview share its buffer, so nothing is
+    ### copied before int.from_bytes reads the element.
+    mv = memoryview(buf)
+    if offset + n*width > len(mv):
+        raise ValueError('buffer too short for {} elements of {} bytes'.format(n, width))
+    return tuple(int.from_bytes(mv[i:i+width], 'big')
+                 for i in range(offset, offset + n*width, width))
+
+def pack_coin(coin, width):
+    return encode_elements(coin, width)
+
+def unpack_coin(buf, width, offset=0):
+    """
+    the coin (A,B,z,a,b,r) at offset in the bytes-like object buf.
+    """
+    return _unpack_elements(buf, 6, width, offset)
+
+def pack_signature(coin_signature, width):
+    return encode_elements(coin_signature, width)
+
+def unpack_signature(buf, width, offset=0):
+    """
+    the coin signature (r1,r2,d) at offset in the bytes-like object buf.
+    """
+    return _unpack_elements(buf, 3, width, offset)
+
+def pack_deposit_record(merchant_id, coin, coin_signature, width):
+    return encode_elements((merchant_id,) + tuple(coin) + tuple(coin_signature), width)
+
+def unpack_deposit_record(buf, width, offset=0):
+    """
+    the deposit record (merchant_id, coin, coin_signature) at offset
+    in the bytes-like object buf.
+    """
+    xs = _unpack_elements(buf, 10, width, offset)
+    return xs[0], xs[1:7], xs[7:]
+
+def pack_header(kind, width, count):
+    return HEADER.pack(MAGIC, VERSION, kind, width, count)
+
+def unpack_header(buf, offset=0):
+    """
+    the (kind, width, count) of the batch header at offset in buf.
+    Raises ValueError if buf does not start a batch of this version.
+    """
+    if len(buf) - offset < HEADER.size:
+        raise ValueError('buffer too short for a batch header')
+    magic, version, kind, width, count = HEADER.unpack_from(buf, offset)
+    if magic != MAGIC:
+        raise ValueError('not a coin batch: bad magic {!r}'.format(magic))
+    if version != VERSION:
+        raise ValueError('unsupported wire format version {}'.format(version))
+    if kind not in _NUM_ELEMENTS or width == 0:
+        raise ValueError('bad batch header: kind {}, width {}'.format(kind, width))
+    return kind, width, count
+
+def pack_deposit_records(deposit_records, width):
+    """
+    the batch of the (merchant_id, coin, coin_signature) triples in
+    deposit_records.
+    """
+    body = [pack_deposit_record(merchant_id, coin, coin_signature, width)
+            for merchant_id, coin, coin_signature in deposit_records]
+    return pack_header(DEPOSIT_RECORD, width, len(body)) + b''.join(body)
+
+def iter_deposit_records(buf):
+    """
+    iterate over the (merchant_id, coin, coin_signature) triples of the
+    batch in the bytes-like object buf, e.g., a bytes object, a
+    bytearray, or an mmap. The records are decoded in place, one at a time.
+    """
+    kind, width, count = unpack_header(buf)
+    if kind != DEPOSIT_RECORD:
+        raise ValueError('not a batch of deposit records: kind {}'.format(kind))
+    size = record_size(DEPOSIT_RECORD, width)
+    if len(buf) != HEADER.size + count*size:
+        raise ValueError('batch of {} records has {} bytes'.format(count, len(buf)))
+    for offset in range(HEADER.size, HEADER.size + count*size, size):
+        yield unpack_deposit_record(buf, width, offset)
+
+def write_deposit_records(f, deposit_records, width):
+    """
+    write the (merchant_id, coin, coin_signature) triples from the
+    iterable deposit_records to the binary file f as one batch, e.g.,
+    a merchant's settlement file, one record at a time. The count in
+    the header is filled in at the end, so f must be seekable.
+    Returns the number of records written.
+    """
+    start = f.tell()
+    f.write(pack_header(DEPOSIT_RECORD, width, 0))
+    count = 0
+    for merchant_id, coin, coin_signature in deposit_records:
+        f.write(pack_deposit_record(merchant_id, coin, coin_signature, width))
+        count += 1
+    end = f.tell()
+    f.seek(start)
+    f.write(pack_header(DEPOSIT_RECORD, width, count))
+    f.seek(end)
+    return count
+
+def iter_deposit_record_chunks(src, chunk_records=4096):
+    """
+    iterate over the records of the batch in src in lists of up to
+    chunk_records (merchant_id, coin, coin_signature) triples. src is
+    a binary file, which is read into one reused buffer of chunk_records
+    records, or a bytes-like object such as an mmap, which is decoded
+    in place. Either way, at most one chunk is held in memory.
+    """
+    if not hasattr(src, 'readinto'):
+        recs = iter_deposit_records(src)
+        while True:
+            chunk = [rec for _, rec in zip(range(chunk_records), recs)]
+            if not chunk:
+                return
+            yield chunk
+    kind, width, count = unpack_header(src.read(HEADER.size))
+    if kind != DEPOSIT_RECORD:
+        raise ValueError('not a batch of deposit records: kind {}'.format(kind))
+    size = record_size(DEPOSIT_RECORD, width)
+    buf = memoryview(bytearray(chunk_records * size))
+    while count:
+        n = min(count, chunk_records)
+        if src.readinto(buf[:n*size]) != n*size:
+            raise ValueError('batch is truncated')
+        yield [unpack_deposit_record(buf, width, offset) for offset in range(0, n*size, size)]
+        count -= n